@@ -0,0 +1,160 @@
+"""
+流式解码器微基准 - 回放录制的流式响应，测量每个token的CPU开销
+
+用法:
+    python benchmarks/stream_decoder_bench.py                   # 使用内置生成的 Ollama/OpenAI 流（各 20000 块）
+    python benchmarks/stream_decoder_bench.py --chunks 50000
+    python benchmarks/stream_decoder_bench.py --replay capture.ndjson   # 回放真实录制的流
+
+录制真实流可以使用:
+    curl -N http://localhost:1314/api/chat -d '{"model":"qwen2.5:3b","messages":[{"role":"user","content":"你好"}]}' > capture.ndjson
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.stream_decoder import StreamDecoder, extract_stream_content  # noqa: E402
+
+# 模拟真实回复中的token：中英文、标点、换行、引号和代码
+SAMPLE_TOKENS = ["你好", "，", "这是", "一个", "测试", "。", "Hello", " world", "!", "\n", "```python", "\n",
+                 "print", "(\"", "hi", "\")", "\n", "```", " 😊", "\t", "\\", "数据"]
+
+
+def make_ollama_stream(chunks):
+    """生成 Ollama /api/chat 格式的 NDJSON 流"""
+    rng = random.Random(42)
+    lines = []
+    for _ in range(chunks):
+        lines.append(json.dumps({
+            "model": "qwen2.5:3b",
+            "created_at": "2025-04-15T08:00:00.000000Z",
+            "message": {"role": "assistant", "content": rng.choice(SAMPLE_TOKENS)},
+            "done": False
+        }, ensure_ascii=False, separators=(",", ":")))
+    lines.append(json.dumps({"model": "qwen2.5:3b", "message": {"role": "assistant", "content": ""},
+                             "done": True, "eval_count": chunks}, separators=(",", ":")))
+    return ("\n".join(lines) + "\n").encode("utf-8")
+
+
+def make_openai_stream(chunks):
+    """生成 OpenAI SSE 格式的流"""
+    rng = random.Random(7)
+    events = []
+    for _ in range(chunks):
+        events.append("data: " + json.dumps({
+            "id": "chatcmpl-bench",
+            "object": "chat.completion.chunk",
+            "created": 1713168000,
+            "model": "gpt-4o-mini",
+            "choices": [{"index": 0, "delta": {"content": rng.choice(SAMPLE_TOKENS)}, "finish_reason": None}]
+        }, ensure_ascii=False, separators=(",", ":")))
+    events.append("data: [DONE]")
+    return ("\n\n".join(events) + "\n\n").encode("utf-8")
+
+
+def split_network_chunks(payload, min_size=256, max_size=4096, seed=1):
+    """把完整的流切分成随机大小的网络包，模拟 iter_content 的到达方式"""
+    rng = random.Random(seed)
+    parts = []
+    pos = 0
+    while pos < len(payload):
+        size = rng.randint(min_size, max_size)
+        parts.append(payload[pos:pos + size])
+        pos += size
+    return parts
+
+
+def legacy_decode(parts):
+    """旧实现：按行 decode + json.loads + 逐层取字典（作为对照）"""
+    out = []
+    pending = b""
+    for part in parts:
+        pending += part
+        *lines, pending = pending.split(b"\n")
+        for line in lines:
+            if not line:
+                continue
+            if line.startswith(b"data: "):
+                data_text = line[6:].decode("utf-8", errors="replace")
+                if data_text.strip() == "[DONE]":
+                    return out
+                try:
+                    content = extract_stream_content(json.loads(data_text))
+                    if content:
+                        out.append(content)
+                except json.JSONDecodeError:
+                    pass
+            else:
+                line_text = line.decode("utf-8", errors="replace")
+                try:
+                    content = extract_stream_content(json.loads(line_text))
+                    if content:
+                        out.append(content)
+                except json.JSONDecodeError:
+                    if line_text and not line_text.startswith(("{", "[")):
+                        out.append(line_text)
+    return out
+
+
+def decoder_decode(parts):
+    """新实现：增量字节解码器"""
+    decoder = StreamDecoder()
+    out = []
+    for part in parts:
+        out.extend(decoder.feed(part))
+        if decoder.done:
+            break
+    out.extend(decoder.flush())
+    return out
+
+
+def bench(name, func, parts, repeat):
+    """运行多次取最佳耗时，返回 (每块纳秒, 结果)"""
+    best = float("inf")
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(parts)
+        best = min(best, time.perf_counter() - start)
+    per_chunk_ns = best / max(len(result), 1) * 1e9
+    print(f"  {name:<10} {best * 1000:8.2f} ms  {per_chunk_ns:8.0f} ns/chunk  ({len(result)} chunks)")
+    return per_chunk_ns, result
+
+
+def run_case(label, payload, repeat):
+    parts = split_network_chunks(payload)
+    print(f"{label}: {len(payload) / 1024:.0f} KiB, {len(parts)} network reads")
+    legacy_ns, legacy_out = bench("legacy", legacy_decode, parts, repeat)
+    decoder_ns, decoder_out = bench("decoder", decoder_decode, parts, repeat)
+    if "".join(legacy_out) != "".join(decoder_out):
+        print("  !! 输出不一致")
+        return False
+    print(f"  speedup    {legacy_ns / decoder_ns:.2f}x")
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser(description="流式解码器微基准")
+    parser.add_argument("--chunks", type=int, default=20000, help="生成流中的数据块数量")
+    parser.add_argument("--repeat", type=int, default=5, help="重复次数（取最佳）")
+    parser.add_argument("--replay", action="append", default=[], help="回放录制的流文件，可多次指定")
+    args = parser.parse_args()
+
+    ok = True
+    if args.replay:
+        for path in args.replay:
+            with open(path, "rb") as f:
+                ok &= run_case(os.path.basename(path), f.read(), args.repeat)
+    else:
+        ok &= run_case("ollama-ndjson", make_ollama_stream(args.chunks), args.repeat)
+        ok &= run_case("openai-sse", make_openai_stream(args.chunks), args.repeat)
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
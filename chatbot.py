@@ -1,10 +1,12 @@
 import streamlit as st
 from utils.theme import inject_custom_css
-from utils.api import LLMClient
+from utils.async_api import create_llm_client
 from components.sidebar import render_sidebar, update_system_prompt_for_language
-from components.chat import display_chat_history, handle_user_input
+from components.chat import display_chat_history, handle_user_input, render_active_generation
 from utils.document_processor import document_processor
 from utils.config import CONFIG
+from utils.history_store import create_chat_histories, chat_summaries, set_chat_title
+from utils.identity import identity
 import uuid
 import datetime
 import os
@@ -23,21 +25,26 @@ def ensure_chat_titles_use_current_language(chat_histories, language):
         "New Chat": "新对话"
     }
 
-    for chat_id, chat in chat_histories.items():
+    # 只读取对话摘要，不加载消息
+    for chat in chat_summaries(chat_histories):
         title = chat.get("title", "")
+        new_title = title
         
         # 处理默认标题
         if title in title_mapping:
-            chat["title"] = "新对话" if is_chinese else "New Chat"
+            new_title = "新对话" if is_chinese else "New Chat"
             
         # 检查标题中是否包含中英文默认标题部分
         for zh_title, en_title in title_mapping.items():
             if zh_title in title and not is_chinese:
                 # 中文标题在英文模式下
-                chat["title"] = title.replace(zh_title, en_title)
+                new_title = title.replace(zh_title, en_title)
             elif en_title in title and is_chinese:
                 # 英文标题在中文模式下
-                chat["title"] = title.replace(en_title, zh_title)
+                new_title = title.replace(en_title, zh_title)
+        
+        if new_title != title:
+            set_chat_title(chat_histories, chat["id"], new_title)
 
 # 文档上传组件
 def render_document_upload():
@@ -432,20 +439,42 @@ st.set_page_config(
 # 初始化页面样式
 inject_custom_css()
 
-# 初始化LLM客户端 - 只创建一次实例
+# 初始化LLM客户端 - 整个进程共享一个实例（连接池和可用模型列表在所有会话间复用）
+@st.cache_resource(show_spinner=False)
+def get_shared_llm_client():
+    """创建进程内共享的LLM客户端"""
+    return create_llm_client()
+
 if "llm_client" not in st.session_state:
     try:
-        st.session_state.llm_client = LLMClient()
+        st.session_state.llm_client = get_shared_llm_client()
     except Exception as e:
         st.error(f"初始化LLM客户端失败: {e}，请确保Ollama服务已启动")
-        st.session_state.llm_client = LLMClient()  # 尝试再次创建，即使失败也能继续运行UI
+        st.session_state.llm_client = create_llm_client()  # 尝试再次创建，即使失败也能继续运行UI
+
+# 聊天历史的所有者：登录用户或服务端签发的匿名标识（签名 Cookie），不从页面地址中读取
+if "owner" not in st.session_state:
+    st.session_state.owner, owner_token = identity.current_owner()
+    if owner_token:
+        identity.issue_cookie(owner_token)
 
-# 初始化聊天历史管理
+# 会话标识，用于请求调度器在不同用户之间公平排队；同时写入URL参数，
+# 重新打开页面时可以重新连接到进行中的后台生成（sid 的签名绑定到所有者，其他人打开链接会得到新的会话）
+if "session_id" not in st.session_state:
+    st.session_state.session_id = identity.session_id_for(st.session_state.owner, st.query_params.get("sid"))
+    st.query_params["sid"] = st.session_state.session_id
+
+# 初始化聊天历史管理（启用持久化存储时对话保存在 SQLite 中，按需加载）
 if "chat_histories" not in st.session_state:
-    st.session_state.chat_histories = {}
+    st.session_state.chat_histories = create_chat_histories(st.session_state.owner)
 
-# 初始化当前聊天ID
+# 初始化当前聊天ID：有保存的对话时打开最近的一个
 if "current_chat_id" not in st.session_state:
+    recent_chats = chat_summaries(st.session_state.chat_histories, limit=1)
+    if recent_chats:
+        st.session_state.current_chat_id = recent_chats[0]["id"]
+
+if st.session_state.get("current_chat_id") not in st.session_state.chat_histories:
     # 创建新的聊天会话
     new_chat_id = str(uuid.uuid4())
     st.session_state.current_chat_id = new_chat_id
@@ -464,7 +493,7 @@ if "language" not in st.session_state:
 if "is_generating" not in st.session_state:
     st.session_state.is_generating = False
 
-# 不使用队列：我们采用前端冷却 + 后端校验的方式防止重复请求
+# 单个会话内使用前端冷却 + 后端校验防止重复请求；跨会话的并发由 utils/scheduler.py 排队控制
 
 # 获取当前聊天会话
 current_chat = st.session_state.chat_histories[st.session_state.current_chat_id]
@@ -486,7 +515,7 @@ def switch_language(lang):
         ensure_chat_titles_use_current_language(st.session_state.chat_histories, lang)
         
         # 使用JavaScript重定向实现页面刷新，替代st.experimental_rerun()
-        current_url = f"?lang={lang}"
+        current_url = f"?lang={lang}&sid={st.session_state.session_id}"
         st.markdown(
             f"""
             <script>
@@ -675,6 +704,9 @@ settings = render_sidebar(current_chat)
 # 显示聊天历史
 display_chat_history(current_chat["messages"], current_chat.get("model_changes", []))
 
+# 显示进行中的后台生成（页面重新运行不会中断生成）
+render_active_generation()
+
 # 检查是否在主界面显示文档上传功能
 doc_config = CONFIG.get("document_processing", {})
 if doc_config.get("show_in_main_ui", True):
@@ -2,83 +2,122 @@
 import streamlit as st
 import json
 import time
+from contextlib import nullcontext
 from utils.config import CONFIG
 from utils.model_selector import model_selector
 from utils.emotion_detector import emotion_detector
 from utils.document_processor import document_processor
+from utils.scheduler import request_scheduler, AdmissionError, PRIORITY_HIGH, PRIORITY_NORMAL
+from utils.cancellation import CancelledError
+from utils.response_cache import response_cache
+from utils.markdown_cache import markdown_cache
+from utils.context_packer import context_packer
+from utils.summarizer import conversation_summarizer, summary_message
+from utils.prompt_builder import apply_turn_hints, prefix_tracker
+from utils.stream_decoder import StreamError
+from utils.stream_renderer import StreamRenderer
+from utils.generation_worker import generation_manager, STATUS_RUNNING, STATUS_CANCELLED
 
-# 获取缓存配置
-CACHE_CONFIG = CONFIG["cache"]
-
-@st.cache_data(ttl=CACHE_CONFIG["ttl"], max_entries=CACHE_CONFIG["max_entries"])
 def cached_generate_response(messages_json, model, temperature, max_tokens):
-    """缓存模型响应，避免相同提问重复请求API"""
+    """缓存模型响应，避免相同（或语义相近）的独立提问重复请求API"""
     # 获取LLM客户端
     llm_client = st.session_state.llm_client
     # 从JSON还原消息
     messages = json.loads(messages_json)
+    system_prompt = "".join(m["content"] for m in messages if m["role"] == "system")
+    prompt = next((m["content"] for m in reversed(messages) if m["role"] == "user"), "")
+    # 只有单轮提问可以使用缓存
+    cacheable = bool(prompt) and (
+        not response_cache.standalone_only or not any(m["role"] == "assistant" for m in messages)
+    )
+    if cacheable:
+        cached_reply = response_cache.get(prompt, model, temperature, system_prompt)
+        if cached_reply:
+            return cached_reply, None
     # 调用API
-    return llm_client.generate_response(
+    reply, error = llm_client.generate_response(
         messages, 
         model,
         temperature=temperature,
         max_tokens=max_tokens
     )
+    if cacheable and reply and not error:
+        response_cache.put(prompt, model, temperature, system_prompt, reply)
+    return reply, error
+
+def _index_model_changes(model_changes):
+    """按 after_message_index 索引模型切换记录"""
+    changes_by_index = {}
+    for change in model_changes or []:
+        changes_by_index.setdefault(change.get("after_message_index", 0), []).append(change)
+    return changes_by_index
+
+def _render_model_change(change, is_chinese):
+    """显示轻量级的模型切换提示"""
+    model_change_text = f"模型已从 {change['from']} 切换为 {change['to']}" if is_chinese else f"Model changed from {change['from']} to {change['to']}"
+    
+    # 如果是自动切换的，显示不同的文本
+    if change.get("auto", False):
+        model_change_text = f"系统自动将模型从 {change['from']} 切换为 {change['to']}，以更好地回答您的问题" if is_chinese else f"System automatically changed model from {change['from']} to {change['to']} to better answer your question"
+    
+    st.markdown(
+        f"""<div style="text-align: center; padding: 5px; 
+        color: rgba(255,255,255,0.5); font-size: 0.8rem; 
+        margin: 10px 0; font-style: italic; border-top: 1px solid rgba(255,255,255,0.1);
+        border-bottom: 1px solid rgba(255,255,255,0.1); padding: 8px 0;">
+        {model_change_text}
+        </div>""", 
+        unsafe_allow_html=True
+    )
 
 def display_chat_history(messages, model_changes=None):
-    """显示聊天历史"""
+    """显示聊天历史（只渲染最近的若干页，更早的消息按需加载）"""
     # 获取UI配置
     ui_config = CONFIG["ui"]
-    max_messages = ui_config.get("max_message_display", 50)
+    page_size = max(1, int(ui_config.get("history_page_size", 20)))
     
     # 获取当前语言
     is_chinese = st.session_state.get("language", "zh") == "zh"
     
-    # 如果消息过多，只显示最近的max_messages条
-    display_messages = messages[-max_messages:] if len(messages) > max_messages else messages
+    # 每个对话已展开的页数，切换对话后各自保留
+    chat_id = st.session_state.get("current_chat_id")
+    history_pages = st.session_state.setdefault("_history_pages", {})
+    pages = history_pages.get(chat_id, 1)
+    
+    # 只显示最近 pages * page_size 条消息，渲染开销不随对话长度增长
+    start = max(0, len(messages) - pages * page_size)
+    if start > 0:
+        load_more_text = f"加载更早的消息（还有 {start} 条）" if is_chinese else f"Load earlier messages ({start} more)"
+        if st.button(load_more_text, key=f"load_more_{chat_id}_{pages}", use_container_width=True):
+            history_pages[chat_id] = pages + 1
+            st.rerun()
+    
+    # 模型切换记录按“第几条助手消息之后”索引
+    changes_by_index = _index_model_changes(model_changes)
+    # 窗口之前的助手消息数，用于计算窗口内助手消息的序号
+    assistant_index = sum(1 for msg in messages[:start] if msg["role"] == "assistant") if changes_by_index else 0
     
     # 简化的聊天历史显示，使用表情符号作为头像
     message_count = 0
-    for msg in display_messages:
+    for msg in messages[start:]:
         # 跳过系统消息
         if msg["role"] == "system":
             continue
             
-        # 直接显示消息内容
+        # 显示消息内容（长消息使用按内容哈希缓存的 HTML，避免每次重新运行都重新解析）
         with st.chat_message(msg["role"], avatar="👤" if msg["role"] == "user" else "🤖"):
-            st.markdown(msg["content"])
+            html = markdown_cache.render(msg["content"])
+            if html is None:
+                st.markdown(msg["content"])
+            else:
+                st.markdown(html, unsafe_allow_html=True)
         message_count += 1
         
-        # 在每条助手消息后检查是否有相关的模型切换记录
-        if msg["role"] == "assistant" and model_changes:
-            # 计算此消息的索引位置
-            current_index = message_count // 2  # 每对用户-助手消息算一组
-            
-            # 筛选出应该显示在这条消息后的所有模型切换记录
-            relevant_changes = [change for change in model_changes 
-                               if change.get("after_message_index", 0) == current_index]
-            
-            # 如果有相关的模型切换记录，显示它们
-            for change in relevant_changes:
-                # 获取当前语言
-                is_chinese = st.session_state.get("language", "zh") == "zh"
-                
-                # 显示轻量级的模型切换提示
-                model_change_text = f"模型已从 {change['from']} 切换为 {change['to']}" if is_chinese else f"Model changed from {change['from']} to {change['to']}"
-                
-                # 如果是自动切换的，显示不同的文本
-                if change.get("auto", False):
-                    model_change_text = f"系统自动将模型从 {change['from']} 切换为 {change['to']}，以更好地回答您的问题" if is_chinese else f"System automatically changed model from {change['from']} to {change['to']} to better answer your question"
-                
-                st.markdown(
-                    f"""<div style="text-align: center; padding: 5px; 
-                    color: rgba(255,255,255,0.5); font-size: 0.8rem; 
-                    margin: 10px 0; font-style: italic; border-top: 1px solid rgba(255,255,255,0.1);
-                    border-bottom: 1px solid rgba(255,255,255,0.1); padding: 8px 0;">
-                    {model_change_text}
-                    </div>""", 
-                    unsafe_allow_html=True
-                )
+        # 在每条助手消息后显示相关的模型切换记录
+        if msg["role"] == "assistant" and changes_by_index:
+            assistant_index += 1
+            for change in changes_by_index.get(assistant_index, ()):
+                _render_model_change(change, is_chinese)
     
     # 优化自动滚动：定位聊天区域的可滚动父容器、使用防抖/节流，并在用户主动滚动时暂停自动滚动，减少卡顿
     if message_count > 0:
@@ -208,16 +247,157 @@ def display_chat_history(messages, model_changes=None):
             unsafe_allow_html=True
         )
 
+def _request_priority(prompt, messages):
+    """短小的提问使用高优先级排队"""
+    if CONFIG.get("scheduler", {}).get("prioritize_short_prompts", True) and model_selector.is_short_prompt(prompt, messages):
+        return PRIORITY_HIGH
+    return PRIORITY_NORMAL
+
+def _scheduler_slot(model, prompt, messages, placeholder, is_chinese, cancel_token=None):
+    """获取模型的并发名额，排队期间在占位符中显示队列位置；生成被取消时退出排队"""
+    priority = _request_priority(prompt, messages)
+
+    def on_wait(position):
+        if cancel_token is not None:
+            cancel_token.raise_if_cancelled()
+        # 排队也算生成进行中，刷新 watchdog 避免被误判为卡住
+        st.session_state['_generating_watchdog_ts'] = time.time()
+        placeholder.markdown(
+            f"⏳ 排队中，前面还有 {position} 个请求..." if is_chinese else
+            f"⏳ Queued, {position} request(s) ahead of you..."
+        )
+
+    session_id = st.session_state.get("session_id", "default")
+    return request_scheduler.slot(model, session_id, priority=priority, on_wait=on_wait)
+
+def _submit_background_generation(prompt, messages, llm_client, settings, api_messages, meta):
+    """把流式生成提交到后台工作线程，返回生成任务"""
+    session_id = st.session_state.get("session_id", "default")
+    model = settings["model"]
+    temperature = settings["temperature"]
+    max_tokens = settings["max_tokens"]
+    priority = _request_priority(prompt, messages)
+
+    def work(job):
+        # 加入相同的进行中请求时不占用后端，不需要排队
+        joining = hasattr(llm_client, "has_inflight_stream") and llm_client.has_inflight_stream(
+            api_messages, model, temperature, max_tokens
+        )
+        slot = nullcontext() if joining else request_scheduler.slot(
+            model, session_id, priority=priority, on_wait=job.set_queue_position
+        )
+        with slot:
+            job.queue_position = None
+            for chunk in llm_client.generate_stream(
+                api_messages,
+                model=model,
+                temperature=temperature,
+                max_tokens=max_tokens,
+                cancel_token=job.cancel_token
+            ):
+                job.append(chunk)
+
+    return generation_manager.submit(session_id, st.session_state.current_chat_id, prompt, work, meta)
+
+def _complete_generation(job):
+    """后台生成结束：把回复写入对应对话的历史并清理生成状态（在脚本线程中调用）"""
+    generation_manager.discard(job.session_id, job)
+    is_chinese = st.session_state.get("language", "zh") == "zh"
+    reply = job.snapshot()
+    if job.error is not None:
+        if isinstance(job.error, AdmissionError):
+            notice = f"服务器繁忙，请稍后再试（{job.error}）" if is_chinese else f"Server is busy, please try again later ({job.error})"
+        else:
+            notice = f"流式生成出错: {job.error}"
+        st.session_state["_generation_notice"] = notice
+    if reply and job.status != STATUS_CANCELLED:
+        chat = st.session_state.chat_histories.get(job.chat_id)
+        if chat is None:
+            # 页面重新打开后原对话已不在本会话中，连同提问一起写入当前对话
+            chat = st.session_state.chat_histories[st.session_state.current_chat_id]
+            chat["messages"].append({"role": "user", "content": job.prompt})
+        chat["messages"].append({"role": "assistant", "content": reply})
+        meta = job.meta
+        if meta.get("cacheable") and job.error is None and not job.stream_failed:
+            response_cache.put(job.prompt, meta["model"], meta["temperature"], meta["system_prompt"], reply)
+        st.session_state['post_generate_cooldown_until'] = time.time() + float(meta.get("post_generate_cooldown_seconds", 2.0))
+    st.session_state.pop("_generation_view", None)
+    st.session_state['is_generating'] = False
+
+@st.fragment(run_every=generation_manager.poll_interval)
+def _generation_fragment(job_id):
+    """定期从后台任务的缓冲区读取新内容并渲染，任务结束后整页重新运行以显示完整历史"""
+    job = generation_manager.get(st.session_state.get("session_id", "default"))
+    if job is None or job.id != job_id:
+        st.rerun()
+    view = st.session_state.get("_generation_view")
+    if view is None or view["job_id"] != job.id:
+        # 渲染器跨多次运行保留，按 ui.stream_flush_* 的节奏刷新新内容
+        view = {"job_id": job.id, "cursor": 0, "renderer": StreamRenderer(None, cursor="▌")}
+    delta, view["cursor"], full = job.read(view["cursor"])
+    st.session_state["_generation_view"] = view
+
+    is_chinese = st.session_state.get("language", "zh") == "zh"
+    renderer = view["renderer"]
+    with st.chat_message("assistant", avatar="🤖"):
+        renderer.attach(st.empty())
+        if full:
+            renderer.reset()
+        renders = renderer.renders
+        renderer.append(delta)
+        renderer.flush_pending()
+        if renderer.renders == renders:
+            # 未达到刷新条件：保持上次显示的内容
+            renderer.refresh()
+        if not renderer.renders:
+            if job.queue_position:
+                renderer.placeholder.markdown(
+                    f"⏳ 排队中，前面还有 {job.queue_position} 个请求..." if is_chinese else
+                    f"⏳ Queued, {job.queue_position} request(s) ahead of you..."
+                )
+            else:
+                renderer.placeholder.markdown("💭 思考中..." if is_chinese else "💭 Thinking...")
+
+    if job.finished:
+        _complete_generation(job)
+        st.rerun()
+
+def render_active_generation():
+    """显示当前会话进行中的后台生成；页面重新运行或重新打开后从缓冲区继续显示"""
+    notice = st.session_state.pop("_generation_notice", None)
+    if notice:
+        st.warning(notice)
+    job = generation_manager.get(st.session_state.get("session_id", "default"))
+    if job is None:
+        return
+    if job.finished:
+        _complete_generation(job)
+        st.rerun()
+    _generation_fragment(job.id)
+
 def handle_user_input(prompt, messages, llm_client, settings):
     """处理用户输入并获取AI回复"""
-    # 并发保护：如果当前已有生成进行中，先检查 watchdog 以避免挂起状态长期阻塞
+    # 并发保护：当前会话已有后台生成进行中时不接受新的提问（长时间没有进展的任务视为卡住并取消）
     now = time.time()
+    session_id = st.session_state.get("session_id", "default")
+    active_job = generation_manager.get(session_id)
+    if active_job is not None and not active_job.finished:
+        watchdog_timeout = float(CONFIG.get('conversation', {}).get('generating_watchdog_timeout', 30.0))
+        if active_job.status == STATUS_RUNNING and now - active_job.last_activity > watchdog_timeout:
+            generation_manager.cancel(session_id, "生成超时（watchdog）")
+        else:
+            is_chinese = st.session_state.get('language', 'zh') == 'zh'
+            st.warning("正在生成，请稍候再试..." if is_chinese else "AI is still responding, please wait...")
+            return
+
+    # 同步生成（文档问答等）的并发保护：检查 watchdog 以避免挂起状态长期阻塞
     if st.session_state.get('is_generating', False):
         # watchdog 时间阈值（秒），超时后认为之前的生成已卡住并清理
         watchdog_timeout = float(CONFIG.get('conversation', {}).get('generating_watchdog_timeout', 30.0))
         wd_ts = st.session_state.get('_generating_watchdog_ts', None)
         if wd_ts and (now - wd_ts) > watchdog_timeout:
-            # 清理挂起状态，让新的请求可以继续
+            # 取消卡住的生成（关闭上游连接并归还调度名额），再清理挂起状态，让新的请求可以继续
+            llm_client.cancel(st.session_state.get("session_id", "default"), "生成超时（watchdog）")
             try:
                 st.session_state['is_generating'] = False
                 if '_generating_watchdog_ts' in st.session_state:
@@ -270,16 +450,22 @@ def handle_user_input(prompt, messages, llm_client, settings):
     if settings.get("emotion_detection", False):
         emotion = emotion_detector.detect_emotion(prompt)
     
-    # 如果检测到情感，增强系统提示词
+    # 本轮的临时提示：追加在最后一条用户消息中，不改动系统提示词，保持请求前缀稳定
+    turn_hints = []
+    # 临时提示对应的稳定标签（情感类别、简洁要求），用于划分响应缓存的作用域；
+    # 情感回应的文字是随机选择的，不能用来做缓存键
+    cache_variants = []
+    
+    # 如果检测到情感，加入情感回应提示
     emotional_response = ""
     if emotion:
         emotional_response = emotion_detector.get_emotional_response(emotion)
         if emotional_response and len(emotional_response) > 0:
-            # 将情感回应添加到系统提示词
             if is_chinese:
-                system_prompt = system_prompt + f"\n\n用户情绪似乎是{emotion}。在回复的开头加上以下情感回应：\n{emotional_response}"
+                turn_hints.append(f"用户情绪似乎是{emotion}。在回复的开头加上以下情感回应：{emotional_response}")
             else:
-                system_prompt = system_prompt + f"\n\nThe user's emotion seems to be {emotion}. Start your response with this emotional acknowledgement:\n{emotional_response}"
+                turn_hints.append(f"The user's emotion seems to be {emotion}. Start your response with this emotional acknowledgement: {emotional_response}")
+            cache_variants.append(f"emotion={emotion}")
     
     # 强制发送冷却：防止用户过快连续提交（如果配置了冷却）
     cooldown = float(settings.get("cooldown_seconds", CONFIG.get("conversation", {}).get("cooldown_seconds", 1.0)))
@@ -294,18 +480,14 @@ def handle_user_input(prompt, messages, llm_client, settings):
     # 更新最后发送时间戳
     st.session_state["_last_send_ts"] = now
 
-    # 构造请求数据 - 使用侧边栏配置的上下文长度
-    max_history = int(settings.get("max_history_messages", CONFIG.get("conversation", {}).get("max_history_messages", 10)))
-    api_messages = [{"role": "system", "content": system_prompt}]
-    api_messages += messages[-max_history:]
-    
-    # 如果开启了默认简洁回答选项并且未自定义系统提示，则在system_prompt中加入简洁约束
+    # 如果开启了默认简洁回答选项并且系统提示词中没有简洁要求，则在本轮提示中加入简洁约束
     concise_default = bool(settings.get("concise_by_default", CONFIG.get("conversation", {}).get("concise_by_default", True)))
     if concise_default and "简洁" not in system_prompt and "concise" not in system_prompt[:50]:
         if is_chinese:
-            system_prompt = system_prompt + "\n\n请尽量回答简洁（1-3句），必要时给出要点。"
+            turn_hints.append("请尽量回答简洁（1-3句），必要时给出要点。")
         else:
-            system_prompt = system_prompt + "\n\nPlease keep answers concise (1-3 sentences) and provide key points when necessary."
+            turn_hints.append("Please keep answers concise (1-3 sentences) and provide key points when necessary.")
+        cache_variants.append("concise")
 
     # 检查是否启用自动模型选择
     if settings.get("auto_model_select", False):
@@ -338,6 +520,28 @@ def handle_user_input(prompt, messages, llm_client, settings):
             # 更新会话状态中的模型
             st.session_state.model_choice = recommended_model
     
+    # 构造请求数据 - 按模型的上下文长度和本次的最大生成长度打包历史消息；
+    # 已折叠进摘要的早期消息用摘要代替
+    max_history = int(settings.get("max_history_messages", CONFIG.get("conversation", {}).get("max_history_messages", 0)))
+    chat_id = st.session_state.current_chat_id
+    chat = st.session_state.chat_histories[chat_id]
+    summary = conversation_summarizer.active_summary(chat)
+    # max_tokens 与提示词预算之和不能超过模型的上下文长度
+    settings["max_tokens"] = context_packer.output_tokens_for(settings["model"], settings["max_tokens"])
+    api_messages = context_packer.pack(
+        system_prompt,
+        conversation_summarizer.unsummarized(chat),
+        settings["model"],
+        settings["max_tokens"],
+        max_history,
+        summary_message(summary["text"]) if summary else None
+    )
+    api_messages = apply_turn_hints(api_messages, turn_hints, is_chinese)
+    # 未摘要的历史过长时在后台更新摘要（不阻塞本次请求）
+    conversation_summarizer.maybe_schedule(
+        chat_id, chat, llm_client, context_packer.budget_for(settings["model"], settings["max_tokens"])
+    )
+
     # 检查是否启用了文档增强回复功能
     document_enabled = st.session_state.get("document_enabled", False)
     document_text = st.session_state.get("document_text", "")
@@ -352,13 +556,16 @@ def handle_user_input(prompt, messages, llm_client, settings):
                     "I'm using the document content to answer your question..."
                 )
 
-                with st.spinner(doc_info):
-                    # 使用文档处理器生成基于文档的回复（同步）
-                    reply = document_processor.generate_document_enhanced_response(
-                        prompt, 
-                        document_text, 
-                        settings["model"]
-                    )
+                queue_placeholder = st.empty()
+                with _scheduler_slot(settings["model"], prompt, messages, queue_placeholder, is_chinese):
+                    queue_placeholder.empty()
+                    with st.spinner(doc_info):
+                        # 使用文档处理器生成基于文档的回复（同步）
+                        reply = document_processor.generate_document_enhanced_response(
+                            prompt, 
+                            document_text, 
+                            settings["model"]
+                        )
 
                     # 显示回复
                     st.markdown(reply)
@@ -372,6 +579,8 @@ def handle_user_input(prompt, messages, llm_client, settings):
                     st.session_state['post_generate_cooldown_until'] = time.time() + post_cd
                 except Exception:
                     pass
+        except AdmissionError as e:
+            st.warning(f"服务器繁忙，请稍后再试（{e}）" if is_chinese else f"Server is busy, please try again later ({e})")
         finally:
             # 生成结束，恢复输入
             st.session_state['is_generating'] = False
@@ -379,62 +588,119 @@ def handle_user_input(prompt, messages, llm_client, settings):
         # 在文档回复模式下不需要调用普通API
         return
     
-    # 使用流式输出API - 以增量形式渲染回复
+    # 响应缓存：独立提问命中缓存（精确或语义相近）时直接显示缓存的回复，不再请求后端
+    cache_system_prompt = "\n\n".join([system_prompt] + cache_variants)
+    cacheable = response_cache.enabled and (
+        not response_cache.standalone_only or not any(m["role"] == "assistant" for m in messages)
+    )
+    if cacheable:
+        cached_reply = response_cache.get(prompt, settings["model"], settings["temperature"], cache_system_prompt)
+        if cached_reply:
+            with st.chat_message("assistant", avatar="🤖"):
+                st.markdown(cached_reply)
+            messages.append({"role": "assistant", "content": cached_reply})
+            try:
+                post_cd = float(settings.get("post_generate_cooldown_seconds", CONFIG.get("conversation", {}).get("post_generate_cooldown_seconds", 2.0)))
+                st.session_state['post_generate_cooldown_until'] = time.time() + post_cd
+            except Exception:
+                pass
+            st.session_state['is_generating'] = False
+            st.session_state.pop('_generating_watchdog_ts', None)
+            return
+
+    # 统计与上一次请求相同的前缀长度（后端可复用的 KV 缓存）
+    prefix_tracker.observe(chat_id, api_messages)
+
+    # 后台生成：生成在工作线程中进行，页面重新运行不会中断，界面只轮询缓冲区渲染
+    if generation_manager.enabled and hasattr(llm_client, "generate_stream"):
+        st.session_state.pop('_generating_watchdog_ts', None)
+        _submit_background_generation(prompt, messages, llm_client, settings, api_messages, {
+            "cacheable": cacheable,
+            "model": settings["model"],
+            "temperature": settings["temperature"],
+            "system_prompt": cache_system_prompt,
+            "post_generate_cooldown_seconds": settings.get("post_generate_cooldown_seconds", CONFIG.get("conversation", {}).get("post_generate_cooldown_seconds", 2.0))
+        })
+        render_active_generation()
+        return
+
+    # 使用流式输出API - 以增量形式渲染回复（未启用后台生成时在脚本线程中同步生成）
+    # 取消令牌：页面重新运行、切换对话或 watchdog 触发时中断本次生成
+    cancel_token = llm_client.create_cancel_token(session_id)
+    stream_generator = None
     try:
         with st.chat_message("assistant", avatar="🤖"):
             placeholder = st.empty()
             accumulated = ""
+            # 生成过程中是否出现了错误提示（出错的回复不写入缓存）
+            stream_failed = False
 
-            # 选择流式生成器接口（如果可用）
-            stream_generator = None
-            # 优先使用显式的 generate_stream 方法（返回生成器）
-            if hasattr(llm_client, 'generate_stream'):
-                stream_generator = llm_client.generate_stream(
-                    api_messages,
-                    model=settings["model"],
-                    temperature=settings["temperature"],
-                    max_tokens=settings["max_tokens"]
-                )
-            else:
-                # 否则尝试使用 generate_response 返回的可迭代对象
-                result = llm_client.generate_response(
-                    api_messages,
-                    settings["model"],
-                    temperature=settings["temperature"],
-                    max_tokens=settings["max_tokens"],
-                    stream=True
-                )
-                # 如果返回 (reply, error) 的形式，尝试取第一个可迭代对象
-                if isinstance(result, tuple) and len(result) == 2:
-                    stream_generator = result[0]
+            # 获取模型并发名额（排队时显示队列位置），生成器在名额内被完整消费；
+            # 加入相同的进行中请求时不占用后端，不需要排队
+            joining = hasattr(llm_client, "has_inflight_stream") and llm_client.has_inflight_stream(
+                api_messages, settings["model"], settings["temperature"], settings["max_tokens"]
+            )
+            slot = nullcontext() if joining else _scheduler_slot(settings["model"], prompt, messages, placeholder, is_chinese, cancel_token)
+            with slot:
+                # 清除排队提示
+                placeholder.empty()
+                # 选择流式生成器接口（如果可用）
+                stream_generator = None
+                # 优先使用显式的 generate_stream 方法（返回生成器）
+                if hasattr(llm_client, 'generate_stream'):
+                    stream_generator = llm_client.generate_stream(
+                        api_messages,
+                        model=settings["model"],
+                        temperature=settings["temperature"],
+                        max_tokens=settings["max_tokens"],
+                        cancel_token=cancel_token
+                    )
                 else:
-                    stream_generator = result
+                    # 否则尝试使用 generate_response 返回的可迭代对象
+                    result = llm_client.generate_response(
+                        api_messages,
+                        settings["model"],
+                        temperature=settings["temperature"],
+                        max_tokens=settings["max_tokens"],
+                        stream=True
+                    )
+                    # 如果返回 (reply, error) 的形式，尝试取第一个可迭代对象
+                    if isinstance(result, tuple) and len(result) == 2:
+                        stream_generator = result[0]
+                    else:
+                        stream_generator = result
 
-            # 如果stream_generator是字符串（非迭代器），直接显示
-            if isinstance(stream_generator, str):
-                accumulated = stream_generator
-                placeholder.markdown(accumulated)
-            else:
-                # 迭代生成块，增量更新UI
-                try:
-                    for chunk in stream_generator:
-                        # 有些实现可能yield None或空字符串，跳过
-                        if not chunk:
-                            continue
-                        accumulated += chunk
-                        placeholder.markdown(accumulated)
-                        # 每收到一次 chunk 刷新 watchdog 时间戳，表示还在进行中
-                        try:
-                            st.session_state['_generating_watchdog_ts'] = _time.time()
-                        except Exception:
-                            pass
-                except TypeError:
-                    # 非可迭代返回，尝试直接显示其字符串表示
-                    placeholder.markdown(str(stream_generator))
-
-        # 将完整响应记录到历史（如果有内容）
-        if accumulated:
+                # 如果stream_generator是字符串（非迭代器），直接显示
+                if isinstance(stream_generator, str):
+                    accumulated = stream_generator
+                    placeholder.markdown(accumulated)
+                else:
+                    # 迭代生成块，按时间/字符预算合并后增量更新UI
+                    renderer = StreamRenderer(placeholder)
+                    try:
+                        for chunk in stream_generator:
+                            # 有些实现可能yield None或空字符串，跳过
+                            if not chunk:
+                                continue
+                            if isinstance(chunk, StreamError):
+                                stream_failed = True
+                            accumulated += chunk
+                            renderer.append(chunk)
+                            # 每收到一次 chunk 刷新 watchdog 时间戳，表示还在进行中
+                            try:
+                                st.session_state['_generating_watchdog_ts'] = _time.time()
+                            except Exception:
+                                pass
+                        renderer.finish()
+                    except TypeError:
+                        # 非可迭代返回，尝试直接显示其字符串表示
+                        placeholder.markdown(str(stream_generator))
+
+        # 将完整响应记录到历史（如果有内容；已取消的生成不再写入）
+        if accumulated and not cancel_token.cancelled:
             messages.append({"role": "assistant", "content": accumulated})
+            if cacheable and not stream_failed and not isinstance(stream_generator, str):
+                response_cache.put(prompt, settings["model"], settings["temperature"], cache_system_prompt, accumulated)
             # 记录生成后冷却，前端会依据该时间提示用户等待
             try:
                 post_cd = float(settings.get("post_generate_cooldown_seconds", CONFIG.get("conversation", {}).get("post_generate_cooldown_seconds", 2.0)))
@@ -447,6 +713,13 @@ def handle_user_input(prompt, messages, llm_client, settings):
         except Exception:
             pass
 
+    except AdmissionError as e:
+        st.warning(f"服务器繁忙，请稍后再试（{e}）" if is_chinese else f"Server is busy, please try again later ({e})")
+
+    except CancelledError:
+        # 排队期间被取消，直接结束
+        pass
+
     except Exception as e:
         error_msg = f"流式生成出错: {e}"
         st.error(error_msg)
@@ -457,6 +730,10 @@ def handle_user_input(prompt, messages, llm_client, settings):
             pass
 
     finally:
+        # 提前结束时（页面重新运行等）显式关闭生成器，使其立即关闭上游连接
+        if hasattr(stream_generator, "close"):
+            stream_generator.close()
+        llm_client.release_cancel_token(session_id, cancel_token)
         # 生成结束，恢复输入（再做一次保险性清理）
         try:
             st.session_state['is_generating'] = False
@@ -1,13 +1,39 @@
 import streamlit as st
 import uuid
 import datetime
+import time
 import os
 import sys
 from utils.document_processor import document_processor
 from utils.config import CONFIG
 from utils.domain_experts import DomainExperts
+from utils.generation_worker import generation_manager
+from utils.history_store import chat_summaries, search_chats, question_preview
 from components.upload import sidebar_upload_ui
 
+def _question_previews(chat_id, messages):
+    """返回对话中用户问题的预览列表（按对话缓存，只处理上次之后新增的消息）"""
+    cache = st.session_state.setdefault("_question_previews", {})
+    count, previews = cache.get(chat_id, (0, []))
+    if count > len(messages):
+        count, previews = 0, []
+    for msg in messages[count:]:
+        if msg["role"] == "user":
+            previews.append(question_preview(msg["content"]))
+    cache[chat_id] = (len(messages), previews)
+    return previews
+
+def _cancel_active_generation(reason):
+    """切换或新建对话时取消当前会话进行中的生成"""
+    session_id = st.session_state.get("session_id", "default")
+    job = generation_manager.cancel(session_id, reason)
+    if job is not None:
+        generation_manager.discard(session_id, job)
+    llm_client = st.session_state.get("llm_client")
+    if llm_client is not None and hasattr(llm_client, "cancel"):
+        llm_client.cancel(session_id, reason)
+    st.session_state['is_generating'] = False
+
 def render_sidebar(current_chat):
     """渲染侧边栏设置和聊天历史"""
     # 获取URL参数中的语言设置
@@ -41,6 +67,7 @@ def render_sidebar(current_chat):
         # ===== 新建聊天按钮 =====
         new_chat_text = "➕ 新建聊天" if is_chinese else "➕ New Chat"
         if st.button(new_chat_text, type="primary", use_container_width=True):
+            _cancel_active_generation("新建对话")
             # 创建新的聊天会话
             new_chat_id = str(uuid.uuid4())
             st.session_state.current_chat_id = new_chat_id
@@ -55,53 +82,88 @@ def render_sidebar(current_chat):
             }
             st.rerun()
         
+        # ===== 全文搜索聊天记录 =====
+        search_placeholder = "🔍 搜索聊天记录" if is_chinese else "🔍 Search chats"
+        search_query = st.text_input(
+            search_placeholder, key="history_search_query", label_visibility="collapsed", placeholder=search_placeholder
+        )
+        if search_query.strip():
+            started = time.time()
+            hits = search_chats(st.session_state.chat_histories, search_query, limit=20)
+            elapsed_ms = (time.time() - started) * 1000
+            if is_chinese:
+                st.caption(f"找到 {len(hits)} 条结果（{elapsed_ms:.0f} 毫秒）")
+            else:
+                st.caption(f"{len(hits)} results ({elapsed_ms:.0f} ms)")
+            for rank, hit in enumerate(hits):
+                role_icon = "👤" if hit["role"] == "user" else "🤖"
+                st.markdown(f"**{hit['title']}**  \n{role_icon} {hit['snippet']}")
+                if hit["chat_id"] != st.session_state.current_chat_id:
+                    if st.button("打开" if is_chinese else "Open", key=f"search_open_{rank}_{hit['chat_id']}"):
+                        _cancel_active_generation("切换对话")
+                        st.session_state.current_chat_id = hit["chat_id"]
+                        st.rerun()
+            st.divider()
+        
         # 聊天历史列表 - 移除标题
-        # 按创建时间倒序排列聊天历史
-        sorted_chats = sorted(
-            st.session_state.chat_histories.items(),
-            key=lambda x: x[1].get("created_at", datetime.datetime.now()),
-            reverse=True
+        # 按创建时间倒序只取最近的若干个对话（只读取对话摘要，其它对话的消息在切换后才加载）
+        page_size = max(1, int(CONFIG["ui"].get("sidebar_chat_page_size", 20)))
+        chat_limit = st.session_state.setdefault("_sidebar_chat_limit", page_size)
+        sorted_chats = chat_summaries(
+            st.session_state.chat_histories, limit=chat_limit + 1, max_previews=int(CONFIG.get("history", {}).get("max_previews", 5))
         )
+        has_more_chats = len(sorted_chats) > chat_limit
+        sorted_chats = sorted_chats[:chat_limit]
+        
+        # 当前对话不在列表中（如从搜索结果打开的较早对话）时放在最前面
+        current_chat_id = st.session_state.current_chat_id
+        if all(summary["id"] != current_chat_id for summary in sorted_chats):
+            sorted_chats.insert(0, {"id": current_chat_id, "title": current_chat.get("title", "")})
         
         # 显示聊天历史列表
-        for chat_id, chat in sorted_chats:
-            # 获取聊天标题 - 如果是默认标题，则使用第一条用户消息作为标题
-            title = chat.get("title", "新对话" if is_chinese else "New Chat")
-            if (title == "新对话" or title == "New Chat") and chat["messages"]:
-                for msg in chat["messages"]:
-                    if msg["role"] == "user":
-                        # 使用第一条用户消息作为标题
-                        title = msg["content"][:15] + ("..." if len(msg["content"]) > 15 else "")
-                        break
+        for summary in sorted_chats:
+            chat_id = summary["id"]
+            title = summary.get("title") or ("新对话" if is_chinese else "New Chat")
             
             # 如果是当前聊天，高亮显示
-            if chat_id == st.session_state.current_chat_id:
+            if chat_id == current_chat_id:
+                questions = _question_previews(chat_id, current_chat["messages"])
+                # 如果是默认标题，则使用第一条用户消息作为标题
+                if (title == "新对话" or title == "New Chat") and questions:
+                    title = questions[0]["title"]
                 st.markdown(f"**🔹 {title}**")
                 
                 # 显示当前聊天的所有用户问题
-                if chat["messages"]:
+                if questions:
                     messages_label = "聊天记录" if is_chinese else "Chat History"
                     with st.expander(messages_label, expanded=True):
-                        for i, msg in enumerate(chat["messages"]):
-                            if msg["role"] == "user":
-                                # 截取前30个字符，如果超过则添加省略号
-                                question = msg["content"][:30] + ("..." if len(msg["content"]) > 30 else "")
-                                st.markdown(f"- {question}")
+                        for question in questions:
+                            st.markdown(f"- {question['preview']}")
             else:
+                # 标题和问题预览来自对话摘要，不加载消息
+                previews = summary.get("previews") or []
+                if (title == "新对话" or title == "New Chat") and previews:
+                    title = previews[0]["title"]
                 # 创建一个可折叠的聊天历史项
                 with st.expander(f"🔸 {title}", expanded=False):
-                    # 显示该聊天的所有用户问题
-                    if chat["messages"]:
-                        for i, msg in enumerate(chat["messages"]):
-                            if msg["role"] == "user":
-                                # 截取前30个字符，如果超过则添加省略号
-                                question = msg["content"][:30] + ("..." if len(msg["content"]) > 30 else "")
-                                st.markdown(f"- {question}")
+                    for question in previews:
+                        st.markdown(f"- {question['preview']}")
+                    # 消息数量同样来自摘要
+                    count = summary.get("message_count", 0)
+                    st.caption(f"{count} 条消息" if is_chinese else f"{count} messages")
                     
                     # 添加切换按钮
                     if st.button("切换", key=f"switch_{chat_id}"):
+                        _cancel_active_generation("切换对话")
                         st.session_state.current_chat_id = chat_id
         
+        # 加载更早的对话
+        if has_more_chats:
+            load_more_text = "加载更多对话" if is_chinese else "Load more chats"
+            if st.button(load_more_text, key=f"load_more_chats_{chat_limit}", use_container_width=True):
+                st.session_state["_sidebar_chat_limit"] = chat_limit + page_size
+                st.rerun()
+        
         # 分隔线
         st.divider()
         
@@ -378,7 +440,7 @@ def render_sidebar(current_chat):
         
         # 会话相关设置使用配置文件中的默认值（不在UI中显示）
         conversation_cfg = CONFIG.get("conversation", {})
-        max_history = int(conversation_cfg.get("max_history_messages", 10))
+        max_history = int(conversation_cfg.get("max_history_messages", 0))
         cooldown = float(conversation_cfg.get("cooldown_seconds", 1.0))
         concise = bool(conversation_cfg.get("concise_by_default", True))
 
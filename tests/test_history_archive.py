@@ -0,0 +1,83 @@
+import io
+
+import pytest
+
+from utils.history_archive import ArchiveError, export_archive, import_archive
+from utils.history_store import ChatHistories, HistoryStore
+
+
+def _store(tmp_path, name):
+    return HistoryStore(str(tmp_path / name), flush_interval=0.01)
+
+
+def _add_chat(store, owner, chat_id, contents):
+    chats = ChatHistories(store, owner)
+    chats[chat_id] = {"title": chat_id, "messages": []}
+    for i, content in enumerate(contents):
+        chats[chat_id]["messages"].append({"role": "user" if i % 2 == 0 else "assistant", "content": content})
+    store.flush()
+
+
+def _state(store, owner):
+    """返回所有者的全部对话内容和索引行数，用于比较导入结果"""
+    conn = store._connect()
+    chats = {}
+    for summary in store.list_chats(owner):
+        chat = store.load_chat(owner, summary["id"])
+        chats[summary["id"]] = (summary["message_count"], [m["content"] for m in chat["messages"]])
+    postings = conn.execute("SELECT COUNT(*) FROM postings").fetchone()[0]
+    return chats, postings
+
+
+def _archive(store, owner):
+    return b"".join(export_archive(store, owner, batch_size=3))
+
+
+@pytest.fixture
+def archive(tmp_path):
+    source = _store(tmp_path, "source.db")
+    _add_chat(source, "alice", "c1", [f"问题 {i} hello" for i in range(7)])
+    _add_chat(source, "alice", "c2", ["only question"])
+    return _archive(source, "alice")
+
+
+def test_importing_twice_is_idempotent(tmp_path, archive):
+    target = _store(tmp_path, "target.db")
+    assert import_archive(target, "bob", io.BytesIO(archive), batch_size=2) == (2, 8)
+    first = _state(target, "bob")
+    import_archive(target, "bob", io.BytesIO(archive), batch_size=2)
+    assert _state(target, "bob") == first
+    assert first[0]["c1"] == (7, [f"问题 {i} hello" for i in range(7)])
+
+
+def test_import_replaces_longer_existing_chat(tmp_path, archive):
+    target = _store(tmp_path, "target.db")
+    reference = _store(tmp_path, "reference.db")
+    import_archive(reference, "bob", io.BytesIO(archive))
+
+    _add_chat(target, "bob", "c1", [f"old message {i}" for i in range(12)])
+    import_archive(target, "bob", io.BytesIO(archive))
+    assert _state(target, "bob") == _state(reference, "bob")
+    assert target.search("bob", "old") == []
+
+
+def test_retry_after_failed_import_has_no_duplicates(tmp_path, archive):
+    target = _store(tmp_path, "target.db")
+    reference = _store(tmp_path, "reference.db")
+    import_archive(reference, "bob", io.BytesIO(archive))
+
+    with pytest.raises(ArchiveError):
+        import_archive(target, "bob", io.BytesIO(archive[:-5]), batch_size=1)
+    import_archive(target, "bob", io.BytesIO(archive), batch_size=1)
+    assert _state(target, "bob") == _state(reference, "bob")
+
+
+def test_chat_id_owned_by_another_user_is_remapped_stably(tmp_path, archive):
+    target = _store(tmp_path, "target.db")
+    _add_chat(target, "carol", "c1", ["carol's chat"])
+    import_archive(target, "bob", io.BytesIO(archive))
+    import_archive(target, "bob", io.BytesIO(archive))
+
+    assert _state(target, "carol")[0] == {"c1": (1, ["carol's chat"])}
+    bob_chats = _state(target, "bob")[0]
+    assert len(bob_chats) == 2 and "c1" not in bob_chats
@@ -0,0 +1,133 @@
+import os
+import stat
+from types import SimpleNamespace
+
+import pytest
+
+import utils.identity as identity_module
+from utils.history_store import ChatHistories, HistoryStore
+from utils.identity import ANONYMOUS_PREFIX, IdentityManager, load_secret
+
+
+@pytest.fixture(autouse=True)
+def no_env_secret(monkeypatch):
+    monkeypatch.delenv("SMARTCHAT_SECRET", raising=False)
+
+
+@pytest.fixture
+def manager():
+    return IdentityManager({"secret": "test-secret"})
+
+
+def _fake_streamlit(monkeypatch, cookies):
+    monkeypatch.setattr(identity_module, "st", SimpleNamespace(
+        experimental_user=None, context=SimpleNamespace(cookies=cookies, headers={})
+    ))
+
+
+def test_sign_verify_round_trip(manager):
+    token = manager.sign("anon:abc")
+    assert manager.verify(token) == "anon:abc"
+
+
+@pytest.mark.parametrize("token", [None, "", "garbage", "anon:abc", "anon:abc.", ".deadbeef"])
+def test_verify_rejects_malformed_tokens(manager, token):
+    assert manager.verify(token) is None
+
+
+def test_verify_rejects_tampered_value_and_mac(manager):
+    token = manager.sign("anon:abc")
+    value, _, mac = token.rpartition(".")
+    # 换成另一个所有者但沿用原签名
+    assert manager.verify(f"anon:evil.{mac}") is None
+    # 修改签名
+    assert manager.verify(f"{value}.{'0' * len(mac)}") is None
+    # 把别的值的签名拼到目标所有者上
+    other_mac = manager.sign("anon:other").rpartition(".")[2]
+    assert manager.verify(f"{value}.{other_mac}") is None
+
+
+def test_token_from_other_secret_rejected(manager):
+    token = IdentityManager({"secret": "another-secret"}).sign("anon:abc")
+    assert manager.verify(token) is None
+
+
+def test_current_owner_accepts_signed_cookie(manager, monkeypatch):
+    _fake_streamlit(monkeypatch, {manager.cookie_name: manager.sign("anon:abc")})
+    assert manager.current_owner() == ("anon:abc", None)
+
+
+def test_current_owner_replaces_tampered_cookie(manager, monkeypatch):
+    mac = manager.sign("anon:abc").rpartition(".")[2]
+    _fake_streamlit(monkeypatch, {manager.cookie_name: f"anon:victim.{mac}"})
+    owner, token = manager.current_owner()
+    assert owner != "anon:victim" and owner.startswith(ANONYMOUS_PREFIX)
+    assert manager.verify(token) == owner
+
+
+def test_current_owner_rejects_signed_non_anonymous_cookie(manager, monkeypatch):
+    # 只有登录才能得到 user: 所有者，Cookie 里的不接受
+    _fake_streamlit(monkeypatch, {manager.cookie_name: manager.sign("user:alice@example.com")})
+    owner, token = manager.current_owner()
+    assert owner.startswith(ANONYMOUS_PREFIX) and token is not None
+
+
+def test_session_id_bound_to_owner(manager):
+    sid = manager.session_id_for("anon:alice")
+    assert manager.session_id_for("anon:alice", sid) == sid
+    # 别的所有者拿到链接时得到新的会话标识
+    assert manager.session_id_for("anon:bob", sid) != sid
+
+
+@pytest.mark.parametrize("requested", [None, "", "garbage", "abc.", "abc.0123"])
+def test_session_id_rejects_invalid(manager, requested):
+    sid = manager.session_id_for("anon:alice", requested)
+    assert sid != requested
+    assert manager.session_id_for("anon:alice", sid) == sid
+
+
+def test_secret_file_created_private_and_reused(tmp_path):
+    path = tmp_path / "data" / "identity_secret"
+    secret = load_secret({"secret_path": str(path)})
+    assert path.read_bytes() == secret
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o600
+    assert load_secret({"secret_path": str(path)}) == secret
+
+
+def test_env_secret_takes_precedence(tmp_path, monkeypatch):
+    monkeypatch.setenv("SMARTCHAT_SECRET", "from-env")
+    path = tmp_path / "identity_secret"
+    assert load_secret({"secret": "from-config", "secret_path": str(path)}) == b"from-env"
+    assert not path.exists()
+
+
+def _add_chat(store, owner, chat_id, contents):
+    chats = ChatHistories(store, owner)
+    chats[chat_id] = {"title": chat_id, "messages": []}
+    for content in contents:
+        chats[chat_id]["messages"].append({"role": "user", "content": content})
+    store.flush()
+
+
+def test_search_isolated_between_owners(tmp_path):
+    store = HistoryStore(str(tmp_path / "history.db"), flush_interval=0.01)
+    _add_chat(store, "anon:alice", "alice-chat", ["shared keyword from alice"])
+    _add_chat(store, "anon:bob", "bob-chat", ["shared keyword from bob", "bob secret note"])
+
+    alice = store.search("anon:alice", "keyword")
+    assert [r["chat_id"] for r in alice] == ["alice-chat"]
+    assert store.search("anon:alice", "secret") == []
+    assert [r["chat_id"] for r in store.search("anon:bob", "keyword")] == ["bob-chat"]
+
+
+def test_search_scores_ignore_other_owners(tmp_path):
+    alone = HistoryStore(str(tmp_path / "alone.db"), flush_interval=0.01)
+    _add_chat(alone, "anon:alice", "alice-chat", ["keyword here", "something else"])
+
+    shared = HistoryStore(str(tmp_path / "shared.db"), flush_interval=0.01)
+    _add_chat(shared, "anon:alice", "alice-chat", ["keyword here", "something else"])
+    _add_chat(shared, "anon:bob", "bob-chat", ["keyword"] * 20 + ["filler"] * 50)
+
+    # 其他用户的消息数量和词频不影响得分，无法从得分推断别人的数据
+    expected = alone.search("anon:alice", "keyword")[0]["score"]
+    assert shared.search("anon:alice", "keyword")[0]["score"] == pytest.approx(expected)
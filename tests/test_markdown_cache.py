@@ -0,0 +1,64 @@
+import pytest
+
+pytest.importorskip("markdown_it")
+pytest.importorskip("linkify_it")
+
+from utils.markdown_cache import MarkdownCache
+
+
+@pytest.fixture
+def cache():
+    return MarkdownCache({"min_length": 0})
+
+
+def test_list_after_paragraph(cache):
+    html = cache.render("Here are steps:\n1. first\n2. second")
+    assert "<p>Here are steps:</p>" in html
+    assert "<ol>" in html and "<li>first</li>" in html and "<li>second</li>" in html
+
+
+def test_nested_list_with_two_space_indent(cache):
+    html = cache.render("- a\n  - b\n  - c\n- d")
+    assert html.count("<ul>") == 2
+    assert "<li>b</li>" in html and "<li>d</li>" in html
+
+
+def test_strikethrough(cache):
+    assert "<s>strike</s>" in cache.render("~~strike~~ text")
+
+
+def test_autolinks(cache):
+    html = cache.render("see https://example.com and www.example.org")
+    assert '<a href="https://example.com">' in html
+    assert '<a href="http://www.example.org">' in html
+
+
+def test_tables(cache):
+    html = cache.render("| a | b |\n|---|---|\n| 1 | 2 |")
+    assert "<table>" in html and "<td>2</td>" in html
+
+
+def test_raw_html_is_escaped(cache):
+    html = cache.render("<script>alert(1)</script> <b>x</b>")
+    assert "<script>" not in html and "&lt;script&gt;" in html
+    assert "<b>" not in html
+
+
+def test_unsafe_urls_are_dropped(cache):
+    html = cache.render("[a](javascript:alert(1)) [b](ftp://host/x) [c](https://ok.example)")
+    assert 'href="javascript:' not in html
+    assert 'href="ftp:' not in html
+    assert 'href="https://ok.example"' in html
+
+
+def test_math_and_short_messages_are_not_converted():
+    cache = MarkdownCache({"min_length": 50})
+    assert cache.render("short") is None
+    assert cache.render("x" * 60 + " $a^2$") is None
+
+
+def test_cache_hit():
+    cache = MarkdownCache({"min_length": 0})
+    first = cache.render("**bold** text")
+    assert cache.render("**bold** text") == first
+    assert cache.stats == {"hits": 1, "misses": 1, "evictions": 0}
@@ -4,16 +4,50 @@ import time
 import logging
 import os
 import json
+import socket
+import threading
 import traceback
 import re
+import queue
+from itertools import chain
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection
 from utils.config import CONFIG
+from utils.stream_decoder import StreamDecoder, StreamError, extract_stream_content
+from utils.stream_renderer import StreamRenderer
+from utils.backend_pool import BackendPool
+from utils.scheduler import request_scheduler
+from utils.circuit_breaker import CircuitOpenError, RetryBudget, backoff_with_jitter
+from utils.hedging import TTFTTracker, StreamAttempt
+from utils.cancellation import CancellationToken
+from utils.coalescing import SingleFlight, request_key
+from utils.context_packer import context_packer
 
 # 配置日志记录
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+class _KeepAliveAdapter(HTTPAdapter):
+    """带TCP keep-alive选项的连接池适配器"""
+
+    def __init__(self, tcp_keepalive=True, keepalive_idle=30, **kwargs):
+        self.tcp_keepalive = tcp_keepalive
+        self.keepalive_idle = keepalive_idle
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        if self.tcp_keepalive:
+            socket_options = list(HTTPConnection.default_socket_options)
+            socket_options.append((socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1))
+            # 空闲多久后开始发送探测包（并非所有平台都支持）
+            if hasattr(socket, "TCP_KEEPIDLE"):
+                socket_options.append((socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, int(self.keepalive_idle)))
+            kwargs["socket_options"] = socket_options
+        super().init_poolmanager(*args, **kwargs)
+
+
 class LLMClient:
-    """大语言模型API客户端"""
+    """大语言模型API客户端（进程内共享，线程安全）"""
     
     def __init__(self):
         # 从配置文件读取设置
@@ -21,11 +55,75 @@ class LLMClient:
         self.endpoint = api_config["endpoint"]
         self.max_retries = api_config["max_retries"]
         self.retry_delay = api_config["retry_delay"]
+        self.retry_max_delay = float(api_config.get("retry_max_delay", 8))
         self.base_timeout = api_config["timeout"]
-        self.session = requests.Session()  # 使用会话保持连接
-        self.available_models = self._get_available_models()
-        logger.info(f"初始化LLM客户端，API端点: {self.endpoint}")
-        logger.info(f"可用模型: {', '.join(self.available_models) if self.available_models else '无'}")
+        self.pool_config = api_config.get("pool", {})
+        self.session = self._create_session()  # 使用会话保持连接
+        # 多个后端时在它们之间负载均衡；未配置 endpoints 时只使用单个 endpoint
+        endpoints = api_config.get("endpoints") or [self.endpoint]
+        self.endpoint = endpoints[0]
+        self.backend_pool = BackendPool(
+            endpoints,
+            self.session,
+            api_config.get("load_balancing", {}),
+            api_config.get("circuit_breaker", {})
+        )
+        # 调度器的并发上限按健康后端数放大
+        request_scheduler.attach_backend_pool(self.backend_pool)
+        # 所有会话共享的重试预算，后端故障时限制整体重试流量
+        self.retry_budget = RetryBudget(**api_config.get("retry_budget", {}))
+        # 对冲请求：首块耗时超过近期分位数时向另一个后端发送相同请求
+        hedging_config = api_config.get("hedging", {})
+        self.hedging_enabled = bool(hedging_config.get("enabled", False))
+        self.ttft_tracker = TTFTTracker(
+            window=hedging_config.get("window", 200),
+            percentile=hedging_config.get("percentile", 95),
+            min_samples=hedging_config.get("min_samples", 20),
+            initial_delay=hedging_config.get("initial_delay", 3.0),
+            min_delay=hedging_config.get("min_delay", 0.5)
+        )
+        # 可用模型列表懒加载并定期刷新，避免每次创建客户端都同步请求 /api/tags
+        self.models_refresh_interval = float(api_config.get("models_refresh_interval", 300))
+        self._available_models = None
+        self._models_loaded_at = 0.0
+        self._models_lock = threading.Lock()
+        # 相同的进行中流式请求（低温度）合并为一个上游请求
+        coalescing_config = api_config.get("coalescing", {})
+        self.coalescing_enabled = bool(coalescing_config.get("enabled", True))
+        self.coalescing_max_temperature = float(coalescing_config.get("max_temperature", 0.3))
+        self.single_flight = SingleFlight()
+        # 每个会话当前生成的取消令牌
+        self._cancel_tokens = {}
+        self._cancel_lock = threading.Lock()
+        logger.info(f"初始化LLM客户端，API端点: {', '.join(endpoints)}")
+
+    def _create_session(self):
+        """创建带有限大小连接池的HTTP会话"""
+        session = requests.Session()
+        adapter = _KeepAliveAdapter(
+            tcp_keepalive=self.pool_config.get("tcp_keepalive", True),
+            keepalive_idle=self.pool_config.get("keepalive_timeout", 30),
+            pool_connections=int(self.pool_config.get("max_host_pools", 8)),
+            pool_maxsize=int(self.pool_config.get("max_connections_per_host", 32)),
+            pool_block=bool(self.pool_config.get("block_when_full", True))
+        )
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        return session
+
+    @property
+    def available_models(self):
+        """可用模型列表（首次访问时加载，超过刷新间隔后重新获取）"""
+        now = time.time()
+        if self._available_models is not None and now - self._models_loaded_at < self.models_refresh_interval:
+            return self._available_models
+        with self._models_lock:
+            # 双重检查，避免多个线程同时请求
+            if self._available_models is None or time.time() - self._models_loaded_at >= self.models_refresh_interval:
+                self._available_models = self._get_available_models()
+                self._models_loaded_at = time.time()
+                logger.info(f"可用模型: {', '.join(self._available_models) if self._available_models else '无'}")
+        return self._available_models
 
     def _get_available_models(self):
         """获取API可用的模型列表"""
@@ -96,19 +194,28 @@ class LLMClient:
         # 记录详细的请求信息
         logger.info(f"API请求详情: endpoint={self.endpoint}, model={model}, stream={stream}, temperature={temperature}, max_tokens={max_tokens}")
         
-        # 重试逻辑
+        # 重试逻辑：每次尝试从后端池选择节点，失败过的节点在本次请求中不再使用
+        tried_backends = []
+        self.retry_budget.record_request()
         for attempt in range(self.max_retries):
+            try:
+                backend = self.backend_pool.acquire(model=model, exclude=tried_backends)
+            except CircuitOpenError as e:
+                logger.warning(f"请求被熔断器拒绝: {e}")
+                return "", str(e)
+            request_start = time.time()
+            backend_ok = True
             try:
                 # 计算当前尝试的超时时间（逐渐增加）
                 current_timeout = self.base_timeout * (1 + attempt * 0.5)
-                logger.info(f"尝试 #{attempt+1}/{self.max_retries}, 设置超时: {current_timeout}秒")
+                logger.info(f"尝试 #{attempt+1}/{self.max_retries}, 后端: {backend.name}, 设置超时: {current_timeout}秒")
                 
                 # 发送请求
                 # 使用 (connect_timeout, read_timeout) 方式，避免在长时间流式读取时无限阻塞
                 connect_timeout = min(10, current_timeout)
                 read_timeout = max(30, current_timeout)
                 response = self.session.post(
-                    self.endpoint,
+                    backend.url,
                     headers=headers,
                     json=data,
                     timeout=(connect_timeout, read_timeout)
@@ -135,16 +242,17 @@ class LLMClient:
                 
             except requests.exceptions.Timeout:
                 logger.warning(f"请求超时 (尝试 {attempt+1}/{self.max_retries})")
-                # 如果不是最后一次尝试，则等待后重试
-                if attempt < self.max_retries - 1:
-                    sleep_time = self.retry_delay * (2 ** attempt)  # 指数退避
-                    time.sleep(sleep_time)
-                else:
+                backend_ok = False
+                tried_backends.append(backend)
+                # 如果不是最后一次尝试且重试预算允许，则等待后重试
+                if not (attempt < self.max_retries - 1 and self._wait_before_retry(attempt, tried_backends)):
                     return "", "请求超时，服务器未响应"
             
             except requests.exceptions.HTTPError as e:
                 status_code = e.response.status_code
                 logger.error(f"HTTP错误: {status_code}, {e}")
+                if status_code >= 500:
+                    backend_ok = False
                 
                 # 记录响应内容以便调试
                 try:
@@ -154,11 +262,9 @@ class LLMClient:
                     logger.error("无法读取错误响应内容")
                 
                 # 根据状态码处理不同错误
-                if status_code == 429:  # 过多请求
-                    if attempt < self.max_retries - 1:
-                        sleep_time = self.retry_delay * (2 ** attempt)
-                        time.sleep(sleep_time)
-                    else:
+                if status_code == 429:  # 过多请求，优先换到其它后端
+                    tried_backends.append(backend)
+                    if not (attempt < self.max_retries - 1 and self._wait_before_retry(attempt, tried_backends)):
                         return "", "服务器繁忙，请稍后再试"
                 elif status_code == 401:  # 未授权
                     return "", "API密钥无效或不正确"
@@ -168,13 +274,11 @@ class LLMClient:
                     return "", f"HTTP错误 {status_code}: {e}"
             
             except requests.exceptions.ConnectionError as e:
-                logger.error(f"连接错误: {e}")
-                if attempt < self.max_retries - 1:
-                    sleep_time = self.retry_delay * (2 ** attempt)
-                    logger.info(f"等待 {sleep_time}秒后重试...")
-                    time.sleep(sleep_time)
-                else:
-                    # 尝试使用备用端点
+                logger.error(f"连接错误 ({backend.name}): {e}")
+                backend_ok = False
+                tried_backends.append(backend)
+                if not (attempt < self.max_retries - 1 and self._wait_before_retry(attempt, tried_backends)):
+                    # 所有后端都不可用时返回提示信息
                     backup_result = self._try_backup_endpoint(messages, model, temperature, max_tokens)
                     if backup_result:
                         return backup_result, None
@@ -183,6 +287,36 @@ class LLMClient:
             except Exception as e:
                 logger.error(f"请求异常: {e}", exc_info=True)
                 return "", f"请求出错: {str(e)}"
+
+            finally:
+                self.backend_pool.release(
+                    backend,
+                    latency=time.time() - request_start if backend_ok else None,
+                    success=backend_ok,
+                    model=model
+                )
+
+    def _wait_before_retry(self, attempt, tried_backends):
+        """重试前等待，返回是否应该重试
+
+        所有后端都已熔断或重试预算用尽时立即放弃；还有未尝试的健康后端时立即切换，
+        否则按带随机抖动的指数退避等待，避免所有会话在同一时刻一起重试
+        """
+        available = self.backend_pool.available_backends()
+        if not available:
+            logger.warning("所有后端均处于熔断状态，放弃重试")
+            return False
+        if not self.retry_budget.try_acquire():
+            logger.warning("重试预算已用尽，放弃重试")
+            return False
+        untried = [b for b in available if b.healthy and b not in tried_backends]
+        if untried:
+            logger.info(f"切换到后端 {untried[0].name} 重试")
+            return True
+        sleep_time = backoff_with_jitter(attempt, self.retry_delay, self.retry_max_delay)
+        logger.info(f"等待 {sleep_time:.2f}秒后重试...")
+        time.sleep(sleep_time)
+        return True
     
     def _validate_model(self, model):
         """验证模型是否可用，不可用时返回备选模型"""
@@ -205,9 +339,9 @@ class LLMClient:
         return model
     
     def _try_backup_endpoint(self, messages, model, temperature, max_tokens):
-        """尝试使用备用API端点"""
+        """所有后端都不可用时，返回包含用户问题摘要的提示信息"""
         try:
-            logger.info("尝试使用备用API端点")
+            logger.info("所有API后端均不可用，返回提示信息")
             # 构建简单的响应
             important_content = self._extract_important_content(messages[-1]["content"])
             return f'无法连接到API服务。您的问题是关于："{important_content}"。请检查API服务是否运行。'
@@ -224,8 +358,55 @@ class LLMClient:
         # 否则提取前100个字符
         return text[:100] + "..."
     
-    def generate_stream(self, messages, model="llama3", temperature=0.7, max_tokens=2048):
-        """生成流式响应，直接返回生成器，供前端处理"""
+    def create_cancel_token(self, key):
+        """为会话创建新的取消令牌，同一会话尚未结束的上一次生成会被取消"""
+        token = CancellationToken()
+        with self._cancel_lock:
+            previous = self._cancel_tokens.get(key)
+            self._cancel_tokens[key] = token
+        if previous is not None:
+            previous.cancel("同一会话开始了新的生成")
+        return token
+
+    def cancel(self, key, reason=""):
+        """取消会话当前的生成，返回是否有生成被取消"""
+        with self._cancel_lock:
+            token = self._cancel_tokens.pop(key, None)
+        if token is None or token.cancelled:
+            return False
+        token.cancel(reason or "用户取消")
+        return True
+
+    def release_cancel_token(self, key, token):
+        """生成结束后移除会话的取消令牌（已被新令牌替换时不做处理）"""
+        with self._cancel_lock:
+            if self._cancel_tokens.get(key) is token:
+                del self._cancel_tokens[key]
+
+    def _can_coalesce(self, temperature):
+        """温度足够低、输出基本确定时才合并相同请求"""
+        return self.coalescing_enabled and temperature <= self.coalescing_max_temperature
+
+    def has_inflight_stream(self, messages, model, temperature, max_tokens):
+        """是否有可以直接加入的相同进行中请求"""
+        if not self._can_coalesce(temperature):
+            return False
+        return self.single_flight.in_flight(request_key(model, messages, temperature, max_tokens))
+
+    def generate_stream(self, messages, model="llama3", temperature=0.7, max_tokens=2048, cancel_token=None):
+        """生成流式响应，直接返回生成器，供前端处理；cancel_token 被取消时立即中断上游连接并结束"""
+        if not self._can_coalesce(temperature):
+            yield from self._generate_stream_direct(messages, model, temperature, max_tokens, cancel_token)
+            return
+        key = request_key(model, messages, temperature, max_tokens)
+        yield from self.single_flight.stream(
+            key,
+            lambda upstream_token: self._generate_stream_direct(messages, model, temperature, max_tokens, upstream_token),
+            cancel_token
+        )
+
+    def _generate_stream_direct(self, messages, model, temperature, max_tokens, cancel_token=None):
+        """向后端发送流式请求（带重试、故障转移和取消）"""
         # 记录请求开始
         logger.info(f"开始流式请求模型 {model}，消息数量: {len(messages)}")
         
@@ -260,11 +441,27 @@ class LLMClient:
                 "stream": True
             }
         
-        # 最大重试次数
+        # 最大重试次数：每次尝试从后端池选择节点，失败过的节点在本次请求中不再使用
+        tried_backends = []
+        self.retry_budget.record_request()
         for attempt in range(self.max_retries):
+            if self._is_cancelled(cancel_token):
+                return
+            try:
+                backend = self.backend_pool.acquire(model=model, exclude=tried_backends)
+            except CircuitOpenError as e:
+                logger.warning(f"流式请求被熔断器拒绝: {e}")
+                yield StreamError(e)
+                return
+            request_start = time.time()
+            first_chunk_latency = None
+            backend_ok = True
+            response = None
+            # 是否已经向调用方输出过内容：输出后连接中断不能再重试，否则会拼出“截断的前半段 + 另一份完整回答”
+            received_content = False
             try:
                 # 记录尝试信息
-                logger.info(f"尝试 #{attempt+1}/{self.max_retries} 连接到 {self.endpoint}")
+                logger.info(f"尝试 #{attempt+1}/{self.max_retries} 连接到 {backend.url}")
                 
                 # 计算当前尝试的超时时间
                 current_timeout = self.base_timeout * (1 + attempt * 0.5)
@@ -278,96 +475,53 @@ class LLMClient:
                 stream_read_timeout = CONFIG.get("api", {}).get("stream_read_timeout", 20)
                 # 保证 read_timeout 不小于当前计算值的一部分，以避免过早超时
                 read_timeout = max(stream_read_timeout, current_timeout)
-                response = self.session.post(
-                    self.endpoint,
-                    headers=headers,
-                    json=data,
-                    timeout=(connect_timeout, read_timeout),
-                    stream=True
+                # 发送请求并等待第一个数据块（启用对冲时可能由另一个后端胜出）
+                backend, response, chunks = self._open_stream(
+                    backend,
+                    model,
+                    headers,
+                    data,
+                    (connect_timeout, read_timeout),
+                    tried_backends,
+                    cancel_token
                 )
+                first_chunk_latency = time.time() - request_start
                 
-                # 记录响应信息
-                logger.info(f"收到响应，状态码: {response.status_code}")
-                
-                # 检查响应状态
-                response.raise_for_status()
-                
-                # 获取流式响应的迭代器
-                line_iterator = response.iter_lines()
-                
-                # 标记是否收到任何内容
-                received_content = False
+                # 使用增量解码器处理原始字节流：分帧格式只在流开始时识别一次
+                decoder = StreamDecoder(api_type)
 
-                # 处理流式响应（按行迭代）
+                # 处理流式响应（按到达的数据块迭代）
                 try:
-                    for line in line_iterator:
-                        if not line:
-                            continue
-
-                        # 解析数据行
-                        if line.startswith(b'data: '):
-                            data_text = line[6:].decode('utf-8', errors='replace')
-
-                            if data_text.strip() == "[DONE]":
-                                logger.info("收到流结束标记 [DONE]")
-                                break
-
-                            # 尝试解析JSON
-                            try:
-                                chunk = json.loads(data_text)
-
-                                # 根据不同API类型提取内容
-                                content = None
-                                if api_type == "ollama":
-                                    if "message" in chunk and "content" in chunk["message"]:
-                                        content = chunk["message"]["content"]
-                                    elif "response" in chunk:
-                                        content = chunk["response"]
-                                elif api_type == "openai":
-                                    if "choices" in chunk and len(chunk["choices"]) > 0:
-                                        delta = chunk["choices"][0].get("delta", {})
-                                        content = delta.get("content", "")
-                                else:
-                                    # 通用格式解析
-                                    content = self._extract_stream_chunk(chunk)
-
-                                if content:
-                                    received_content = True
-                                    yield content
-                            except json.JSONDecodeError:
-                                logger.warning(f"JSON解析失败: {data_text[:100]}")
-                            except Exception as e:
-                                logger.error(f"处理数据块时出错: {e}")
-                                logger.error(traceback.format_exc())
-                        else:
-                            # 处理没有data:前缀的行
-                            try:
-                                line_text = line.decode('utf-8', errors='replace')
-
-                                # 尝试解析非标准行为JSON
-                                try:
-                                    chunk = json.loads(line_text)
-                                    content = self._extract_stream_chunk(chunk)
-                                    if content:
-                                        received_content = True
-                                        yield content
-                                except json.JSONDecodeError:
-                                    # 不是JSON，可能是普通文本
-                                    if line_text and not line_text.startswith("{") and not line_text.startswith("["):
-                                        received_content = True
-                                        yield line_text
-                            except Exception as e:
-                                logger.error(f"处理非标准行时出错: {e}")
+                    for raw in chunks:
+                        for content in decoder.feed(raw):
+                            received_content = True
+                            yield content
+                        if decoder.done:
+                            logger.info("收到流结束标记 [DONE]")
+                            break
+                        if self._is_cancelled(cancel_token):
+                            break
+                    for content in decoder.flush():
+                        received_content = True
+                        yield content
                 except requests.exceptions.ChunkedEncodingError as e:
-                    # 在某些情况下，response.iter_lines() 可能抛出分块编码错误，记录并继续尝试回退方案
+                    # 连接在流式读取过程中断开：按连接错误处理（未输出内容时换节点重试）
                     logger.warning(f"读取流式响应时出现分块编码错误: {e}")
+                    raise requests.exceptions.ConnectionError(f"流式响应中断: {e}") from e
+
+                if self._is_cancelled(cancel_token):
+                    # 已取消：结果未知，不计入后端健康状态
+                    backend_ok = None
+                    return
 
-                # 如果没有收到任何分块内容，尝试回退：读取完整响应体并解析JSON或作为纯文本返回
+                if decoder.parse_errors:
+                    logger.warning(f"流式响应中有 {decoder.parse_errors} 行无法解析")
+
+                # 如果没有收到任何分块内容，尝试回退：解析未能按行解码的响应体（整块JSON或纯文本）
                 if not received_content:
                     try:
-                        raw = response.content
-                        if raw:
-                            text = raw.decode('utf-8', errors='replace')
+                        text = decoder.unparsed_text()
+                        if text:
                             # 尝试解析为JSON
                             try:
                                 resp = json.loads(text)
@@ -381,40 +535,180 @@ class LLMClient:
                                 # 不是JSON，直接作为纯文本返回（trim）
                                 logger.info("回退解析：响应不是JSON，作为纯文本返回")
                                 yield text
+                        elif decoder.error:
+                            logger.warning(f"模型返回错误: {decoder.error}")
+                            yield StreamError(f"模型返回错误: {decoder.error}")
                         else:
                             logger.warning("从API接收到响应，但既没有流式分块也没有主体内容")
-                            yield "未能从模型获取有效响应"
+                            yield StreamError("未能从模型获取有效响应")
                     except Exception as e:
                         logger.error(f"回退解析响应时出错: {e}")
-                        yield "处理响应时出错"
+                        yield StreamError("处理响应时出错")
                 
                 # 成功完成生成，退出重试循环
                 break
                 
             except requests.exceptions.ConnectionError as e:
-                logger.error(f"连接错误: {e}")
-                if attempt < self.max_retries - 1:
-                    sleep_time = self.retry_delay * (2 ** attempt)
-                    logger.info(f"等待 {sleep_time}秒后重试...")
-                    time.sleep(sleep_time)
-                else:
+                if self._is_cancelled(cancel_token):
+                    backend_ok = None
+                    return
+                logger.error(f"连接错误 ({backend.name}): {e}")
+                backend_ok = False
+                tried_backends.append(backend)
+                if received_content:
+                    yield StreamError("连接在生成过程中断开，回复不完整")
+                    return
+                if not (attempt < self.max_retries - 1 and self._wait_before_retry(attempt, tried_backends)):
                     error_msg = f"无法连接到API服务器 ({self.endpoint})，请检查网络或服务是否运行"
                     logger.error(error_msg)
-                    yield error_msg
+                    yield StreamError(error_msg)
+                    return
             except Exception as e:
+                if self._is_cancelled(cancel_token):
+                    backend_ok = None
+                    return
                 logger.error(f"流式生成出错: {e}")
                 logger.error(traceback.format_exc())
-                if attempt < self.max_retries - 1:
-                    time.sleep(self.retry_delay * (2 ** attempt))
-                else:
-                    # 最后一次尝试失败，返回错误消息
+                # 超时和5xx错误说明后端本身有问题，计入被动健康检查并换节点重试
+                backend_ok = not self._is_backend_failure(e)
+                if not backend_ok:
+                    tried_backends.append(backend)
+                if received_content:
+                    yield StreamError(f"生成过程中出错，回复不完整: {str(e)}")
+                    return
+                if not (attempt < self.max_retries - 1 and self._wait_before_retry(attempt, tried_backends)):
+                    # 最后一次尝试失败或不再重试，返回错误消息
                     error_msg = f"生成过程中出错: {str(e)}"
                     logger.error(error_msg)
-                    yield error_msg
+                    yield StreamError(error_msg)
+                    return
+            finally:
+                if cancel_token is not None:
+                    cancel_token.detach_all()
+                # 生成器被提前关闭（页面重新运行等）时也要关闭响应，避免后端继续生成
+                if response is not None:
+                    response.close()
+                self.backend_pool.release(backend, latency=first_chunk_latency, success=backend_ok, model=model)
+
+    @staticmethod
+    def _is_cancelled(cancel_token):
+        return cancel_token is not None and cancel_token.cancelled
+
+    def _open_stream(self, backend, model, headers, data, timeout, tried_backends, cancel_token=None):
+        """发送流式请求并读取第一个数据块，返回 (实际使用的后端, 响应对象, 数据块迭代器)"""
+        if self.hedging_enabled and len(self.backend_pool) > 1:
+            return self._open_hedged_stream(backend, model, headers, data, timeout, tried_backends, cancel_token)
+
+        start = time.time()
+        response = self._post_stream(backend.url, headers, data, timeout)
+        if cancel_token is not None:
+            cancel_token.attach(response)
+        logger.info(f"收到响应，状态码: {response.status_code}")
+        response.raise_for_status()
+        chunks = iter(response.iter_content(chunk_size=None))
+        first = next(chunks, b"")
+        self.ttft_tracker.record(time.time() - start)
+        return backend, response, chain([first], chunks)
+
+    def _open_hedged_stream(self, backend, model, headers, data, timeout, tried_backends, cancel_token=None):
+        """对冲请求：首块超过等待时间仍未到达时向另一个后端发送相同请求，先到者胜出
+
+        失败的对冲请求在这里释放它的后端；对冲请求胜出时原后端也在这里释放，
+        调用方只需释放返回的后端
+        """
+        results = queue.Queue()
+        primary = StreamAttempt(backend, lambda: self._post_stream(backend.url, headers, data, timeout), results)
+        if cancel_token is not None:
+            cancel_token.attach(primary)
+        attempts = [primary]
+        hedge_deadline = primary.started_at + self.ttft_tracker.hedge_delay()
+        first_error = None
+
+        while True:
+            wait = None if hedge_deadline is None else max(0.0, hedge_deadline - time.time())
+            try:
+                attempt, chunks, first, error = results.get(timeout=wait)
+            except queue.Empty:
+                # 只对冲一次
+                hedge_deadline = None
+                hedge = None
+                if not self._is_cancelled(cancel_token):
+                    hedge = self._start_hedge(model, headers, data, timeout, attempts, tried_backends, results)
+                if hedge is not None:
+                    attempts.append(hedge)
+                    if cancel_token is not None:
+                        cancel_token.attach(hedge)
+                continue
+
+            attempts.remove(attempt)
+            if error is None:
+                break
+            if attempt is not primary:
+                self.backend_pool.release(attempt.backend, success=not self._is_backend_failure(error), model=model)
+            first_error = first_error or error
+            if not attempts and hedge_deadline is None:
+                raise first_error
+            if attempt is primary and hedge_deadline is not None:
+                # 对冲尚未发出时主请求失败，交给正常的重试逻辑
+                raise error
+
+        # 取消仍在进行的其它请求
+        for loser in attempts:
+            loser.cancel()
+            if loser is not primary:
+                self.backend_pool.release(loser.backend, success=None)
+
+        if attempt is not primary:
+            logger.info(f"对冲请求胜出: {attempt.backend.name}（原后端 {backend.name}）")
+            if primary in attempts:
+                # 原后端只是慢，并未失败；把已等待的时间计入延迟估计
+                self.backend_pool.release(backend, latency=time.time() - primary.started_at, success=None)
+            else:
+                self.backend_pool.release(backend, success=not self._is_backend_failure(first_error), model=model)
+
+        # 首块耗时从原请求发出时算起：用对冲请求自身的耗时会让分位数偏低，对冲阈值越收越紧
+        self.ttft_tracker.record(time.time() - primary.started_at)
+        return attempt.backend, attempt.response, chain([first], chunks)
+
+    def _start_hedge(self, model, headers, data, timeout, attempts, tried_backends, results):
+        """向另一个后端发送对冲请求，没有可用后端或重试预算不足时返回 None"""
+        busy = [a.backend for a in attempts]
+        try:
+            hedge_backend = self.backend_pool.acquire(model=model, exclude=busy + list(tried_backends))
+        except CircuitOpenError:
+            return None
+        if hedge_backend in busy or not self.retry_budget.try_acquire():
+            self.backend_pool.release(hedge_backend, success=None)
+            return None
+        logger.info(f"首块等待超过 {self.ttft_tracker.hedge_delay():.2f}秒，向 {hedge_backend.name} 发送对冲请求")
+        return StreamAttempt(
+            hedge_backend,
+            lambda: self._post_stream(hedge_backend.url, headers, data, timeout),
+            results
+        )
+
+    def _is_backend_failure(self, error):
+        """判断异常是否由后端故障引起（超时、连接失败或5xx）"""
+        if isinstance(error, (requests.exceptions.Timeout, requests.exceptions.ConnectionError)):
+            return True
+        if isinstance(error, requests.exceptions.HTTPError):
+            response = getattr(error, "response", None)
+            return response is not None and response.status_code >= 500
+        return False
     
+    def _post_stream(self, url, headers, data, timeout):
+        """发送流式请求并返回响应对象（子类可替换传输层，如异步客户端）"""
+        return self.session.post(
+            url,
+            headers=headers,
+            json=data,
+            timeout=timeout,
+            stream=True
+        )
+
     def _detect_api_type(self):
         """检测API类型"""
-        if "ollama" in self.endpoint:
+        if "ollama" in self.endpoint or self.endpoint.rstrip("/").endswith(("/api/chat", "/api/generate")):
             return "ollama"
         elif "openai.com" in self.endpoint:
             return "openai"
@@ -423,15 +717,22 @@ class LLMClient:
     
     def _prepare_ollama_request(self, messages, model, temperature, max_tokens, stream):
         """准备Ollama API请求格式"""
-        return {
+        data = {
             "model": model,
             "messages": messages,
             "stream": stream,
             "options": {
                 "temperature": temperature,
-                "num_predict": max_tokens
+                "num_predict": max_tokens,
+                # 按模型配置的上下文长度运行，与上下文打包的预算一致（Ollama 默认只有 2048）
+                "num_ctx": context_packer.context_window(model)
             }
         }
+        # 显式指定模型在显存中的保留时间，避免请求间隙模型被卸载
+        keep_alive = CONFIG.get("api", {}).get("keep_alive")
+        if keep_alive is not None:
+            data["keep_alive"] = keep_alive
+        return data
     
     def _prepare_openai_request(self, messages, model, temperature, max_tokens, stream):
         """准备OpenAI API请求格式"""
@@ -468,20 +769,7 @@ class LLMClient:
     
     def _extract_stream_chunk(self, chunk_data):
         """从流式响应数据块中提取内容"""
-        # 尝试各种可能的路径提取内容
-        if "content" in chunk_data:
-            return chunk_data["content"]
-        elif "message" in chunk_data and "content" in chunk_data["message"]:
-            return chunk_data["message"]["content"]
-        elif "choices" in chunk_data and len(chunk_data["choices"]) > 0:
-            if "delta" in chunk_data["choices"][0] and "content" in chunk_data["choices"][0]["delta"]:
-                return chunk_data["choices"][0]["delta"]["content"]
-            elif "text" in chunk_data["choices"][0]:
-                return chunk_data["choices"][0]["text"]
-        elif "response" in chunk_data:
-            return chunk_data["response"]
-            
-        return ""
+        return extract_stream_content(chunk_data)
 
     def _handle_streaming_response(self, response, api_type="unknown"):
         """处理流式响应"""
@@ -505,68 +793,22 @@ class LLMClient:
             
             try:
                 # 处理流式响应
-                for line in response.iter_lines():
-                    if not line:
-                        continue
-                    
-                    # 解析数据行
-                    if line.startswith(b'data: '):
-                        data = line[6:].decode('utf-8', errors='replace')
-                        
-                        if data.strip() == "[DONE]":
-                            break
-                        
-                        # 尝试解析JSON
-                        try:
-                            chunk = json.loads(data)
-                            
-                            # 根据不同API类型提取内容
-                            content = None
-                            if api_type == "ollama":
-                                if "message" in chunk and "content" in chunk["message"]:
-                                    content = chunk["message"]["content"]
-                                elif "response" in chunk:
-                                    content = chunk["response"]
-                            elif api_type == "openai":
-                                if "choices" in chunk and len(chunk["choices"]) > 0:
-                                    delta = chunk["choices"][0].get("delta", {})
-                                    content = delta.get("content", "")
-                            else:
-                                # 通用格式解析
-                                content = self._extract_stream_chunk(chunk)
-                            
-                            if content:
-                                full_response += content
-                                # 显示光标效果
-                                message_placeholder.markdown(full_response + "▌")
-                        except json.JSONDecodeError:
-                            logger.warning(f"JSON解析失败: {data[:100]}")
-                        except Exception as e:
-                            logger.error(f"处理数据块时出错: {e}")
-                    else:
-                        # 处理没有data:前缀的行
-                        try:
-                            line_text = line.decode('utf-8', errors='replace')
-                            
-                            # 尝试解析为JSON
-                            try:
-                                chunk = json.loads(line_text)
-                                content = self._extract_stream_chunk(chunk)
-                                if content:
-                                    full_response += content
-                                    message_placeholder.markdown(full_response + "▌")
-                            except json.JSONDecodeError:
-                                # 不是JSON，可能是普通文本
-                                if line_text and not line_text.startswith("{") and not line_text.startswith("["):
-                                    full_response += line_text
-                                    message_placeholder.markdown(full_response + "▌")
-                        except Exception as e:
-                            logger.error(f"处理非标准行时出错: {e}")
+                decoder = StreamDecoder(api_type)
+                # 合并数据块后再刷新（带光标效果）
+                renderer = StreamRenderer(message_placeholder, cursor="▌")
+                for raw in response.iter_content(chunk_size=None):
+                    contents = decoder.feed(raw)
+                    if contents:
+                        renderer.append("".join(contents))
+                    if decoder.done:
+                        break
+                contents = decoder.flush()
+                if contents:
+                    renderer.append("".join(contents))
                 
                 # 显示最终结果（无光标）
-                if full_response:
-                    message_placeholder.markdown(full_response)
-                else:
+                full_response = renderer.finish()
+                if not full_response:
                     # 如果没有收到任何响应，显示错误消息
                     message_placeholder.error("未收到有效的响应")
                     
@@ -0,0 +1,221 @@
+"""
+异步流式客户端 - 在进程内共享的后台事件循环上执行流式请求
+
+所有会话的流式生成都复用同一个 asyncio 事件循环（运行在一个守护线程中），
+HTTP 连接和套接字读取由这个循环统一处理；对外仍然提供与 LLMClient 相同的
+同步分块生成器接口，供 components/chat.py 中的 handle_user_input 直接使用。
+
+注意：同步接口意味着每个进行中的生成仍有一个消费线程（脚本线程或 utils/generation_worker.py
+的工作线程）在整个流式过程中阻塞等待分块队列，共享事件循环节省的是连接和读取，而不是每个生成一个线程的开销。
+重试、对冲、合并请求和解码都在同步的 LLMClient 中实现，没有提供在事件循环上直接消费的异步迭代接口。
+"""
+import asyncio
+import logging
+import queue
+import threading
+import requests
+from utils.api import LLMClient
+from utils.config import CONFIG
+
+logger = logging.getLogger(__name__)
+
+# aiohttp 为可选依赖，未安装时回退到同步客户端
+try:
+    import aiohttp
+    AIOHTTP_AVAILABLE = True
+except ImportError:
+    aiohttp = None
+    AIOHTTP_AVAILABLE = False
+
+# 进程内共享的事件循环及其线程
+_shared_loop = None
+_shared_loop_lock = threading.Lock()
+
+
+def get_shared_loop():
+    """获取进程内共享的后台事件循环，首次调用时启动守护线程"""
+    global _shared_loop
+    with _shared_loop_lock:
+        if _shared_loop is None or _shared_loop.is_closed():
+            loop = asyncio.new_event_loop()
+            thread = threading.Thread(
+                target=loop.run_forever,
+                name="llm-stream-loop",
+                daemon=True
+            )
+            thread.start()
+            _shared_loop = loop
+            logger.info("已启动共享的流式请求事件循环")
+    return _shared_loop
+
+
+class _StreamResponse:
+    """把事件循环中的流式响应桥接为 requests 风格的同步响应对象"""
+
+    def __init__(self, url, status_code, error_text, chunk_queue, future, read_timeout):
+        self.url = url
+        self.status_code = status_code
+        self.text = error_text or ""
+        self._queue = chunk_queue
+        self._future = future
+        self._read_timeout = read_timeout
+        self._raw = []
+        self._finished = False
+
+    def raise_for_status(self):
+        """状态码异常时抛出 requests.HTTPError，保持与同步客户端一致的错误处理"""
+        if self.status_code >= 400:
+            self.close()
+            raise requests.exceptions.HTTPError(
+                f"{self.status_code} Error for url: {self.url}",
+                response=self
+            )
+
+    def iter_chunks(self):
+        """按到达顺序返回原始字节块（调用线程在流式期间阻塞等待队列）"""
+        while not self._finished:
+            try:
+                kind, payload = self._queue.get(timeout=self._read_timeout)
+            except queue.Empty:
+                self.close()
+                raise requests.exceptions.ReadTimeout(
+                    f"读取流式响应超时（{self._read_timeout}秒）"
+                )
+
+            if kind == "data":
+                self._raw.append(payload)
+                yield payload
+            elif kind == "error":
+                self._finished = True
+                raise _translate_error(payload)
+            else:
+                self._finished = True
+
+    def iter_content(self, chunk_size=None):
+        """按到达顺序返回原始字节块，与 requests.Response.iter_content(None) 一致"""
+        return self.iter_chunks()
+
+    def iter_lines(self):
+        """按行返回响应内容，行为与 requests.Response.iter_lines 相同"""
+        pending = b""
+        for chunk in self.iter_chunks():
+            pending += chunk
+            # 最后一段可能是不完整的行，留到下一个数据块
+            *lines, pending = pending.split(b"\n")
+            for line in lines:
+                yield line.rstrip(b"\r")
+        if pending:
+            yield pending.rstrip(b"\r")
+
+    @property
+    def content(self):
+        """读取剩余内容并返回完整响应体"""
+        for _ in self.iter_chunks():
+            pass
+        return b"".join(self._raw)
+
+    def close(self):
+        """取消后台读取任务，释放连接"""
+        self._finished = True
+        if self._future is not None and not self._future.done():
+            self._future.cancel()
+
+
+def _translate_error(error):
+    """将 aiohttp/asyncio 异常转换为 requests 异常，复用 LLMClient 中的重试逻辑"""
+    if isinstance(error, requests.exceptions.RequestException):
+        return error
+    if isinstance(error, asyncio.TimeoutError):
+        return requests.exceptions.Timeout(str(error) or "请求超时")
+    if aiohttp is not None and isinstance(error, aiohttp.ClientConnectionError):
+        return requests.exceptions.ConnectionError(str(error))
+    if aiohttp is not None and isinstance(error, aiohttp.ClientPayloadError):
+        return requests.exceptions.ChunkedEncodingError(str(error))
+    return requests.exceptions.RequestException(str(error))
+
+
+class AsyncLLMClient(LLMClient):
+    """基于共享事件循环的异步流式客户端，接口与 LLMClient 保持一致"""
+
+    def __init__(self):
+        super().__init__()
+        self.loop = get_shared_loop()
+        self._aio_session = None
+        self._aio_session_lock = threading.Lock()
+
+    def _get_aio_session(self):
+        """在共享事件循环中懒加载 aiohttp 会话"""
+        with self._aio_session_lock:
+            if self._aio_session is None or self._aio_session.closed:
+                future = asyncio.run_coroutine_threadsafe(self._create_aio_session(), self.loop)
+                self._aio_session = future.result()
+        return self._aio_session
+
+    async def _create_aio_session(self):
+        """创建 aiohttp 会话（必须在事件循环内执行），连接数上限与同步连接池一致"""
+        connector = aiohttp.TCPConnector(
+            limit=int(self.pool_config.get("max_connections", 64)),
+            limit_per_host=int(self.pool_config.get("max_connections_per_host", 32)),
+            keepalive_timeout=float(self.pool_config.get("keepalive_timeout", 30))
+        )
+        return aiohttp.ClientSession(connector=connector)
+
+    def _post_stream(self, url, headers, data, timeout):
+        """把流式请求提交到共享事件循环，返回同步可迭代的响应对象"""
+        connect_timeout, read_timeout = timeout
+        session = self._get_aio_session()
+        chunk_queue = queue.Queue()
+
+        future = asyncio.run_coroutine_threadsafe(
+            self._stream_request(session, url, headers, data, connect_timeout, read_timeout, chunk_queue),
+            self.loop
+        )
+
+        # 等待响应头（或错误）到达
+        try:
+            kind, payload = chunk_queue.get(timeout=connect_timeout + read_timeout)
+        except queue.Empty:
+            future.cancel()
+            raise requests.exceptions.Timeout(f"等待响应超时: {url}")
+
+        if kind == "error":
+            raise _translate_error(payload)
+
+        status_code, error_text = payload
+        return _StreamResponse(url, status_code, error_text, chunk_queue, future, read_timeout)
+
+    async def _stream_request(self, session, url, headers, data, connect_timeout, read_timeout, chunk_queue):
+        """在事件循环中读取流式响应，并把数据块放入线程安全队列"""
+        client_timeout = aiohttp.ClientTimeout(
+            total=None,
+            sock_connect=connect_timeout,
+            sock_read=read_timeout
+        )
+        try:
+            async with session.post(url, headers=headers, json=data, timeout=client_timeout) as resp:
+                error_text = None
+                if resp.status >= 400:
+                    error_text = await resp.text(errors="replace")
+                chunk_queue.put(("status", (resp.status, error_text)))
+                if error_text is not None:
+                    return
+
+                async for chunk in resp.content.iter_any():
+                    chunk_queue.put(("data", chunk))
+            chunk_queue.put(("end", None))
+        except asyncio.CancelledError:
+            chunk_queue.put(("end", None))
+            raise
+        except Exception as e:
+            logger.warning(f"异步流式请求失败: {e}")
+            chunk_queue.put(("error", e))
+
+
+def create_llm_client():
+    """根据配置创建LLM客户端：启用异步流式且安装了aiohttp时使用异步客户端"""
+    use_async = CONFIG.get("api", {}).get("async_streaming", True)
+    if use_async and AIOHTTP_AVAILABLE:
+        return AsyncLLMClient()
+    if use_async:
+        logger.warning("未安装aiohttp，异步流式模式不可用，使用同步客户端")
+    return LLMClient()
@@ -0,0 +1,240 @@
+"""
+后端池 - 在多个 Ollama 后端之间做负载均衡，并通过健康检查自动摘除/恢复节点
+
+健康检查同时轮询 /api/ps 记录每个节点上已加载（常驻显存）的模型，
+选择节点时优先把请求发到目标模型已经加载的节点，避免 Ollama 切换模型权重。
+每个节点还带有一个熔断器，所有节点都熔断时 acquire() 直接抛出 CircuitOpenError。
+"""
+import logging
+import threading
+import time
+from urllib.parse import urlsplit, urlunsplit
+from utils.circuit_breaker import CircuitBreaker, CircuitOpenError
+
+logger = logging.getLogger(__name__)
+
+# 负载均衡策略
+STRATEGY_LEAST_OUTSTANDING = "least_outstanding"
+STRATEGY_LATENCY_WEIGHTED = "latency_weighted"
+
+
+def _replace_path(url, path):
+    """把URL的路径替换为指定路径（用于从 /api/chat 推导 /api/tags 等端点）"""
+    parts = urlsplit(url)
+    return urlunsplit((parts.scheme, parts.netloc, path, "", ""))
+
+
+class Backend:
+    """单个后端节点的状态：在途请求数、延迟估计和健康状态"""
+
+    def __init__(self, url, breaker_config=None):
+        self.url = url
+        self.name = urlsplit(url).netloc or url
+        self.breaker = CircuitBreaker(self.name, **(breaker_config or {}))
+        self.tags_url = _replace_path(url, "/api/tags")
+        self.ps_url = _replace_path(url, "/api/ps")
+        self.loaded_models = set()
+        self.outstanding = 0
+        self.ewma_latency = None
+        self.healthy = True
+        self.consecutive_failures = 0
+        self.consecutive_successes = 0
+        self.last_checked = 0.0
+
+    def __repr__(self):
+        return f"Backend({self.name}, healthy={self.healthy}, breaker={self.breaker.state}, outstanding={self.outstanding})"
+
+
+class BackendPool:
+    """后端池：按最少在途请求或延迟加权选择后端，后台定期探测 /api/tags"""
+
+    def __init__(self, endpoints, session, config=None, breaker_config=None):
+        config = config or {}
+        self.backends = [Backend(url, breaker_config) for url in endpoints]
+        self.session = session
+        self.strategy = config.get("strategy", STRATEGY_LEAST_OUTSTANDING)
+        self.health_check_interval = float(config.get("health_check_interval", 10))
+        self.health_check_timeout = float(config.get("health_check_timeout", 3))
+        self.unhealthy_threshold = int(config.get("unhealthy_threshold", 2))
+        self.healthy_threshold = int(config.get("healthy_threshold", 1))
+        self.latency_alpha = float(config.get("latency_ewma_alpha", 0.3))
+        self.model_affinity = bool(config.get("model_affinity", True))
+        # 已加载模型的节点比其它节点多出的在途请求超过该值时，允许发往冷节点
+        self.affinity_max_extra_load = int(config.get("affinity_max_extra_load", 4))
+        self._lock = threading.Lock()
+        self._rr = 0
+        self._stop = threading.Event()
+        self._health_thread = None
+
+    def __len__(self):
+        return len(self.backends)
+
+    def acquire(self, model=None, exclude=()):
+        """选择一个后端并把它的在途请求数加一，调用方必须在结束时调用 release()
+
+        所有节点的熔断器都打开时抛出 CircuitOpenError，调用方应立即失败而不是等待重试
+        """
+        self._ensure_health_checks()
+        with self._lock:
+            allowed = [b for b in self.backends if b.breaker.can_attempt()]
+            if not allowed:
+                raise CircuitOpenError("后端服务暂时不可用（熔断保护中），请稍后再试")
+            candidates = [b for b in allowed if b.healthy and b not in exclude]
+            if not candidates:
+                # 没有健康节点时仍然尝试未熔断的节点，避免整体不可用
+                candidates = [b for b in allowed if b not in exclude] or allowed
+
+            if model and self.model_affinity and len(candidates) > 1:
+                candidates = self._prefer_warm(candidates, model)
+
+            backend = self._choose(candidates)
+            backend.breaker.begin()
+            backend.outstanding += 1
+            return backend
+
+    def _prefer_warm(self, candidates, model):
+        """优先选择已加载目标模型的节点，除非它们明显比冷节点更繁忙（调用方持有锁）"""
+        warm = [b for b in candidates if model in b.loaded_models]
+        if not warm or len(warm) == len(candidates):
+            return candidates
+        cold = [b for b in candidates if model not in b.loaded_models]
+        least_warm = min(b.outstanding for b in warm)
+        least_cold = min(b.outstanding for b in cold)
+        if least_warm - least_cold > self.affinity_max_extra_load:
+            return candidates
+        return warm
+
+    def release(self, backend, latency=None, success=True, model=None):
+        """请求结束：减少在途请求数，并根据结果更新延迟、熔断器、被动健康状态和已加载模型
+
+        success 为 None 表示请求被取消、结果未知，此时不更新熔断器和健康状态
+        """
+        with self._lock:
+            if success and model:
+                # 请求成功说明该模型已在此节点加载
+                backend.loaded_models.add(model)
+            backend.outstanding = max(0, backend.outstanding - 1)
+            if latency is not None:
+                if backend.ewma_latency is None:
+                    backend.ewma_latency = latency
+                else:
+                    backend.ewma_latency += self.latency_alpha * (latency - backend.ewma_latency)
+            if success is None:
+                backend.breaker.record_cancelled()
+            elif success:
+                backend.breaker.record_success()
+                self._mark_success(backend)
+            else:
+                backend.breaker.record_failure()
+                self._mark_failure(backend)
+
+    def warm_backends(self, model):
+        """返回已加载指定模型的健康后端列表"""
+        with self._lock:
+            return [b for b in self.backends if b.healthy and model in b.loaded_models]
+
+    def healthy_backends(self):
+        """返回当前健康的后端列表"""
+        with self._lock:
+            return [b for b in self.backends if b.healthy]
+
+    def available_backends(self):
+        """返回熔断器允许请求的后端列表"""
+        with self._lock:
+            return [b for b in self.backends if b.breaker.can_attempt()]
+
+    def _choose(self, candidates):
+        """按配置的策略从候选节点中选择一个（调用方持有锁）"""
+        if len(candidates) == 1:
+            return candidates[0]
+
+        # 轮转起点，使得得分相同的节点之间均匀分布
+        self._rr = (self._rr + 1) % len(candidates)
+        ordered = candidates[self._rr:] + candidates[:self._rr]
+
+        if self.strategy == STRATEGY_LATENCY_WEIGHTED:
+            known = [b.ewma_latency for b in candidates if b.ewma_latency is not None]
+            default_latency = min(known) if known else 1.0
+            return min(
+                ordered,
+                key=lambda b: (b.ewma_latency if b.ewma_latency is not None else default_latency) * (b.outstanding + 1)
+            )
+        return min(ordered, key=lambda b: b.outstanding)
+
+    def _mark_success(self, backend):
+        backend.consecutive_failures = 0
+        backend.consecutive_successes += 1
+        if not backend.healthy and backend.consecutive_successes >= self.healthy_threshold:
+            backend.healthy = True
+            logger.info(f"后端 {backend.name} 恢复健康，重新加入负载均衡")
+
+    def _mark_failure(self, backend):
+        backend.consecutive_successes = 0
+        backend.consecutive_failures += 1
+        if backend.healthy and backend.consecutive_failures >= self.unhealthy_threshold:
+            backend.healthy = False
+            logger.warning(f"后端 {backend.name} 连续失败 {backend.consecutive_failures} 次，暂时摘除")
+
+    def _ensure_health_checks(self):
+        """首次使用时启动后台健康检查线程（单节点时不需要）"""
+        if self._health_thread is not None or len(self.backends) < 2 or self.health_check_interval <= 0:
+            return
+        with self._lock:
+            if self._health_thread is None:
+                self._health_thread = threading.Thread(
+                    target=self._health_loop,
+                    name="llm-backend-health",
+                    daemon=True
+                )
+                self._health_thread.start()
+
+    def _health_loop(self):
+        """定期探测所有后端（启动后立即探测一次，尽早获得已加载模型信息）"""
+        self.check_all()
+        while not self._stop.wait(self.health_check_interval):
+            self.check_all()
+
+    def check_all(self):
+        """同步探测所有后端的 /api/tags"""
+        for backend in self.backends:
+            self.probe(backend)
+
+    def probe(self, backend):
+        """探测单个后端，返回是否健康；健康时同时刷新它已加载的模型"""
+        start = time.time()
+        ok = False
+        loaded_models = None
+        try:
+            response = self.session.get(backend.tags_url, timeout=self.health_check_timeout)
+            ok = response.status_code == 200
+            if ok and self.model_affinity:
+                loaded_models = self._fetch_loaded_models(backend)
+        except Exception as e:
+            logger.debug(f"健康检查失败 {backend.name}: {e}")
+        with self._lock:
+            backend.last_checked = time.time()
+            if ok:
+                self._mark_success(backend)
+                if loaded_models is not None:
+                    backend.loaded_models = loaded_models
+            else:
+                self._mark_failure(backend)
+                backend.loaded_models = set()
+        if ok:
+            logger.debug(f"健康检查通过 {backend.name}，耗时 {time.time() - start:.3f}秒")
+        return ok
+
+    def _fetch_loaded_models(self, backend):
+        """读取 /api/ps 中当前加载在该节点上的模型，接口不可用时返回 None"""
+        try:
+            response = self.session.get(backend.ps_url, timeout=self.health_check_timeout)
+            if response.status_code != 200:
+                return None
+            return {m.get("name") or m.get("model") for m in response.json().get("models", [])} - {None}
+        except Exception as e:
+            logger.debug(f"读取已加载模型失败 {backend.name}: {e}")
+            return None
+
+    def stop(self):
+        """停止健康检查线程"""
+        self._stop.set()
@@ -0,0 +1,257 @@
+"""
+缓存存储后端 - 响应缓存的可替换存储层
+
+MemoryCacheBackend 把条目保存在当前进程内存中；SQLiteCacheBackend 把压缩后的条目
+写入本地 SQLite 数据库（WAL 模式），同一台机器上的多个进程可以并发读写，
+重启或重新部署后缓存依然有效。所有后端都按 TTL 过期、超过条目上限时按最近访问时间淘汰。
+"""
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+class CacheBackend(ABC):
+    """缓存存储后端接口：值为可 JSON 序列化的字典，每个条目带作用域和过期时间"""
+
+    def __init__(self, max_entries=1000):
+        self.max_entries = int(max_entries)
+        self.stats = {"evictions": 0, "expired": 0}
+
+    @abstractmethod
+    def get(self, key):
+        """返回未过期的值并刷新访问时间，不存在或已过期返回 None"""
+
+    @abstractmethod
+    def set(self, key, value, ttl, scope=""):
+        """写入（或覆盖）一个条目，ttl 为生存时间（秒）"""
+
+    @abstractmethod
+    def delete(self, key):
+        """删除一个条目"""
+
+    @abstractmethod
+    def keys(self, scope):
+        """返回作用域内所有未过期条目的键（不读取值）"""
+
+    @abstractmethod
+    def scan(self, scope, keys=None):
+        """返回作用域内未过期条目的 (key, value) 列表；指定 keys 时只返回其中的条目"""
+
+    @abstractmethod
+    def clear(self):
+        """清空所有条目"""
+
+    @abstractmethod
+    def __len__(self):
+        """返回条目数"""
+
+
+class MemoryCacheBackend(CacheBackend):
+    """进程内存后端（线程安全），进程重启后缓存丢失"""
+
+    def __init__(self, max_entries=1000):
+        super().__init__(max_entries)
+        # key -> (scope, value, expires_at)，按访问顺序排列
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._entries.get(key)
+            if item is None:
+                return None
+            if item[2] < time.time():
+                del self._entries[key]
+                self.stats["expired"] += 1
+                return None
+            self._entries.move_to_end(key)
+            return item[1]
+
+    def set(self, key, value, ttl, scope=""):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (scope, value, time.time() + ttl)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.stats["evictions"] += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def keys(self, scope):
+        now = time.time()
+        with self._lock:
+            return [key for key, item in self._entries.items() if item[0] == scope and item[2] >= now]
+
+    def scan(self, scope, keys=None):
+        now = time.time()
+        with self._lock:
+            if keys is not None:
+                items = ((key, self._entries.get(key)) for key in keys)
+                return [(key, item[1]) for key, item in items if item is not None and item[0] == scope and item[2] >= now]
+            return [(key, item[1]) for key, item in self._entries.items() if item[0] == scope and item[2] >= now]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+
+class SQLiteCacheBackend(CacheBackend):
+    """本地 SQLite 后端：值经 zlib 压缩存储，多进程共享，重启后保留"""
+
+    _SCHEMA = """
+        CREATE TABLE IF NOT EXISTS cache_entries (
+            key TEXT PRIMARY KEY,
+            scope TEXT NOT NULL,
+            value BLOB NOT NULL,
+            expires_at REAL NOT NULL,
+            accessed_at REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_cache_scope ON cache_entries (scope, expires_at);
+        CREATE INDEX IF NOT EXISTS idx_cache_accessed ON cache_entries (accessed_at);
+    """
+
+    def __init__(self, path, max_entries=1000, compress_level=6, purge_interval=60.0):
+        super().__init__(max_entries)
+        self.path = path
+        self.compress_level = int(compress_level)
+        # 过期条目清理和容量检查的最小间隔（秒），避免每次写入都扫描整表
+        self.purge_interval = float(purge_interval)
+        self._last_purge = 0.0
+        # sqlite3 连接不能跨线程共享，每个线程使用自己的连接
+        self._local = threading.local()
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        with self._connect() as conn:
+            conn.executescript(self._SCHEMA)
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5.0, isolation_level=None)
+            # WAL 模式下读不阻塞写，多个进程可以同时读取
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _encode(self, value):
+        return zlib.compress(json.dumps(value, ensure_ascii=False).encode("utf-8"), self.compress_level)
+
+    @staticmethod
+    def _decode(blob):
+        return json.loads(zlib.decompress(blob).decode("utf-8"))
+
+    def get(self, key):
+        conn = self._connect()
+        now = time.time()
+        row = conn.execute("SELECT value, expires_at FROM cache_entries WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        if row[1] < now:
+            conn.execute("DELETE FROM cache_entries WHERE key = ?", (key,))
+            self.stats["expired"] += 1
+            return None
+        conn.execute("UPDATE cache_entries SET accessed_at = ? WHERE key = ?", (now, key))
+        try:
+            return self._decode(row[0])
+        except (zlib.error, ValueError) as e:
+            logger.warning(f"缓存条目损坏，已删除: {e}")
+            self.delete(key)
+            return None
+
+    def set(self, key, value, ttl, scope=""):
+        conn = self._connect()
+        now = time.time()
+        conn.execute(
+            "INSERT OR REPLACE INTO cache_entries (key, scope, value, expires_at, accessed_at) VALUES (?, ?, ?, ?, ?)",
+            (key, scope, self._encode(value), now + ttl, now)
+        )
+        if now - self._last_purge >= self.purge_interval:
+            self._last_purge = now
+            self._purge(conn, now)
+
+    def _purge(self, conn, now):
+        """删除过期条目，超过条目上限时删除最久未访问的条目"""
+        expired = conn.execute("DELETE FROM cache_entries WHERE expires_at < ?", (now,)).rowcount
+        self.stats["expired"] += max(expired, 0)
+        count = conn.execute("SELECT COUNT(*) FROM cache_entries").fetchone()[0]
+        if count > self.max_entries:
+            evicted = conn.execute(
+                "DELETE FROM cache_entries WHERE key IN "
+                "(SELECT key FROM cache_entries ORDER BY accessed_at LIMIT ?)",
+                (count - self.max_entries,)
+            ).rowcount
+            self.stats["evictions"] += max(evicted, 0)
+
+    def delete(self, key):
+        self._connect().execute("DELETE FROM cache_entries WHERE key = ?", (key,))
+
+    def keys(self, scope):
+        return [
+            key for (key,) in self._connect().execute(
+                "SELECT key FROM cache_entries WHERE scope = ? AND expires_at >= ?", (scope, time.time())
+            )
+        ]
+
+    def scan(self, scope, keys=None):
+        conn = self._connect()
+        now = time.time()
+        if keys is None:
+            rows = conn.execute(
+                "SELECT key, value FROM cache_entries WHERE scope = ? AND expires_at >= ?", (scope, now)
+            ).fetchall()
+        else:
+            rows = []
+            keys = list(keys)
+            # 分批查询，避免超过 SQLite 的参数个数上限
+            for i in range(0, len(keys), 500):
+                batch = keys[i:i + 500]
+                rows += conn.execute(
+                    f"SELECT key, value FROM cache_entries WHERE scope = ? AND expires_at >= ? "
+                    f"AND key IN ({', '.join('?' * len(batch))})",
+                    [scope, now] + batch
+                ).fetchall()
+        entries = []
+        for key, blob in rows:
+            try:
+                entries.append((key, self._decode(blob)))
+            except (zlib.error, ValueError):
+                continue
+        return entries
+
+    def clear(self):
+        self._connect().execute("DELETE FROM cache_entries")
+
+    def __len__(self):
+        return self._connect().execute("SELECT COUNT(*) FROM cache_entries").fetchone()[0]
+
+
+def create_cache_backend(config):
+    """按配置创建缓存后端，磁盘后端不可用时回退到内存后端"""
+    config = config or {}
+    max_entries = int(config.get("max_entries", 1000))
+    if config.get("backend", "memory") == "sqlite":
+        path = config.get("path", "./data/response_cache.db")
+        try:
+            return SQLiteCacheBackend(
+                path,
+                max_entries=max_entries,
+                compress_level=config.get("compress_level", 6)
+            )
+        except (sqlite3.Error, OSError) as e:
+            logger.warning(f"无法打开磁盘缓存 {path}，改用内存缓存: {e}")
+    return MemoryCacheBackend(max_entries)
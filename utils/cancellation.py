@@ -0,0 +1,86 @@
+"""
+取消令牌 - 协作式取消进行中的生成请求
+
+生成过程把正在读取的上游响应挂到令牌上；页面重新运行、切换对话或 watchdog 触发时
+取消令牌，立即中断上游连接，让后端停止生成没人读取的内容，并尽快归还调度名额。
+"""
+import logging
+import socket
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class CancelledError(Exception):
+    """生成已被取消"""
+
+
+class CancellationToken:
+    """一次生成的取消令牌（线程安全），cancel() 会中断所有挂在令牌上的响应"""
+
+    def __init__(self):
+        self.reason = None
+        self._event = threading.Event()
+        self._resources = []
+        self._lock = threading.Lock()
+
+    @property
+    def cancelled(self):
+        return self._event.is_set()
+
+    def cancel(self, reason=""):
+        """取消生成并中断已挂载的上游响应"""
+        with self._lock:
+            if self._event.is_set():
+                return
+            self.reason = reason
+            self._event.set()
+            resources, self._resources = self._resources, []
+        if reason:
+            logger.info(f"取消生成: {reason}")
+        for resource in resources:
+            abort_response(resource)
+
+    def attach(self, resource):
+        """挂载一个可关闭的响应，令牌已取消时立即中断它"""
+        with self._lock:
+            if not self._event.is_set():
+                self._resources.append(resource)
+                return
+        abort_response(resource)
+
+    def detach_all(self):
+        """当前请求结束，移除挂载的响应"""
+        with self._lock:
+            self._resources = []
+
+    def raise_if_cancelled(self):
+        """已取消时抛出 CancelledError"""
+        if self._event.is_set():
+            raise CancelledError(self.reason or "生成已取消")
+
+
+def abort_response(response):
+    """中断一个可能正被其它线程阻塞读取的响应：先关闭底层 socket，再在后台调用 close()"""
+    _shutdown_socket(response)
+    # 同步响应在另一线程阻塞读取时 close() 会等待读取结束，放到后台执行
+    threading.Thread(target=_close_quietly, args=(response,), name="llm-response-abort", daemon=True).start()
+
+
+def _close_quietly(response):
+    try:
+        response.close()
+    except Exception as e:
+        logger.debug(f"关闭响应失败: {e}")
+
+
+def _shutdown_socket(response):
+    """关闭 requests 响应底层的 socket，使阻塞中的读取立即返回（异步响应没有该属性，直接跳过）"""
+    connection = getattr(getattr(response, "raw", None), "_connection", None)
+    sock = getattr(connection, "sock", None)
+    if sock is None:
+        return
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except OSError as e:
+        logger.debug(f"中断连接失败: {e}")
@@ -0,0 +1,119 @@
+"""
+熔断与重试预算 - 后端故障时快速失败，并限制整体重试流量
+
+每个后端节点各有一个熔断器（关闭/打开/半开三种状态）；整个进程共享一个重试预算，
+重试次数被限制为正常请求量的一定比例，避免后端故障时所有会话一起重试压垮后端。
+"""
+import logging
+import random
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# 熔断器状态
+STATE_CLOSED = "closed"
+STATE_OPEN = "open"
+STATE_HALF_OPEN = "half_open"
+
+
+class CircuitOpenError(Exception):
+    """所有后端的熔断器都处于打开状态，请求被立即拒绝"""
+
+
+class CircuitBreaker:
+    """单个后端的熔断器"""
+
+    def __init__(self, name, failure_threshold=5, recovery_timeout=15.0, half_open_max_calls=1):
+        self.name = name
+        self.failure_threshold = int(failure_threshold)
+        self.recovery_timeout = float(recovery_timeout)
+        self.half_open_max_calls = int(half_open_max_calls)
+        self.state = STATE_CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.half_open_calls = 0
+        self._lock = threading.Lock()
+
+    def can_attempt(self):
+        """是否允许向该后端发送请求（不改变状态）"""
+        with self._lock:
+            if self.state == STATE_CLOSED:
+                return True
+            if self.state == STATE_OPEN:
+                return time.time() - self.opened_at >= self.recovery_timeout
+            return self.half_open_calls < self.half_open_max_calls
+
+    def begin(self):
+        """请求即将发出：打开状态超过恢复时间后转为半开，并占用一个试探名额"""
+        with self._lock:
+            if self.state == STATE_OPEN and time.time() - self.opened_at >= self.recovery_timeout:
+                self.state = STATE_HALF_OPEN
+                self.half_open_calls = 0
+                logger.info(f"熔断器 {self.name} 进入半开状态，放行试探请求")
+            if self.state == STATE_HALF_OPEN:
+                self.half_open_calls += 1
+
+    def record_success(self):
+        """请求成功：半开状态下关闭熔断器"""
+        with self._lock:
+            if self.state != STATE_CLOSED:
+                logger.info(f"熔断器 {self.name} 试探成功，恢复关闭状态")
+            self.state = STATE_CLOSED
+            self.failures = 0
+            self.half_open_calls = 0
+
+    def record_cancelled(self):
+        """请求被取消、结果未知：只归还半开状态下占用的试探名额"""
+        with self._lock:
+            if self.state == STATE_HALF_OPEN and self.half_open_calls > 0:
+                self.half_open_calls -= 1
+
+    def record_failure(self):
+        """请求失败：连续失败达到阈值或半开试探失败时打开熔断器"""
+        with self._lock:
+            self.failures += 1
+            if self.state == STATE_HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != STATE_OPEN:
+                    logger.warning(f"熔断器 {self.name} 打开（连续失败 {self.failures} 次），{self.recovery_timeout}秒内快速失败")
+                self.state = STATE_OPEN
+                self.opened_at = time.time()
+                self.half_open_calls = 0
+
+
+class RetryBudget:
+    """重试预算：每个请求存入 ratio 个令牌，每次重试消耗一个令牌"""
+
+    def __init__(self, ratio=0.2, min_per_second=0.5, max_tokens=10):
+        self.ratio = float(ratio)
+        self.min_per_second = float(min_per_second)
+        self.max_tokens = float(max_tokens)
+        self.tokens = self.max_tokens
+        self._last_refill = time.time()
+        self._lock = threading.Lock()
+
+    def record_request(self):
+        """记录一次新请求（不含重试），按比例增加重试额度"""
+        with self._lock:
+            self._refill()
+            self.tokens = min(self.max_tokens, self.tokens + self.ratio)
+
+    def try_acquire(self):
+        """尝试消耗一次重试额度，预算不足时返回 False"""
+        with self._lock:
+            self._refill()
+            if self.tokens >= 1.0:
+                self.tokens -= 1.0
+                return True
+            return False
+
+    def _refill(self):
+        """按时间补充最低限度的重试额度，保证低流量时也能重试（调用方持有锁）"""
+        now = time.time()
+        self.tokens = min(self.max_tokens, self.tokens + (now - self._last_refill) * self.min_per_second)
+        self._last_refill = now
+
+
+def backoff_with_jitter(attempt, base_delay, max_delay):
+    """指数退避加全抖动：在 [0, min(max_delay, base * 2^attempt)] 内随机等待"""
+    return random.uniform(0, min(max_delay, base_delay * (2 ** attempt)))
@@ -0,0 +1,134 @@
+"""
+请求合并 - 相同的进行中请求共享同一个上游流（single-flight）
+
+温度足够低（输出基本确定）时，模型、参数和消息完全相同的并发请求只向后端发送一次：
+第一个请求在后台线程中读取上游流并缓存数据块，之后加入的请求先回放已缓存的数据块，
+再与第一个请求一起接收后续数据块。所有订阅者都离开时取消上游请求。
+"""
+import hashlib
+import json
+import logging
+import threading
+from utils.cancellation import CancellationToken
+from utils.stream_decoder import StreamError
+
+logger = logging.getLogger(__name__)
+
+
+def request_key(model, messages, temperature, max_tokens):
+    """根据模型、参数和消息计算请求的合并键"""
+    payload = json.dumps(
+        {"model": model, "messages": messages, "temperature": temperature, "max_tokens": max_tokens},
+        ensure_ascii=False,
+        sort_keys=True
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class _Flight:
+    """一个进行中的上游流：后台线程生产数据块，多个订阅者按各自进度读取"""
+
+    def __init__(self, key, factory, on_finish):
+        self.key = key
+        self.chunks = []
+        self.done = False
+        self.subscribers = 0
+        self.cond = threading.Condition()
+        self.upstream_token = CancellationToken()
+        self._factory = factory
+        self._on_finish = on_finish
+        self._thread = threading.Thread(target=self._run, name="llm-single-flight", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        try:
+            for chunk in self._factory(self.upstream_token):
+                with self.cond:
+                    self.chunks.append(chunk)
+                    self.cond.notify_all()
+        except Exception as e:
+            logger.error(f"合并请求的上游流出错: {e}")
+            with self.cond:
+                self.chunks.append(StreamError(f"生成过程中出错: {str(e)}"))
+        finally:
+            with self.cond:
+                self.done = True
+                self.cond.notify_all()
+            self._on_finish(self)
+
+
+class _Subscription:
+    """挂到订阅者取消令牌上的对象：取消时唤醒正在等待数据块的订阅者"""
+
+    def __init__(self, flight):
+        self._flight = flight
+
+    def close(self):
+        with self._flight.cond:
+            self._flight.cond.notify_all()
+
+
+class SingleFlight:
+    """按请求键合并进行中的流式请求（线程安全）"""
+
+    def __init__(self):
+        self._flights = {}
+        self._lock = threading.Lock()
+        self.stats = {"upstream": 0, "coalesced": 0}
+
+    def in_flight(self, key):
+        """是否有相同的请求正在进行"""
+        with self._lock:
+            return key in self._flights
+
+    def stream(self, key, factory, cancel_token=None):
+        """订阅键对应的上游流，不存在时调用 factory(upstream_token) 创建；返回数据块生成器"""
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is None:
+                flight = _Flight(key, factory, self._finish)
+                self._flights[key] = flight
+                self.stats["upstream"] += 1
+            else:
+                self.stats["coalesced"] += 1
+                logger.info(f"合并相同的进行中请求 {key[:8]}（当前 {flight.subscribers + 1} 个订阅者）")
+            flight.subscribers += 1
+
+        if cancel_token is not None:
+            cancel_token.attach(_Subscription(flight))
+        try:
+            index = 0
+            while True:
+                with flight.cond:
+                    while index >= len(flight.chunks) and not flight.done:
+                        if cancel_token is not None and cancel_token.cancelled:
+                            return
+                        flight.cond.wait()
+                    pending = flight.chunks[index:]
+                if not pending:
+                    return
+                index += len(pending)
+                for chunk in pending:
+                    yield chunk
+                if cancel_token is not None and cancel_token.cancelled:
+                    return
+        finally:
+            if cancel_token is not None:
+                cancel_token.detach_all()
+            self._unsubscribe(flight)
+
+    def _unsubscribe(self, flight):
+        """订阅者离开：最后一个订阅者离开且上游未结束时取消上游请求"""
+        with self._lock:
+            flight.subscribers -= 1
+            abandoned = flight.subscribers <= 0 and not flight.done
+            if abandoned and self._flights.get(flight.key) is flight:
+                del self._flights[flight.key]
+        if abandoned:
+            flight.upstream_token.cancel("合并请求的所有订阅者已离开")
+
+    def _finish(self, flight):
+        """上游流结束，之后的相同请求重新发起"""
+        with self._lock:
+            if self._flights.get(flight.key) is flight:
+                del self._flights[flight.key]
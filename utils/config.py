@@ -12,7 +12,57 @@ DEFAULT_CONFIG = {
         "endpoint": "http://localhost:1314/api/chat",  # Ollama API端点，需要使用POST方法
         "max_retries": 3,                             # 最大重试次数
         "retry_delay": 1,                             # 初始重试延迟（秒）
-        "timeout": 30                                 # 初始超时时间（秒）
+        "timeout": 30,                                # 初始超时时间（秒）
+        "async_streaming": True,                      # 是否在共享事件循环上执行流式请求（需要aiohttp）
+        "models_refresh_interval": 300,               # 可用模型列表的刷新间隔（秒）
+        "endpoints": [],                              # 多个后端的API端点列表，为空时只使用 endpoint
+        # 多后端负载均衡与健康检查
+        "load_balancing": {
+            "strategy": "least_outstanding",  # least_outstanding（最少在途请求）或 latency_weighted（延迟加权）
+            "health_check_interval": 10,      # 健康检查间隔（秒），0 表示关闭
+            "health_check_timeout": 3,        # 健康检查超时（秒）
+            "unhealthy_threshold": 2,         # 连续失败多少次后摘除节点
+            "healthy_threshold": 1,           # 连续成功多少次后恢复节点
+            "model_affinity": True,           # 优先路由到已加载目标模型的节点（轮询 /api/ps）
+            "affinity_max_extra_load": 4      # 热节点比冷节点多出的在途请求超过该值时允许发往冷节点
+        },
+        "keep_alive": "30m",                          # Ollama 模型在显存中的保留时间
+        "retry_max_delay": 8,                         # 重试退避的最大等待时间（秒），实际等待在此范围内随机抖动
+        # 每个后端的熔断器：连续失败后快速失败，恢复时间后放行试探请求
+        "circuit_breaker": {
+            "failure_threshold": 3,     # 连续失败多少次后打开熔断器
+            "recovery_timeout": 15,     # 打开后多久进入半开状态（秒）
+            "half_open_max_calls": 1    # 半开状态下同时放行的试探请求数
+        },
+        # 对冲请求：首块耗时超过近期分位数时向另一个后端发送相同请求，先到者胜出（需要多个后端）
+        "hedging": {
+            "enabled": False,           # 是否启用对冲请求（会增加后端负载，对冲请求消耗重试预算）
+            "percentile": 95,           # 首块耗时分位数，超过该值仍未收到数据时发送对冲请求
+            "window": 200,              # 统计最近多少次请求的首块耗时
+            "min_samples": 20,          # 样本少于该值时使用 initial_delay
+            "initial_delay": 3.0,       # 样本不足时的对冲等待时间（秒）
+            "min_delay": 0.5            # 对冲等待时间下限（秒）
+        },
+        # 请求合并：温度不高于阈值时，相同的进行中流式请求共享同一个上游流
+        "coalescing": {
+            "enabled": True,
+            "max_temperature": 0.3      # 只合并温度不高于该值的请求（输出基本确定）
+        },
+        # 进程内共享的重试预算：重试次数不超过正常请求量的一定比例
+        "retry_budget": {
+            "ratio": 0.2,               # 每个请求增加的重试额度
+            "min_per_second": 0.5,      # 低流量时每秒补充的最低重试额度
+            "max_tokens": 10            # 重试额度上限
+        },
+        # 进程内共享的HTTP连接池
+        "pool": {
+            "max_connections": 64,           # 总连接数上限（异步客户端）
+            "max_connections_per_host": 32,  # 每个后端主机的连接数上限
+            "max_host_pools": 8,             # 缓存的主机连接池数量
+            "block_when_full": True,         # 连接池耗尽时等待而不是新建连接
+            "keepalive_timeout": 30,         # 空闲连接保活时间（秒）
+            "tcp_keepalive": True            # 启用TCP keep-alive探测
+        }
     },
     # 模型配置
     "models": {
@@ -40,22 +90,96 @@ DEFAULT_CONFIG = {
     # 界面配置
     "ui": {
         "theme": "dark",
-        "max_message_display": 50,  # 显示的最大消息数
-        "auto_scroll": True         # 自动滚动到最新消息
+        "history_page_size": 20,    # 聊天历史每页显示的消息数，更早的消息点击加载
+        "sidebar_chat_page_size": 20, # 侧边栏每次显示的对话数，更早的对话点击加载
+        # 历史消息的 Markdown 渲染缓存（需要 markdown 库）
+        "markdown_cache": {
+            "enabled": True,
+            "max_bytes": 16 * 1024 * 1024,  # 缓存占用的最大字节数，超过后按 LRU 淘汰
+            "min_length": 200          # 短于该长度的消息直接显示，不缓存
+        },
+        "auto_scroll": True,        # 自动滚动到最新消息
+        "stream_flush_interval_ms": 100,  # 流式回复两次刷新之间的基础间隔（毫秒）
+        "stream_max_flush_interval_ms": 500,  # 刷新间隔随回复长度增长的上限（毫秒）
+        "stream_flush_chars": 400,  # 待刷新字符数达到该值时立即刷新
+        "stream_boundary_flush_ms": 40  # 句子/代码块边界处提前刷新的最小间隔（毫秒）
+    },
+    # 后台生成配置：生成在工作线程中运行，界面轮询缓冲区渲染
+    "generation": {
+        "enabled": True,           # 关闭后在脚本线程中同步生成
+        "max_workers": 16,         # 后台生成线程数（模型并发仍由 scheduler 限制）
+        "ring_size": 256,          # 每个任务环形缓冲区保留的数据块数
+        "poll_interval": 0.3,      # 界面轮询缓冲区的间隔（秒），显示的刷新节奏仍由 ui.stream_flush_* 控制
+        "retention_seconds": 600   # 无人取走结果的已结束任务保留时间（秒）
+    },
+    # 聊天历史持久化：对话保存在 SQLite（WAL 模式）中，按需加载
+    "history": {
+        "enabled": True,               # 关闭后对话只保存在会话内存中
+        "path": "./data/chat_history.db",
+        "flush_interval": 0.5,         # 写队列最长等待多久提交一次（秒）
+        "batch_size": 500,             # 单个事务最多写入的修改数
+        "max_loaded_chats": 2,         # 每个会话在内存中保留的对话数
+        "search_max_candidates": 1000,  # 全文搜索时参与排序的候选消息数上限
+        "max_previews": 5,             # 对话摘要中保存的问题预览数（侧边栏不加载消息即可显示）
+        # 历史记录所有者：登录用户，或服务端签名的匿名 Cookie（签名密钥也可用环境变量 SMARTCHAT_SECRET 指定）
+        "identity": {
+            "secret_path": "./data/identity_secret",  # 签名密钥文件，不存在时自动生成
+            "cookie_name": "smartchat_owner",
+            "cookie_max_age_days": 365     # 匿名身份 Cookie 的有效期（天）
+        }
     },
     # 会话相关配置：控制上下文长度、输入节流和默认的简洁回复策略
     "conversation": {
-        "max_history_messages": 10,   # 发送到API的最近消息数（越大上下文越长）
+        "max_history_messages": 0,    # 发送到API的最近消息数上限（0 表示不限条数，只按 token 预算）
+        # 上下文打包：按模型 context_window - max_tokens 的 token 预算选择历史消息
+        "context_packing": {
+            "enabled": True,
+            "tokens_per_cjk_char": 1.0,   # 每个中日韩字符估算的 token 数
+            "chars_per_token": 4.0,       # 其它字符每个 token 的平均字符数
+            "message_overhead": 4,        # 每条消息的格式开销
+            "reserve_tokens": 256,        # 预留给估算误差的 token 数
+            "min_prompt_tokens": 1024     # max_tokens 接近上下文长度时提示词至少保留的预算
+        },
+        # 滚动摘要：未摘要的历史过长时在后台把早期轮次折叠为摘要
+        "summarization": {
+            "enabled": True,
+            "model": "qwen2.5:3b",        # 生成摘要使用的轻量模型
+            "trigger_ratio": 0.6,         # 未摘要历史超过 token 预算的该比例时触发
+            "keep_ratio": 0.3,            # 摘要后保留原文的最近历史占预算的比例
+            "max_summary_tokens": 512,    # 摘要的目标长度
+            "temperature": 0.2,
+            "max_workers": 2              # 后台摘要线程数
+        },
         "cooldown_seconds": 1.0,      # 连续发送时的最小间隔（秒）
         "post_generate_cooldown_seconds": 2.0, # 生成完成后前端应等待的秒数
         "generating_watchdog_timeout": 5.0,    # 生成被认为卡住前的超时时间（秒）
         "concise_by_default": True    # 是否默认要求简洁回复（true=简洁，false=详细）
     },
+    # 请求调度：进程内所有会话共享的并发上限与公平排队
+    "scheduler": {
+        "enabled": True,
+        "max_concurrent_per_model": 2,  # 每个健康后端上每个模型同时进行的生成数上限（总上限随后端数增加）
+        "model_limits": {},             # 按模型覆盖每个后端的并发上限，如 {"deepseek-r1:8b": 1}
+        "max_background_per_model": 1,  # 后台任务（对话摘要）每个模型的单独名额，有前台请求排队时让出
+        "max_queue_size": 50,           # 每个模型的最大排队数，超过时拒绝新请求
+        "queue_timeout": 120,           # 最长排队时间（秒）
+        "poll_interval": 0.5,           # 排队期间刷新队列位置的间隔（秒）
+        "prioritize_short_prompts": True,  # 短小简单的提问优先处理
+        "priority_aging_seconds": 10    # 普通请求排队超过该时间后提升为高优先级
+    },
     # 缓存配置
     "cache": {
         "enabled": True,
         "ttl": 3600,               # 缓存生存时间（秒）
-        "max_entries": 100         # 最大缓存条目数
+        "max_entries": 1000,       # 最大缓存条目数（超过后按 LRU 淘汰）
+        "semantic": False,         # 精确匹配未命中时做近似匹配（需要 numpy；哈希向量不理解语义，只放宽词序和标点）
+        "similarity_threshold": 0.98,  # 近似命中的最低余弦相似度
+        "max_token_diff": 0,       # 近似命中允许相差的词数（中日韩单字或拉丁单词）
+        "standalone_only": True,   # 只缓存没有前文的独立提问
+        "backend": "sqlite",       # 存储后端：memory（进程内）或 sqlite（磁盘，多进程共享）
+        "path": "./data/response_cache.db",  # sqlite 后端的数据库文件
+        "compress_level": 6,       # 条目的 zlib 压缩级别
+        "index_refresh_seconds": 5  # 语义索引刷新间隔，其它进程写入的条目在该时间内可见
     }
 }
 
@@ -0,0 +1,111 @@
+"""
+上下文打包 - 按模型的 token 预算选择发送给后端的历史消息
+
+预算为模型的 context_window 减去本次的 max_tokens（max_tokens 过大、提示词预算低于下限时调低 max_tokens）：系统提示词、对话摘要和最新的用户消息总是保留，
+其余历史消息从新到旧依次放入，直到预算用完。token 数用按字符类型校准的估算器计算
+（中日韩字符约 1 个 token，拉丁文字约 4 个字符 1 个 token），每条消息的估算结果按内容缓存，
+重新打包时只需计算新增的消息。
+"""
+import logging
+import re
+import threading
+from collections import OrderedDict
+from utils.config import CONFIG
+
+logger = logging.getLogger(__name__)
+
+_CJK_CHAR = re.compile(r"[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uff00-\uffef]")
+
+
+class ContextPacker:
+    """按 token 预算打包历史消息（线程安全）"""
+
+    def __init__(self, config=None, models=None):
+        config = config or {}
+        self.enabled = bool(config.get("enabled", True))
+        # 估算器校准参数
+        self.tokens_per_cjk_char = float(config.get("tokens_per_cjk_char", 1.0))
+        self.chars_per_token = float(config.get("chars_per_token", 4.0))
+        # 每条消息的格式开销（角色标记等）
+        self.message_overhead = int(config.get("message_overhead", 4))
+        # 预留给估算误差的 token 数
+        self.reserve_tokens = int(config.get("reserve_tokens", 256))
+        # max_tokens 接近上下文长度时，提示词至少保留的预算
+        self.min_prompt_tokens = int(config.get("min_prompt_tokens", 1024))
+        self.default_context_window = int(config.get("default_context_window", 4096))
+        self.models = models or {}
+        self._counts = OrderedDict()
+        self._max_cached = int(config.get("max_cached_messages", 10000))
+        self._lock = threading.Lock()
+
+    def estimate_tokens(self, text):
+        """估算文本的 token 数"""
+        if not text:
+            return 0
+        cjk = len(_CJK_CHAR.findall(text))
+        other = len(text) - cjk
+        return int(cjk * self.tokens_per_cjk_char + other / self.chars_per_token) + 1
+
+    def message_tokens(self, message):
+        """返回一条消息的 token 数（按内容缓存）"""
+        content = message.get("content") or ""
+        with self._lock:
+            count = self._counts.get(content)
+            if count is not None:
+                self._counts.move_to_end(content)
+                return count
+        count = self.estimate_tokens(content) + self.message_overhead
+        with self._lock:
+            self._counts[content] = count
+            if len(self._counts) > self._max_cached:
+                self._counts.popitem(last=False)
+        return count
+
+    def context_window(self, model):
+        """返回模型的上下文长度（token）"""
+        return int(self.models.get(model, {}).get("context_window", self.default_context_window))
+
+    def _prompt_floor(self, context_window):
+        return min(self.min_prompt_tokens, context_window // 2)
+
+    def output_tokens_for(self, model, max_tokens):
+        """返回本次实际使用的 max_tokens：提示词预算低于下限时调低生成长度，保证两者之和不超过上下文长度"""
+        context_window = self.context_window(model)
+        limit = context_window - self.reserve_tokens - self._prompt_floor(context_window)
+        return max(1, min(int(max_tokens), limit))
+
+    def budget_for(self, model, max_tokens):
+        """返回模型本次请求可用于提示词的 token 数（max_tokens 按 output_tokens_for 调整后计算）"""
+        context_window = self.context_window(model)
+        return context_window - self.output_tokens_for(model, max_tokens) - self.reserve_tokens
+
+    def pack(self, system_prompt, messages, model, max_tokens, max_messages=0, summary_message=None):
+        """返回 [系统提示词, 对话摘要] + 预算内最近的历史消息；max_messages 大于 0 时同时限制消息条数"""
+        prefix = [{"role": "system", "content": system_prompt}]
+        if summary_message is not None:
+            prefix.append(summary_message)
+        if not self.enabled:
+            recent = messages[-max_messages:] if max_messages > 0 else list(messages)
+            return prefix + recent
+
+        remaining = self.budget_for(model, max_tokens) - sum(self.message_tokens(m) for m in prefix)
+        selected = []
+        for message in reversed(messages):
+            if max_messages > 0 and len(selected) >= max_messages:
+                break
+            tokens = self.message_tokens(message)
+            # 最新的一条消息总是保留，其余放不下就停止（不跳过中间的消息，保持对话连贯）
+            if selected and tokens > remaining:
+                break
+            selected.append(message)
+            remaining -= tokens
+        selected.reverse()
+
+        dropped = len(messages) - len(selected)
+        if dropped:
+            logger.debug(f"上下文打包: 保留 {len(selected)} 条消息，省略更早的 {dropped} 条，剩余预算 {remaining}")
+        return prefix + selected
+
+
+# 创建全局上下文打包器
+context_packer = ContextPacker(CONFIG.get("conversation", {}).get("context_packing", {}), CONFIG.get("models", {}))
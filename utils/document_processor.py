@@ -1,11 +1,19 @@
 import os
 import base64
 import hashlib
+import logging
 import streamlit as st
 import requests
 import sys
 import tempfile
+from concurrent.futures import ThreadPoolExecutor
 from utils.config import CONFIG
+from utils.scheduler import request_scheduler, AdmissionError
+
+logger = logging.getLogger(__name__)
+
+# PDF文字层中可打印字符的最低比例，低于该比例视为乱码
+_MIN_PRINTABLE_RATIO = 0.9
 
 # 确保临时目录存在
 def ensure_temp_dir():
@@ -23,8 +31,14 @@ class DocumentProcessor:
         self.temp_dir = ensure_temp_dir()
         self.vision_model = "granite3.2-vision:latest"  # 使用官方提供的视觉模型
         self.ollama_api = "http://localhost:1314/api/generate" 
+        # OCR 直接请求上面的单个本地服务，视觉模型的并发上限不能按后端池中的后端数放大
+        request_scheduler.mark_unpooled(self.vision_model)
         self.cache = {}  # 简单的缓存字典
         self.cache_size = CONFIG.get("document_processing", {}).get("cache_size", 10)
+        # 同一文档同时渲染/识别的页数（视觉模型的总并发由 scheduler 按模型限制）
+        self.ocr_concurrency = max(1, int(CONFIG.get("document_processing", {}).get("ocr_concurrency", 4)))
+        # 每页文字层至少包含的非空白字符数，不足的页面（扫描件、图片页）交给视觉模型识别
+        self.text_layer_min_chars = int(CONFIG.get("document_processing", {}).get("text_layer_min_chars", 50))
         
     def process_document(self, uploaded_file, max_pages=10):
         """处理上传的文档（支持Word/PDF/图片）"""
@@ -121,64 +135,92 @@ class DocumentProcessor:
             return error_msg
     
     def _process_pdf_document(self, pdf_path, max_pages):
-        """处理PDF文档并提取文本"""
+        """处理PDF文档并提取文本：有文字层的页面直接提取，只有扫描/图片页面交给视觉模型识别"""
         # 获取URL参数中的语言设置
         query_params = st.query_params
         url_lang = query_params.get("lang", "zh")
         is_chinese = url_lang == "zh"
         
         try:
-            # 尝试使用pdf2image提取图像
+            # 逐页提取文字层，None 表示该页需要识别
+            page_texts = self._extract_pdf_text_layer(pdf_path, max_pages)
+            if page_texts is not None and all(text is not None for text in page_texts):
+                return "\n\n".join(page_texts)
+            
+            # 尝试使用pdf2image把需要识别的页面渲染为图片
             try:
-                from pdf2image import convert_from_path
-                
-                # 转换PDF为图片
-                images = convert_from_path(
-                    pdf_path,
-                    first_page=1,
-                    last_page=max_pages
-                )
+                from pdf2image import convert_from_path, pdfinfo_from_path
                 
-                # 成功转换
-                image_paths = []
+                if page_texts is None:
+                    # 无法读取文字层时所有页面都识别
+                    page_count = min(max_pages, int(pdfinfo_from_path(pdf_path)["Pages"]))
+                    page_texts = [None] * page_count
                 
-                # 保存转换后的图片
-                for i, img in enumerate(images):
-                    img_path = os.path.join(self.temp_dir, f"page_{i}_{os.path.basename(pdf_path)}.jpg")
-                    img.save(img_path, "JPEG")
-                    image_paths.append(img_path)
-                
-                # 处理所有图片
-                return self._process_images(image_paths)
+                # 每页单独渲染并识别，多页并行处理
+                ocr_pages = [i + 1 for i, text in enumerate(page_texts) if text is None]
+                tasks = [
+                    lambda page=page: self._render_pdf_page(convert_from_path, pdf_path, page)
+                    for page in ocr_pages
+                ]
+                for page, text in zip(ocr_pages, self._ocr_in_parallel(tasks, is_chinese)):
+                    page_texts[page - 1] = text
+                return "\n\n".join(page_texts)
                 
             except ImportError:
-                # 如果pdf2image不可用，尝试使用PyPDF2
-                try:
-                    import PyPDF2
-                    reader = PyPDF2.PdfReader(pdf_path)
-                    text = ""
-                    for i, page in enumerate(reader.pages):
-                        if i >= max_pages:
-                            break
-                        text += page.extract_text() + "\n\n"
-                    
-                    if text.strip():
-                        return text
-                    else:
-                        # 如果没有提取到文本，可能是图像PDF
-                        return self._process_images([pdf_path])
-                        
-                except ImportError:
-                    # 如果两个库都不可用，使用图像处理
+                # pdf2image不可用：使用已提取到的文字，完全没有文字时把整个文件交给图像处理
+                extracted = [text for text in (page_texts or []) if text]
+                if extracted:
+                    return "\n\n".join(extracted)
+                if page_texts is None:
                     st.warning("PDF处理库未安装，使用图像处理方式提取PDF内容" if is_chinese else 
                               "PDF processing libraries not installed, using image-based processing")
-                    return self._process_images([pdf_path])
+                return self._process_images([pdf_path])
                     
         except Exception as e:
             error_msg = f"处理PDF文档时出错: {str(e)}" if is_chinese else f"Error processing PDF document: {str(e)}"
             st.error(error_msg)
             return error_msg
     
+    def _extract_pdf_text_layer(self, pdf_path, max_pages):
+        """用PyPDF2逐页提取文字层；文字足够多的页面返回文本，其余为 None。PyPDF2不可用时返回 None"""
+        try:
+            import PyPDF2
+        except ImportError:
+            return None
+        
+        # 损坏或不规范的文件（例如缺少 EOF 标记、交叉引用表损坏）在打开时就会出错，此时所有页面交给 OCR
+        try:
+            reader = PyPDF2.PdfReader(pdf_path)
+            page_count = min(max_pages, len(reader.pages))
+        except Exception as e:
+            logger.warning(f"无法读取PDF文字层，改用OCR: {type(e).__name__}: {e}")
+            return None
+        page_texts = []
+        for i in range(page_count):
+            try:
+                text = reader.pages[i].extract_text() or ""
+            except Exception as e:
+                # 单页解析失败只影响该页，标记为需要OCR
+                logger.warning(f"PDF第 {i + 1} 页文字提取失败，改用OCR: {type(e).__name__}: {e}")
+                text = ""
+            page_texts.append(text if self._has_text_layer(text) else None)
+        return page_texts
+    
+    def _has_text_layer(self, text):
+        """判断提取到的文字是否可用：非空白字符足够多，且大部分是可打印字符（排除字体编码缺失产生的乱码）"""
+        chars = [c for c in text if not c.isspace()]
+        if len(chars) < self.text_layer_min_chars:
+            return False
+        printable = sum(1 for c in chars if c.isprintable() and c != "\ufffd")
+        return printable / len(chars) >= _MIN_PRINTABLE_RATIO
+    
+    def _render_pdf_page(self, convert_from_path, pdf_path, page):
+        """把PDF的一页渲染为图片，返回图片路径"""
+        images = convert_from_path(pdf_path, first_page=page, last_page=page)
+        img_path = os.path.join(self.temp_dir, f"page_{page - 1}_{os.path.basename(pdf_path)}.jpg")
+        images[0].save(img_path, "JPEG")
+        return img_path
+    
     def _process_images(self, image_paths):
         """处理图片列表并提取文本内容"""
         # 获取URL参数中的语言设置
@@ -186,44 +228,57 @@ class DocumentProcessor:
         url_lang = query_params.get("lang", "zh")
         is_chinese = url_lang == "zh"
         
-        parsed_text = []
-        
-        total_images = len(image_paths)
+        tasks = [lambda path=path: path for path in image_paths]
+        return "\n\n".join(self._ocr_in_parallel(tasks, is_chinese))
+    
+    def _ocr_in_parallel(self, tasks, is_chinese):
+        """并行执行识别任务并按原顺序返回文本；每个任务是一个返回图片路径的函数（可在其中渲染页面）"""
+        # 工作线程中不能访问 st.query_params / st.session_state，需要的值在这里读取
+        session_id = st.session_state.get("session_id", "default")
+        # 构建适合当前语言的提示词
+        prompt = "提取此文档中的所有文字内容，保持原格式" if is_chinese else "Extract all text content from this document, maintaining the original format"
         
-        for i, img_path in enumerate(image_paths):
+        def run(task):
             try:
-                # 转换图片为base64
-                with open(img_path, "rb") as f:
-                    img_base64 = base64.b64encode(f.read()).decode()
-                
-                # 构建适合当前语言的提示词
-                prompt = "提取此文档中的所有文字内容，保持原格式" if is_chinese else "Extract all text content from this document, maintaining the original format"
-                
-                # 调用模型解析
-                response = requests.post(
-                    self.ollama_api,
-                    json={
-                        "model": self.vision_model,
-                        "prompt": prompt,
-                        "images": [img_base64],
-                        "stream": False
-                    },
-                    timeout=60
-                )
-                
-                # 检查响应状态
-                if response.status_code == 200:
-                    result = response.json()
-                    parsed_text.append(result.get("response", ""))
-                else:
-                    error_msg = f"API请求失败: HTTP {response.status_code}" if is_chinese else f"API request failed: HTTP {response.status_code}"
-                    parsed_text.append(error_msg)
-                    
+                img_path = task()
+                # 视觉模型的并发名额与聊天请求共用 scheduler 的按模型限制
+                with request_scheduler.slot(self.vision_model, session_id):
+                    return self._ocr_image(img_path, prompt, is_chinese)
+            except AdmissionError as e:
+                return f"视觉模型繁忙: {str(e)}" if is_chinese else f"Vision model busy: {str(e)}"
             except Exception as e:
-                error_msg = f"处理图片时出错: {str(e)}" if is_chinese else f"Error processing image: {str(e)}"
-                parsed_text.append(error_msg)
-                
-        return "\n\n".join(parsed_text)
+                return f"处理图片时出错: {str(e)}" if is_chinese else f"Error processing image: {str(e)}"
+        
+        if len(tasks) <= 1 or self.ocr_concurrency <= 1:
+            return [run(task) for task in tasks]
+        
+        with ThreadPoolExecutor(max_workers=min(self.ocr_concurrency, len(tasks)), thread_name_prefix="doc-ocr") as executor:
+            # map 按提交顺序返回结果，页面顺序不变
+            return list(executor.map(run, tasks))
+    
+    def _ocr_image(self, img_path, prompt, is_chinese):
+        """调用视觉模型识别一张图片中的文字"""
+        # 转换图片为base64
+        with open(img_path, "rb") as f:
+            img_base64 = base64.b64encode(f.read()).decode()
+        
+        # 调用模型解析
+        response = requests.post(
+            self.ollama_api,
+            json={
+                "model": self.vision_model,
+                "prompt": prompt,
+                "images": [img_base64],
+                "stream": False
+            },
+            timeout=60
+        )
+        
+        # 检查响应状态
+        if response.status_code == 200:
+            result = response.json()
+            return result.get("response", "")
+        return f"API请求失败: HTTP {response.status_code}" if is_chinese else f"API request failed: HTTP {response.status_code}"
     
     def generate_document_enhanced_response(self, prompt, document_text, model):
         """基于文档内容生成增强回复"""
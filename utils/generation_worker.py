@@ -0,0 +1,175 @@
+"""
+后台生成 - 生成请求在工作线程池中运行，与 Streamlit 脚本的运行解耦
+
+每个会话同一时间最多有一个生成任务，任务把数据块写入自己的环形缓冲区；
+界面脚本只从缓冲区轮询读取并渲染，不在脚本线程里等待网络。点击控件、切换语言等
+导致的页面重新运行不会中断生成，重新运行（或带相同会话标识重新打开页面）后
+可以继续显示进行中的回复。每个进行中的生成占用一个工作线程直到流式结束。
+"""
+import logging
+import threading
+import time
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from utils.cancellation import CancellationToken, CancelledError
+from utils.config import CONFIG
+from utils.stream_decoder import StreamError
+
+logger = logging.getLogger(__name__)
+
+# 任务状态
+STATUS_QUEUED = "queued"
+STATUS_RUNNING = "running"
+STATUS_DONE = "done"
+STATUS_FAILED = "failed"
+STATUS_CANCELLED = "cancelled"
+
+_FINISHED = (STATUS_DONE, STATUS_FAILED, STATUS_CANCELLED)
+
+
+class GenerationJob:
+    """一个后台生成任务：数据块写入环形缓冲区，读取方按游标增量读取"""
+
+    def __init__(self, session_id, chat_id, prompt, ring_size=256, meta=None):
+        self.id = uuid.uuid4().hex
+        self.session_id = session_id
+        self.chat_id = chat_id
+        self.prompt = prompt
+        # 任务完成后界面处理结果时需要的附加信息（缓存作用域等）
+        self.meta = meta or {}
+        self.status = STATUS_QUEUED
+        self.queue_position = None
+        self.error = None
+        # 是否收到过 StreamError（出错的回复不写入缓存）
+        self.stream_failed = False
+        self.cancel_token = CancellationToken()
+        self.created_at = time.time()
+        self.last_activity = self.created_at
+        self.finished_at = None
+        # 环形缓冲区保存最近的数据块及其序号，溢出的数据块合并到 _prefix
+        self._ring = deque()
+        self._ring_size = max(1, int(ring_size))
+        self._prefix = []
+        self._seq = 0
+        self._lock = threading.Lock()
+
+    @property
+    def finished(self):
+        return self.status in _FINISHED
+
+    def set_queue_position(self, position):
+        """排队期间更新队列位置；任务已取消时抛出 CancelledError 以退出排队"""
+        self.cancel_token.raise_if_cancelled()
+        self.queue_position = position
+        self.last_activity = time.time()
+
+    def append(self, chunk):
+        """写入一个数据块"""
+        if not chunk:
+            return
+        with self._lock:
+            if isinstance(chunk, StreamError):
+                self.stream_failed = True
+            self._ring.append((self._seq, chunk))
+            self._seq += 1
+            if len(self._ring) > self._ring_size:
+                self._prefix.append(self._ring.popleft()[1])
+            self.status = STATUS_RUNNING
+            self.last_activity = time.time()
+
+    def read(self, cursor=0):
+        """读取游标之后的新内容，返回 (文本, 新游标, 是否为完整文本)；游标已滑出缓冲区时返回完整文本"""
+        with self._lock:
+            if cursor >= self._seq:
+                return "", self._seq, False
+            oldest = self._ring[0][0] if self._ring else self._seq
+            if cursor < oldest:
+                return self._snapshot(), self._seq, True
+            return "".join(chunk for seq, chunk in self._ring if seq >= cursor), self._seq, False
+
+    def snapshot(self):
+        """返回目前为止的完整文本"""
+        with self._lock:
+            return self._snapshot()
+
+    def _snapshot(self):
+        if len(self._prefix) > 1:
+            self._prefix = ["".join(self._prefix)]
+        return "".join(self._prefix) + "".join(chunk for _, chunk in self._ring)
+
+    def finish(self, status, error=None):
+        self.error = error
+        self.finished_at = time.time()
+        self.status = status
+
+
+class GenerationManager:
+    """后台生成任务的线程池与按会话的任务表（线程安全）"""
+
+    def __init__(self, config=None):
+        config = config or {}
+        self.enabled = bool(config.get("enabled", True))
+        self.ring_size = int(config.get("ring_size", 256))
+        self.poll_interval = float(config.get("poll_interval", 0.3))
+        # 已结束但没有界面取走结果的任务保留多久（秒），例如页面已关闭
+        self.retention = float(config.get("retention_seconds", 600))
+        self._executor = ThreadPoolExecutor(
+            max_workers=int(config.get("max_workers", 16)),
+            thread_name_prefix="llm-generation"
+        )
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def submit(self, session_id, chat_id, prompt, work, meta=None):
+        """提交生成任务，work(job) 在工作线程中运行并调用 job.append() 写入数据块；同一会话的旧任务会被取消"""
+        job = GenerationJob(session_id, chat_id, prompt, self.ring_size, meta)
+        with self._lock:
+            self._prune()
+            previous = self._jobs.get(session_id)
+            self._jobs[session_id] = job
+        if previous is not None and not previous.finished:
+            previous.cancel_token.cancel("同一会话提交了新的生成")
+        self._executor.submit(self._run, job, work)
+        return job
+
+    def _run(self, job, work):
+        try:
+            work(job)
+        except CancelledError:
+            pass
+        except Exception as e:
+            logger.error(f"后台生成失败: {e}")
+            job.finish(STATUS_FAILED, e)
+            return
+        finally:
+            job.cancel_token.detach_all()
+        job.finish(STATUS_CANCELLED if job.cancel_token.cancelled else STATUS_DONE)
+
+    def get(self, session_id):
+        """返回会话当前的任务（可能已结束但结果尚未被取走），没有时返回 None"""
+        with self._lock:
+            return self._jobs.get(session_id)
+
+    def cancel(self, session_id, reason=""):
+        """取消会话进行中的任务"""
+        job = self.get(session_id)
+        if job is not None and not job.finished:
+            job.cancel_token.cancel(reason)
+        return job
+
+    def discard(self, session_id, job):
+        """界面已处理任务结果，从任务表中移除"""
+        with self._lock:
+            if self._jobs.get(session_id) is job:
+                del self._jobs[session_id]
+
+    def _prune(self):
+        """清理超过保留时间的已结束任务（调用方持有锁）"""
+        now = time.time()
+        for session_id in [s for s, j in self._jobs.items() if j.finished and now - j.finished_at > self.retention]:
+            del self._jobs[session_id]
+
+
+# 创建全局后台生成管理器（进程内所有会话共享）
+generation_manager = GenerationManager(CONFIG.get("generation", {}))
@@ -0,0 +1,88 @@
+"""
+对冲请求 - 降低首个数据块（TTFT）的尾延迟
+
+记录最近流式请求的首块耗时，当前请求超过其分位数仍未收到首个数据块时，
+向另一个后端发送一份相同的请求，先收到数据的一方胜出，另一方被取消。
+"""
+import logging
+import threading
+import time
+from collections import deque
+from utils.cancellation import CancelledError, abort_response
+
+logger = logging.getLogger(__name__)
+
+
+class TTFTTracker:
+    """滑动窗口内的首块耗时统计，用于计算对冲等待时间"""
+
+    def __init__(self, window=200, percentile=95, min_samples=20, initial_delay=3.0, min_delay=0.5):
+        self.percentile = float(percentile)
+        self.min_samples = int(min_samples)
+        self.initial_delay = float(initial_delay)
+        self.min_delay = float(min_delay)
+        self._samples = deque(maxlen=int(window))
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._samples)
+
+    def record(self, seconds):
+        """记录一次首块耗时"""
+        with self._lock:
+            self._samples.append(seconds)
+
+    def quantile(self, percentile=None):
+        """返回指定分位数的首块耗时，没有样本时返回 None"""
+        with self._lock:
+            samples = sorted(self._samples)
+        if not samples:
+            return None
+        p = self.percentile if percentile is None else percentile
+        index = min(len(samples) - 1, int(round(p / 100.0 * (len(samples) - 1))))
+        return samples[index]
+
+    def hedge_delay(self):
+        """发送对冲请求前的等待时间：样本不足时使用初始值"""
+        if len(self) < self.min_samples:
+            return max(self.min_delay, self.initial_delay)
+        return max(self.min_delay, self.quantile())
+
+
+class StreamAttempt:
+    """一次流式请求尝试：在后台线程中发送请求并读取第一个数据块，结果放入共享队列"""
+
+    def __init__(self, backend, open_fn, results):
+        self.backend = backend
+        self.started_at = time.time()
+        self.response = None
+        self.cancelled = False
+        self._open_fn = open_fn
+        self._results = results
+        self._thread = threading.Thread(target=self._run, name="llm-hedge-attempt", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        try:
+            response = self._open_fn()
+            self.response = response
+            if self.cancelled:
+                response.close()
+                raise CancelledError("请求已取消")
+            response.raise_for_status()
+            chunks = iter(response.iter_content(chunk_size=None))
+            first = next(chunks, b"")
+            self._results.put((self, chunks, first, None))
+        except Exception as e:
+            self._results.put((self, None, None, e))
+
+    def cancel(self):
+        """取消该尝试：中断底层连接让后端停止生成，并在后台关闭响应"""
+        self.cancelled = True
+        response = self.response
+        if response is not None:
+            abort_response(response)
+
+    def close(self):
+        """与响应对象一致的关闭接口，便于挂载到取消令牌上"""
+        self.cancel()
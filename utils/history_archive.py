@@ -0,0 +1,123 @@
+"""
+聊天历史归档 - 以流式方式导出、导入对话记录，用于在节点之间迁移用户数据
+
+归档格式：文件头 MAGIC，之后是一条条记录，每条记录为 4 字节大端长度 + zlib 压缩的 JSON。
+记录有两种：
+    {"type": "chat", "id", "title", "created_at", "updated_at", "summary", "model_changes"}
+    {"type": "messages", "chat_id", "seq": 起始序号, "messages": [[role, content, created_at], ...]}
+一个对话的消息按批次拆成多条 messages 记录，导出和导入都是生成器，内存中最多只有一批消息，
+几 GB 的归档也以恒定内存处理。导入时通过 HistoryStore.bulk_load 分批写入数据库，
+已有的同 ID 对话整体替换为归档中的内容，重复导入同一归档是幂等的。
+
+用法:
+    python -m utils.history_archive export <owner> chats.sca
+    python -m utils.history_archive import <owner> chats.sca
+
+owner 是服务端签发的所有者标识（登录用户为 user:<邮箱>，匿名用户为 anon:<id>），见 utils/identity.py。
+"""
+import argparse
+import json
+import struct
+import sys
+import zlib
+
+MAGIC = b"SMARTCHAT-HISTORY\x01"
+
+_LENGTH = struct.Struct(">I")
+
+# 单条记录的大小上限，超过时认为文件已损坏
+MAX_RECORD_BYTES = 256 * 1024 * 1024
+
+
+class ArchiveError(Exception):
+    """归档文件格式错误"""
+
+
+def encode_record(record, level=6):
+    """把一条记录编码为 长度 + 压缩数据"""
+    payload = zlib.compress(json.dumps(record, ensure_ascii=False, separators=(",", ":")).encode("utf-8"), level)
+    return _LENGTH.pack(len(payload)) + payload
+
+
+def export_records(store, owner, batch_size=500):
+    """逐条生成用户所有对话的归档记录"""
+    for chat in store.iter_chats(owner):
+        yield dict(chat, type="chat", model_changes=store.load_model_changes(chat["id"]))
+        for rows in store.iter_messages(chat["id"], batch_size):
+            yield {
+                "type": "messages",
+                "chat_id": chat["id"],
+                "seq": rows[0][0],
+                "messages": [[role, content, created_at] for _, role, content, created_at in rows]
+            }
+
+
+def export_archive(store, owner, batch_size=500, level=6):
+    """生成归档文件的字节块（文件头 + 每条记录一块），可直接写入文件或作为下载流"""
+    yield MAGIC
+    for record in export_records(store, owner, batch_size):
+        yield encode_record(record, level)
+
+
+def read_records(stream):
+    """从文件对象中逐条读取归档记录"""
+    if stream.read(len(MAGIC)) != MAGIC:
+        raise ArchiveError("不是聊天历史归档文件")
+    while True:
+        header = stream.read(_LENGTH.size)
+        if not header:
+            return
+        if len(header) < _LENGTH.size:
+            raise ArchiveError("归档文件在记录头处被截断")
+        (length,) = _LENGTH.unpack(header)
+        if length > MAX_RECORD_BYTES:
+            raise ArchiveError(f"记录长度异常: {length}")
+        payload = stream.read(length)
+        if len(payload) < length:
+            raise ArchiveError("归档文件在记录内容处被截断")
+        try:
+            yield json.loads(zlib.decompress(payload))
+        except (zlib.error, ValueError) as e:
+            raise ArchiveError(f"无法解析记录: {e}") from e
+
+
+def import_archive(store, owner, stream, batch_size=5000):
+    """把归档导入到用户名下，返回 (对话数, 消息数)"""
+    return store.bulk_load(owner, read_records(stream), batch_size)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="导出或导入聊天历史归档")
+    parser.add_argument("action", choices=["export", "import"])
+    parser.add_argument("owner", help="历史记录的所有者标识（user:<邮箱> 或 anon:<id>）")
+    parser.add_argument("path", help="归档文件路径，- 表示标准输入/输出")
+    parser.add_argument("--level", type=int, default=6, help="导出时的 zlib 压缩级别")
+    args = parser.parse_args(argv)
+
+    from utils.history_store import history_store
+    if history_store is None:
+        parser.error("聊天历史存储未启用（config.json 中 history.enabled）")
+
+    if args.action == "export":
+        stream = sys.stdout.buffer if args.path == "-" else open(args.path, "wb")
+        try:
+            for chunk in export_archive(history_store, args.owner, level=args.level):
+                stream.write(chunk)
+        finally:
+            if stream is not sys.stdout.buffer:
+                stream.close()
+        print(f"已导出用户 {args.owner} 的对话到 {args.path}", file=sys.stderr)
+    else:
+        stream = sys.stdin.buffer if args.path == "-" else open(args.path, "rb")
+        try:
+            chats, messages = import_archive(history_store, args.owner, stream)
+        except ArchiveError as e:
+            parser.exit(1, f"导入失败（已提交的对话会保留，重新导入同一归档会替换它们，不会产生重复）: {e}\n")
+        finally:
+            if stream is not sys.stdin.buffer:
+                stream.close()
+        print(f"已导入 {chats} 个对话、{messages} 条消息", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
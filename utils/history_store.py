@@ -0,0 +1,728 @@
+"""
+聊天历史存储 - 对话记录持久化到 SQLite（WAL 模式），按需加载
+
+对话、消息和模型切换记录分别保存在 chats、messages、model_changes 三张表中。
+st.session_state.chat_histories 使用 ChatHistories 映射：侧边栏只读取对话摘要，
+对话的消息在打开时才加载，每个会话在内存中只保留最近打开的少数几个对话。
+chats 表同时保存前几个用户问题的预览，侧边栏不加载消息即可显示对话标题和问题列表。
+对对话记录的修改（追加消息、修改标题、写入摘要等）先进入写队列，
+由后台线程按批次在一个事务中写入数据库。
+
+消息内容同时写入倒排索引（postings 表：词 -> 对话、消息序号、词频），
+侧边栏的全文搜索通过索引查询，不扫描消息。
+"""
+import datetime
+import itertools
+import json
+import logging
+import math
+import os
+import queue
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from collections.abc import MutableMapping
+from utils.config import CONFIG
+from utils.search_index import term_frequencies, query_terms, snippet
+
+logger = logging.getLogger(__name__)
+
+_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS chats (
+        id TEXT PRIMARY KEY,
+        owner TEXT NOT NULL,
+        title TEXT NOT NULL DEFAULT '',
+        created_at REAL NOT NULL,
+        updated_at REAL NOT NULL,
+        message_count INTEGER NOT NULL DEFAULT 0,
+        summary TEXT,
+        previews TEXT
+    );
+    CREATE INDEX IF NOT EXISTS idx_chats_owner ON chats (owner, created_at);
+    CREATE TABLE IF NOT EXISTS messages (
+        chat_id TEXT NOT NULL,
+        seq INTEGER NOT NULL,
+        role TEXT NOT NULL,
+        content TEXT NOT NULL,
+        created_at REAL NOT NULL,
+        PRIMARY KEY (chat_id, seq)
+    );
+    CREATE TABLE IF NOT EXISTS model_changes (
+        chat_id TEXT NOT NULL,
+        seq INTEGER NOT NULL,
+        data TEXT NOT NULL,
+        PRIMARY KEY (chat_id, seq)
+    );
+    CREATE TABLE IF NOT EXISTS postings (
+        term TEXT NOT NULL,
+        chat_id TEXT NOT NULL,
+        seq INTEGER NOT NULL,
+        tf INTEGER NOT NULL,
+        PRIMARY KEY (term, chat_id, seq)
+    ) WITHOUT ROWID;
+    CREATE INDEX IF NOT EXISTS idx_postings_message ON postings (chat_id, seq);
+"""
+
+# 数据库结构版本：1 = 已为旧消息建立倒排索引，2 = 对话摘要中保存问题预览
+_SCHEMA_VERSION = 2
+
+# 搜索排序参数：词频饱和系数
+_TF_SATURATION = 1.2
+
+_INSERT_POSTING = "INSERT INTO postings (term, chat_id, seq, tf) VALUES (?, ?, ?, ?)"
+
+
+# 问题预览：标题截取前 15 个字符，预览截取前 30 个字符，超过时加省略号
+_TITLE_CHARS = 15
+_PREVIEW_CHARS = 30
+
+
+def question_preview(content):
+    """返回一条用户消息在侧边栏中的标题和预览"""
+    return {
+        "preview": content[:_PREVIEW_CHARS] + ("..." if len(content) > _PREVIEW_CHARS else ""),
+        "title": content[:_TITLE_CHARS] + ("..." if len(content) > _TITLE_CHARS else "")
+    }
+
+
+# 按消息重新计算对话的问题预览（与 question_preview 的格式相同），用于升级旧数据库和批量导入
+_REFRESH_PREVIEWS = f"""
+    UPDATE chats SET previews = (
+        SELECT json_group_array(json_object(
+            'preview', substr(content, 1, {_PREVIEW_CHARS}) || CASE WHEN length(content) > {_PREVIEW_CHARS} THEN '...' ELSE '' END,
+            'title', substr(content, 1, {_TITLE_CHARS}) || CASE WHEN length(content) > {_TITLE_CHARS} THEN '...' ELSE '' END
+        ))
+        FROM (SELECT content FROM messages WHERE chat_id = chats.id AND role = 'user' ORDER BY seq LIMIT ?)
+    )
+"""
+
+
+def _posting_rows(chat_id, seq, content):
+    """返回一条消息写入倒排索引的行"""
+    return [(term, chat_id, seq, tf) for term, tf in term_frequencies(content).items()]
+
+
+class HistoryStore:
+    """聊天历史的 SQLite 存储：读操作直接查询，写操作由后台线程批量提交"""
+
+    def __init__(self, path, flush_interval=0.5, batch_size=500, max_candidates=1000, max_previews=5):
+        self.path = path
+        self.flush_interval = float(flush_interval)
+        self.batch_size = int(batch_size)
+        # 全文搜索时参与排序的候选消息数上限
+        self.max_candidates = int(max_candidates)
+        # 对话摘要中保存的问题预览数（侧边栏不加载消息即可显示）
+        self.max_previews = int(max_previews)
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        conn = self._connect()
+        conn.executescript(_SCHEMA)
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        if version < 1:
+            self._rebuild_index(conn)
+        if version < 2:
+            self._add_previews(conn)
+        self._queue = queue.Queue()
+        self._writer = threading.Thread(target=self._write_loop, name="history-writer", daemon=True)
+        self._writer.start()
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10.0, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    # ---- 写入（异步批量） ----
+
+    def _enqueue(self, sql, params):
+        self._queue.put((sql, params))
+
+    def _enqueue_many(self, sql, rows):
+        """一条语句写入多行（在提交时使用 executemany）"""
+        if rows:
+            self._queue.put((sql, list(rows)))
+
+    def _write_loop(self):
+        conn = self._connect()
+        while True:
+            # 收集一个批次：最多等待 flush_interval，遇到刷新请求时立即提交
+            batch, waiter = [], None
+            item = self._queue.get()
+            deadline = time.monotonic() + self.flush_interval
+            while True:
+                if isinstance(item, threading.Event):
+                    waiter = item
+                    break
+                batch.append(item)
+                remaining = deadline - time.monotonic()
+                if len(batch) >= self.batch_size or remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+            if batch:
+                self._commit(conn, batch)
+            for _ in range(len(batch) + (waiter is not None)):
+                self._queue.task_done()
+            if waiter is not None:
+                waiter.set()
+
+    def _commit(self, conn, batch):
+        """在一个事务中写入一批修改"""
+        try:
+            conn.execute("BEGIN")
+            for sql, params in batch:
+                if isinstance(params, list):
+                    conn.executemany(sql, params)
+                else:
+                    conn.execute(sql, params)
+            conn.execute("COMMIT")
+        except sqlite3.Error as e:
+            logger.error(f"写入聊天历史失败（{len(batch)} 条）: {e}")
+            try:
+                conn.execute("ROLLBACK")
+            except sqlite3.Error:
+                pass
+
+    def flush(self, timeout=5.0):
+        """立即提交写队列中的修改并等待完成"""
+        if self._queue.unfinished_tasks == 0:
+            return
+        done = threading.Event()
+        self._queue.put(done)
+        done.wait(timeout)
+
+    def create_chat(self, owner, chat_id, title, created_at):
+        self._enqueue(
+            "INSERT OR IGNORE INTO chats (id, owner, title, created_at, updated_at) VALUES (?, ?, ?, ?, ?)",
+            (chat_id, owner, title, created_at, created_at)
+        )
+
+    def append_message(self, chat_id, seq, message):
+        now = time.time()
+        if message.get("role") == "user":
+            # 问题预览追加到对话摘要中（只保留前 max_previews 个）
+            self._enqueue(
+                "UPDATE chats SET previews = json_insert(COALESCE(previews, '[]'), '$[#]', json(?)) "
+                "WHERE id = ? AND json_array_length(COALESCE(previews, '[]')) < ?",
+                (json.dumps(question_preview(message.get("content", "")), ensure_ascii=False), chat_id, self.max_previews)
+            )
+        self._enqueue(
+            "INSERT OR REPLACE INTO messages (chat_id, seq, role, content, created_at) VALUES (?, ?, ?, ?, ?)",
+            (chat_id, seq, message.get("role", ""), message.get("content", ""), now)
+        )
+        self._enqueue(
+            "UPDATE chats SET message_count = MAX(message_count, ?), updated_at = ? WHERE id = ?",
+            (seq + 1, now, chat_id)
+        )
+        # 增量更新倒排索引
+        self._enqueue("DELETE FROM postings WHERE chat_id = ? AND seq = ?", (chat_id, seq))
+        self._enqueue_many(_INSERT_POSTING, _posting_rows(chat_id, seq, message.get("content", "")))
+
+    def add_model_change(self, chat_id, seq, change):
+        self._enqueue(
+            "INSERT OR REPLACE INTO model_changes (chat_id, seq, data) VALUES (?, ?, ?)",
+            (chat_id, seq, json.dumps(change, ensure_ascii=False))
+        )
+
+    def update_chat(self, chat_id, **fields):
+        """更新对话的 title 或 summary"""
+        for name, value in fields.items():
+            if name == "summary":
+                value = json.dumps(value, ensure_ascii=False) if value is not None else None
+            elif name != "title":
+                continue
+            self._enqueue(f"UPDATE chats SET {name} = ? WHERE id = ?", (value, chat_id))
+
+    def delete_chat(self, chat_id):
+        for table, column in (("postings", "chat_id"), ("messages", "chat_id"), ("model_changes", "chat_id"), ("chats", "id")):
+            self._enqueue(f"DELETE FROM {table} WHERE {column} = ?", (chat_id,))
+
+    def _rebuild_index(self, conn):
+        """为已有的消息重建倒排索引（旧版本数据库升级时运行一次）"""
+        started = time.time()
+        conn.execute("BEGIN")
+        conn.execute("DELETE FROM postings")
+        count = 0
+        for chat_id, seq, content in conn.execute("SELECT chat_id, seq, content FROM messages").fetchall():
+            conn.executemany(_INSERT_POSTING, _posting_rows(chat_id, seq, content))
+            count += 1
+        conn.execute("PRAGMA user_version = 1")
+        conn.execute("COMMIT")
+        if count:
+            logger.info(f"已为 {count} 条历史消息建立全文索引（耗时 {time.time() - started:.1f}秒）")
+
+    def _add_previews(self, conn):
+        """为已有的对话生成问题预览（旧版本数据库升级时运行一次）"""
+        conn.execute("BEGIN")
+        if "previews" not in [row[1] for row in conn.execute("PRAGMA table_info(chats)")]:
+            conn.execute("ALTER TABLE chats ADD COLUMN previews TEXT")
+        conn.execute(_REFRESH_PREVIEWS, (self.max_previews,))
+        conn.execute(f"PRAGMA user_version = {_SCHEMA_VERSION}")
+        conn.execute("COMMIT")
+
+    def bulk_load(self, owner, records, batch_size=5000):
+        """批量导入对话记录（utils/history_archive.py 读出的 chat / messages 记录），返回 (对话数, 消息数)
+
+        导入按对话替换：已有的同 ID 对话的消息先全部删除再写入归档中的消息，结果只取决于归档内容；
+        ID 已被其他用户占用的对话使用由 (所有者, 原 ID) 确定的新 ID。事务只在对话之间提交
+        （累计 batch_size 条消息后），每个对话的替换是原子的，中途失败后重新导入同一归档不会产生重复。
+        """
+        self.flush()
+        conn = self._connect()
+        id_map = {}
+        chats = messages = pending = 0
+        conn.execute("BEGIN")
+        try:
+            for record in records:
+                if record.get("type") == "chat":
+                    if pending >= batch_size:
+                        conn.execute("COMMIT")
+                        conn.execute("BEGIN")
+                        pending = 0
+                    chat_id = record["id"]
+                    row = conn.execute("SELECT owner FROM chats WHERE id = ?", (chat_id,)).fetchone()
+                    if row is not None and row[0] != owner:
+                        chat_id = str(uuid.uuid5(uuid.NAMESPACE_URL, f"smartchat-import:{owner}:{chat_id}"))
+                        row = conn.execute("SELECT owner FROM chats WHERE id = ?", (chat_id,)).fetchone()
+                    if row is not None:
+                        # 替换已有的对话：删除旧消息及其索引
+                        conn.execute("DELETE FROM postings WHERE chat_id = ?", (chat_id,))
+                        conn.execute("DELETE FROM messages WHERE chat_id = ?", (chat_id,))
+                    id_map[record["id"]] = chat_id
+                    summary = record.get("summary")
+                    conn.execute(
+                        "INSERT INTO chats (id, owner, title, created_at, updated_at, summary) VALUES (?, ?, ?, ?, ?, ?) "
+                        "ON CONFLICT (id) DO UPDATE SET title = excluded.title, created_at = excluded.created_at, "
+                        "updated_at = excluded.updated_at, summary = excluded.summary, message_count = 0, previews = NULL",
+                        (chat_id, owner, record.get("title", ""), record["created_at"],
+                         record.get("updated_at") or record["created_at"],
+                         json.dumps(summary, ensure_ascii=False) if summary else None)
+                    )
+                    conn.execute("DELETE FROM model_changes WHERE chat_id = ?", (chat_id,))
+                    conn.executemany(
+                        "INSERT INTO model_changes (chat_id, seq, data) VALUES (?, ?, ?)",
+                        [(chat_id, seq, json.dumps(change, ensure_ascii=False))
+                         for seq, change in enumerate(record.get("model_changes") or [])]
+                    )
+                    chats += 1
+                elif record.get("type") == "messages":
+                    chat_id = id_map.get(record["chat_id"])
+                    if chat_id is None:
+                        raise ValueError(f"消息记录引用了未知的对话 {record['chat_id']}")
+                    start = int(record["seq"])
+                    rows = record["messages"]
+                    conn.executemany(
+                        "INSERT INTO messages (chat_id, seq, role, content, created_at) VALUES (?, ?, ?, ?, ?)",
+                        [(chat_id, start + i, role, content, created_at) for i, (role, content, created_at) in enumerate(rows)]
+                    )
+                    conn.executemany(_INSERT_POSTING, [
+                        posting for i, (_, content, _) in enumerate(rows)
+                        for posting in _posting_rows(chat_id, start + i, content)
+                    ])
+                    conn.execute(
+                        "UPDATE chats SET message_count = MAX(message_count, ?) WHERE id = ?", (start + len(rows), chat_id)
+                    )
+                    conn.execute(_REFRESH_PREVIEWS + " WHERE id = ?", (self.max_previews, chat_id))
+                    messages += len(rows)
+                    pending += len(rows)
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return chats, messages
+
+    # ---- 读取 ----
+
+    def list_chats(self, owner, limit=None, offset=0):
+        """返回对话摘要列表（按创建时间倒序），不读取消息内容"""
+        self.flush()
+        rows = self._connect().execute(
+            "SELECT id, title, created_at, updated_at, message_count, previews FROM chats "
+            "WHERE owner = ? ORDER BY created_at DESC LIMIT ? OFFSET ?",
+            (owner, -1 if limit is None else int(limit), int(offset))
+        ).fetchall()
+        return [
+            {"id": r[0], "title": r[1], "created_at": r[2], "updated_at": r[3], "message_count": r[4],
+             "previews": json.loads(r[5]) if r[5] else []}
+            for r in rows
+        ]
+
+    def count_chats(self, owner):
+        self.flush()
+        return self._connect().execute("SELECT COUNT(*) FROM chats WHERE owner = ?", (owner,)).fetchone()[0]
+
+    def chat_exists(self, owner, chat_id):
+        self.flush()
+        return self._connect().execute(
+            "SELECT 1 FROM chats WHERE id = ? AND owner = ?", (chat_id, owner)
+        ).fetchone() is not None
+
+    def load_chat(self, owner, chat_id):
+        """加载对话的完整记录，不存在时返回 None"""
+        self.flush()
+        conn = self._connect()
+        row = conn.execute(
+            "SELECT title, created_at, summary FROM chats WHERE id = ? AND owner = ?", (chat_id, owner)
+        ).fetchone()
+        if row is None:
+            return None
+        messages = [
+            {"role": role, "content": content}
+            for role, content in conn.execute(
+                "SELECT role, content FROM messages WHERE chat_id = ? ORDER BY seq", (chat_id,)
+            )
+        ]
+        changes = self.load_model_changes(chat_id)
+        return {
+            "title": row[0],
+            "created_at": datetime.datetime.fromtimestamp(row[1]),
+            "messages": messages,
+            "model_changes": changes,
+            "summary": json.loads(row[2]) if row[2] else None
+        }
+
+    def iter_chats(self, owner):
+        """逐个返回用户的对话信息（按创建时间排序，不读取消息）"""
+        self.flush()
+        cursor = self._connect().execute(
+            "SELECT id, title, created_at, updated_at, summary FROM chats WHERE owner = ? ORDER BY created_at", (owner,)
+        )
+        for chat_id, title, created_at, updated_at, summary in cursor:
+            yield {
+                "id": chat_id,
+                "title": title,
+                "created_at": created_at,
+                "updated_at": updated_at,
+                "summary": json.loads(summary) if summary else None
+            }
+
+    def load_model_changes(self, chat_id):
+        return [
+            json.loads(data)
+            for (data,) in self._connect().execute(
+                "SELECT data FROM model_changes WHERE chat_id = ? ORDER BY seq", (chat_id,)
+            )
+        ]
+
+    def iter_messages(self, chat_id, batch_size=500):
+        """按批次返回对话的消息 [(seq, role, content, created_at), ...]，内存中最多一批"""
+        cursor = self._connect().execute(
+            "SELECT seq, role, content, created_at FROM messages WHERE chat_id = ? ORDER BY seq", (chat_id,)
+        )
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                return
+            yield rows
+
+    def search(self, owner, query, limit=20):
+        """在用户的所有对话中全文搜索，返回按相关度排序的命中消息"""
+        terms = query_terms(query)
+        if not terms:
+            return []
+        self.flush()
+        conn = self._connect()
+        # 文档数和文档频率都只统计该用户的对话，不透露其他用户的数据
+        total = conn.execute(
+            "SELECT COALESCE(SUM(message_count), 0) FROM chats WHERE owner = ?", (owner,)
+        ).fetchone()[0] or 1
+
+        # 查询词按文档频率从低到高排列，每个词的权重为 idf
+        weighted = []
+        for term, prefix in terms:
+            if prefix:
+                condition, args = "p.term >= ? AND p.term < ?", (term, term + "\uffff")
+            else:
+                condition, args = "p.term = ?", (term,)
+            # 很常见的词只数到上限为止（超过上限的词权重都很低，区别不大）
+            df = conn.execute(
+                f"SELECT COUNT(*) FROM (SELECT 1 FROM postings p JOIN chats c ON c.id = p.chat_id "
+                f"WHERE {condition} AND c.owner = ? LIMIT ?)",
+                args + (owner, self.max_candidates * 10)
+            ).fetchone()[0]
+            if df:
+                weighted.append((df, condition, args, math.log(1 + (total - df + 0.5) / (df + 0.5))))
+        if not weighted:
+            return []
+        weighted.sort(key=lambda w: w[0])
+
+        # 候选消息：从最少见的词开始取，最多 max_candidates 条（常见词不会把整张表读一遍）
+        conn.execute(
+            "CREATE TEMP TABLE IF NOT EXISTS search_candidates "
+            "(chat_id TEXT, seq INTEGER, PRIMARY KEY (chat_id, seq)) WITHOUT ROWID"
+        )
+        conn.execute("DELETE FROM search_candidates")
+        found = 0
+        for _, condition, args, _ in weighted:
+            before = conn.total_changes
+            conn.execute(
+                "INSERT OR IGNORE INTO search_candidates SELECT p.chat_id, p.seq FROM postings p "
+                f"JOIN chats c ON c.id = p.chat_id WHERE {condition} AND c.owner = ? LIMIT ?",
+                args + (owner, self.max_candidates - found)
+            )
+            found += conn.total_changes - before
+            if found >= self.max_candidates:
+                break
+
+        # 只为候选消息计算得分：命中的查询词越多排名越前，其次按 idf 加权的词频排序
+        hits, params = [], []
+        for index, (_, condition, args, idf) in enumerate(weighted):
+            hits.append(
+                "SELECT p.chat_id, p.seq, p.tf, ? AS q, ? AS w FROM search_candidates s CROSS "
+                f"JOIN postings p ON p.chat_id = s.chat_id AND p.seq = s.seq WHERE {condition}"
+            )
+            params.extend((index, idf) + args)
+        rows = conn.execute(
+            f"WITH hits AS ({' UNION ALL '.join(hits)}) "
+            "SELECT h.chat_id, h.seq, c.title, COUNT(DISTINCT h.q) AS matched, "
+            f"SUM(h.w * h.tf / (h.tf + {_TF_SATURATION})) AS score "
+            "FROM hits h JOIN chats c ON c.id = h.chat_id "
+            "GROUP BY h.chat_id, h.seq ORDER BY matched DESC, score DESC LIMIT ?",
+            params + [int(limit)]
+        ).fetchall()
+
+        results = []
+        for chat_id, seq, title, matched, score in rows:
+            message = conn.execute(
+                "SELECT role, content FROM messages WHERE chat_id = ? AND seq = ?", (chat_id, seq)
+            ).fetchone()
+            if message is None:
+                continue
+            results.append({
+                "chat_id": chat_id,
+                "seq": seq,
+                "title": title,
+                "role": message[0],
+                "snippet": snippet(message[1], query),
+                "score": matched + score
+            })
+        return results
+
+
+class _PersistentList(list):
+    """追加元素时同步写入存储的列表（消息、模型切换记录）"""
+
+    def __init__(self, items, on_append):
+        super().__init__(items)
+        self._on_append = on_append
+
+    def append(self, item):
+        seq = len(self)
+        super().append(item)
+        self._on_append(seq, item)
+
+    def extend(self, items):
+        for item in items:
+            self.append(item)
+
+    def __iadd__(self, items):
+        self.extend(items)
+        return self
+
+
+class ChatRecord(dict):
+    """一个对话的完整记录：修改标题、摘要，追加消息和模型切换记录时写入存储"""
+
+    def __init__(self, store, chat_id, data):
+        super().__init__()
+        self._store = store
+        self.chat_id = chat_id
+        for key, value in data.items():
+            self._set(key, value)
+
+    def _set(self, key, value):
+        if key == "messages":
+            value = _PersistentList(value or [], lambda seq, m: self._store.append_message(self.chat_id, seq, m))
+        elif key == "model_changes":
+            value = _PersistentList(value or [], lambda seq, c: self._store.add_model_change(self.chat_id, seq, c))
+        super().__setitem__(key, value)
+        return value
+
+    def __setitem__(self, key, value):
+        existing = self.get(key) if key in ("messages", "model_changes") else None
+        value = self._set(key, value)
+        if key in ("title", "summary"):
+            self._store.update_chat(self.chat_id, **{key: value})
+        elif existing is not None:
+            # 整体替换列表：只持久化新增的部分
+            for seq in range(len(existing), len(value)):
+                value._on_append(seq, value[seq])
+
+
+class ChatHistories(MutableMapping):
+    """会话的对话集合：对话列表从存储中读取，对话记录按需加载，内存中只缓存最近打开的几个"""
+
+    def __init__(self, store, owner, max_loaded=2):
+        self.store = store
+        self.owner = owner
+        self.max_loaded = max(1, int(max_loaded))
+        self._loaded = OrderedDict()
+        self._lock = threading.Lock()
+
+    def summaries(self, limit=None, offset=0):
+        """返回对话摘要列表（标题、创建时间、消息数、问题预览），不加载消息"""
+        return self.store.list_chats(self.owner, limit, offset)
+
+    def set_title(self, chat_id, title):
+        """修改对话标题（对话未加载时不加载消息）"""
+        with self._lock:
+            record = self._loaded.get(chat_id)
+        if record is not None:
+            record["title"] = title
+        else:
+            self.store.update_chat(chat_id, title=title)
+
+    def search(self, query, limit=20):
+        """在会话的所有对话中全文搜索"""
+        return self.store.search(self.owner, query, limit)
+
+    def __getitem__(self, chat_id):
+        with self._lock:
+            record = self._loaded.get(chat_id)
+            if record is not None:
+                self._loaded.move_to_end(chat_id)
+                return record
+        data = self.store.load_chat(self.owner, chat_id)
+        if data is None:
+            raise KeyError(chat_id)
+        record = ChatRecord(self.store, chat_id, data)
+        self._remember(chat_id, record)
+        return record
+
+    def __setitem__(self, chat_id, data):
+        created_at = data.get("created_at") or datetime.datetime.now()
+        timestamp = created_at.timestamp() if isinstance(created_at, datetime.datetime) else float(created_at)
+        title = data.get("title", "")
+        self.store.create_chat(self.owner, chat_id, title, timestamp)
+        record = ChatRecord(self.store, chat_id, {
+            "title": title,
+            "created_at": created_at,
+            "messages": [],
+            "model_changes": [],
+            "summary": None
+        })
+        # 新建时带有的消息、模型切换记录和摘要逐项写入存储
+        record["messages"].extend(data.get("messages", []))
+        record["model_changes"].extend(data.get("model_changes", []))
+        if data.get("summary"):
+            record["summary"] = data["summary"]
+        self._remember(chat_id, record)
+
+    def _remember(self, chat_id, record):
+        with self._lock:
+            self._loaded[chat_id] = record
+            self._loaded.move_to_end(chat_id)
+            while len(self._loaded) > self.max_loaded:
+                self._loaded.popitem(last=False)
+
+    def __delitem__(self, chat_id):
+        with self._lock:
+            self._loaded.pop(chat_id, None)
+        self.store.delete_chat(chat_id)
+
+    def __contains__(self, chat_id):
+        with self._lock:
+            if chat_id in self._loaded:
+                return True
+        return self.store.chat_exists(self.owner, chat_id)
+
+    def __iter__(self):
+        return iter([chat["id"] for chat in self.summaries()])
+
+    def __len__(self):
+        return self.store.count_chats(self.owner)
+
+
+def chat_summaries(chat_histories, limit=None, offset=0, max_previews=5):
+    """返回对话摘要列表（按创建时间倒序），chat_histories 可以是 ChatHistories 或普通字典"""
+    if isinstance(chat_histories, ChatHistories):
+        return chat_histories.summaries(limit, offset)
+    # 字典按创建顺序插入，倒序遍历即为按创建时间倒序，只处理需要的部分
+    end = None if limit is None else offset + limit
+    return [
+        {
+            "id": chat_id,
+            "title": chat.get("title", ""),
+            "created_at": chat.get("created_at", datetime.datetime.now()).timestamp(),
+            "updated_at": None,
+            "message_count": len(chat.get("messages", [])),
+            "previews": _message_previews(chat.get("messages", []), max_previews)
+        }
+        for chat_id, chat in itertools.islice(reversed(chat_histories.items()), offset, end)
+    ]
+
+
+def _message_previews(messages, limit):
+    """从消息列表中取前 limit 个用户问题的预览"""
+    questions = (m.get("content", "") for m in messages if m.get("role") == "user")
+    return [question_preview(content) for content in itertools.islice(questions, limit)]
+
+
+def search_chats(chat_histories, query, limit=20):
+    """全文搜索对话；chat_histories 是普通字典时逐条扫描消息"""
+    if isinstance(chat_histories, ChatHistories):
+        return chat_histories.search(query, limit)
+    needle = query.strip().lower()
+    if not needle:
+        return []
+    results = []
+    for summary in chat_summaries(chat_histories):
+        for seq, message in enumerate(chat_histories[summary["id"]].get("messages", [])):
+            if needle in message.get("content", "").lower():
+                results.append({
+                    "chat_id": summary["id"],
+                    "seq": seq,
+                    "title": summary["title"],
+                    "role": message.get("role", ""),
+                    "snippet": snippet(message["content"], query),
+                    "score": 1.0
+                })
+                if len(results) >= limit:
+                    return results
+    return results
+
+
+def set_chat_title(chat_histories, chat_id, title):
+    """修改对话标题"""
+    if isinstance(chat_histories, ChatHistories):
+        chat_histories.set_title(chat_id, title)
+    else:
+        chat_histories[chat_id]["title"] = title
+
+
+def create_chat_histories(owner, config=None):
+    """创建会话的对话集合：启用持久化存储时返回 ChatHistories，否则返回普通字典"""
+    config = CONFIG.get("history", {}) if config is None else config
+    if history_store is None:
+        return {}
+    return ChatHistories(history_store, owner, config.get("max_loaded_chats", 2))
+
+
+def create_history_store(config):
+    """按配置创建聊天历史存储，未启用或无法打开时返回 None（使用会话内存中的字典）"""
+    config = config or {}
+    if not config.get("enabled", True):
+        return None
+    path = config.get("path", "./data/chat_history.db")
+    try:
+        return HistoryStore(
+            path,
+            config.get("flush_interval", 0.5),
+            config.get("batch_size", 500),
+            config.get("search_max_candidates", 1000),
+            config.get("max_previews", 5)
+        )
+    except (sqlite3.Error, OSError) as e:
+        logger.warning(f"无法打开聊天历史数据库 {path}，对话只保存在内存中: {e}")
+        return None
+
+
+# 创建全局聊天历史存储（进程内所有会话共享）
+history_store = create_history_store(CONFIG.get("history", {}))
@@ -0,0 +1,123 @@
+"""
+用户身份 - 由服务端签发的聊天历史所有者标识
+
+持久化的聊天历史按所有者保存。配置了 Streamlit 登录（st.login）时所有者是登录用户；
+否则服务端为浏览器生成匿名标识，用 HMAC 签名后写入 Cookie，之后只接受签名有效的 Cookie。
+页面地址中的 sid 参数只用于重新连接进行中的后台生成，它带有与所有者绑定的签名，
+复制链接的人得不到原用户的对话，也不能查看或取消其进行中的生成。
+
+签名密钥依次取环境变量 SMARTCHAT_SECRET、配置中的 secret，都没有时在 data/ 下生成并保存。
+"""
+import hashlib
+import hmac
+import logging
+import os
+import secrets
+import uuid
+import streamlit as st
+from utils.config import CONFIG
+
+logger = logging.getLogger(__name__)
+
+# 匿名所有者标识的前缀（登录用户为 user:）
+ANONYMOUS_PREFIX = "anon:"
+
+
+def load_secret(config):
+    """读取签名密钥，不存在时生成并保存（文件权限 0600）"""
+    secret = os.environ.get("SMARTCHAT_SECRET") or config.get("secret")
+    if secret:
+        return secret.encode("utf-8")
+    path = config.get("secret_path", "./data/identity_secret")
+    for _ in range(2):
+        try:
+            with open(path, "rb") as f:
+                secret = f.read().strip()
+            if secret:
+                return secret
+        except FileNotFoundError:
+            pass
+        except OSError:
+            break
+        try:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        except FileExistsError:
+            # 其它进程刚刚生成了密钥，重新读取
+            continue
+        except OSError:
+            break
+        secret = secrets.token_hex(32).encode("ascii")
+        with os.fdopen(fd, "wb") as f:
+            f.write(secret)
+        return secret
+    logger.warning(f"无法读取或保存身份签名密钥 {path}，使用临时密钥（重启后匿名用户的历史将无法找回）")
+    return secrets.token_hex(32).encode("ascii")
+
+
+class IdentityManager:
+    """签发和校验所有者标识（签名 Cookie）及绑定到所有者的会话标识"""
+
+    def __init__(self, config=None):
+        config = config or {}
+        self.cookie_name = config.get("cookie_name", "smartchat_owner")
+        self.cookie_max_age = int(float(config.get("cookie_max_age_days", 365)) * 86400)
+        self._secret = load_secret(config)
+
+    def _mac(self, *parts):
+        return hmac.new(self._secret, "\x00".join(parts).encode("utf-8"), hashlib.sha256).hexdigest()[:32]
+
+    def sign(self, value):
+        """返回 值.签名 形式的令牌"""
+        return f"{value}.{self._mac('owner', value)}"
+
+    def verify(self, token):
+        """校验令牌，签名有效时返回其中的值，否则返回 None"""
+        value, _, mac = (token or "").rpartition(".")
+        if value and hmac.compare_digest(mac, self._mac("owner", value)):
+            return value
+        return None
+
+    def current_owner(self):
+        """返回 (所有者标识, 需要写入 Cookie 的新令牌)；已登录或 Cookie 有效时令牌为 None"""
+        user = getattr(st, "user", None) or getattr(st, "experimental_user", None)
+        try:
+            if user is not None and user.get("is_logged_in"):
+                name = user.get("email") or user.get("sub")
+                if name:
+                    return f"user:{name}", None
+        except Exception as e:
+            logger.debug(f"读取登录用户失败: {e}")
+
+        try:
+            owner = self.verify(st.context.cookies.get(self.cookie_name))
+        except Exception as e:
+            logger.debug(f"读取身份 Cookie 失败: {e}")
+            owner = None
+        if owner and owner.startswith(ANONYMOUS_PREFIX):
+            return owner, None
+        owner = f"{ANONYMOUS_PREFIX}{uuid.uuid4().hex}"
+        return owner, self.sign(owner)
+
+    def issue_cookie(self, token):
+        """在浏览器中写入身份 Cookie（Streamlit 不能设置响应头，通过组件脚本写入）"""
+        import streamlit.components.v1 as components
+        secure = "; Secure" if st.context.headers.get("X-Forwarded-Proto", "") == "https" else ""
+        components.html(
+            f"""<script>
+            window.parent.document.cookie = "{self.cookie_name}={token}; path=/; max-age={self.cookie_max_age}; SameSite=Strict{secure}";
+            </script>""",
+            height=0
+        )
+
+    def session_id_for(self, owner, requested=None):
+        """返回会话标识：URL 中的 sid 签名属于该所有者时沿用（重新连接进行中的生成），否则签发新的"""
+        nonce, _, mac = (requested or "").partition(".")
+        if nonce and hmac.compare_digest(mac, self._mac("session", owner, nonce)):
+            return requested
+        nonce = uuid.uuid4().hex
+        return f"{nonce}.{self._mac('session', owner, nonce)}"
+
+
+# 创建全局身份管理器
+identity = IdentityManager(CONFIG.get("history", {}).get("identity", {}))
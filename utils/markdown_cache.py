@@ -0,0 +1,115 @@
+"""
+Markdown 渲染缓存 - 历史消息预先转换为经过清理的 HTML 并按内容哈希缓存
+
+每次页面重新运行都会把所有历史消息重新解析一遍，代码较多的长回复开销明显。
+缓存以消息内容的哈希为键，在所有会话之间共享，按字节数限制内存占用并按 LRU 淘汰，
+同时统计命中率用于调整缓存大小。
+
+转换使用 markdown-it-py 的 GFM 规则（表格、删除线、自动链接），与 st.markdown 的渲染结果一致：
+段落后紧跟的列表、两个空格缩进的嵌套列表、~~删除线~~ 和裸网址都按 GFM 处理。
+未安装 markdown-it-py 或 linkify-it-py 时不做转换，由调用方直接显示原文。
+"""
+import hashlib
+import logging
+import re
+import threading
+from collections import OrderedDict
+from utils.config import CONFIG
+
+logger = logging.getLogger(__name__)
+
+# markdown-it-py（含 linkify 扩展）为可选依赖
+try:
+    from markdown_it import MarkdownIt
+    import linkify_it  # noqa: F401  自动链接需要
+except ImportError:
+    MarkdownIt = None
+
+# 只允许这些协议的链接和图片地址，其它（如 javascript:）一律去掉
+_UNSAFE_URL = re.compile(r'\s(href|src)="(?!https?:|mailto:|#|/)[^"]*"', re.IGNORECASE)
+# 含公式的消息交给 Streamlit 自己渲染（HTML 中的 $...$ 不会被当作公式）
+_MATH = re.compile(r"\$[^$\n]+\$|\$\$")
+
+# 每隔多少次查找记录一次命中率
+_STATS_LOG_INTERVAL = 1000
+
+
+class MarkdownCache:
+    """按内容哈希缓存消息渲染结果的 LRU 缓存（线程安全，按字节数限制大小）"""
+
+    def __init__(self, config=None):
+        config = config or {}
+        self.enabled = bool(config.get("enabled", True)) and MarkdownIt is not None
+        self.max_bytes = int(config.get("max_bytes", 16 * 1024 * 1024))
+        # 短消息解析很快，不值得缓存
+        self.min_length = int(config.get("min_length", 200))
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        # 每个线程一个解析器实例
+        self._local = threading.local()
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+    def render(self, content):
+        """返回消息的 HTML；不适合缓存的消息返回 None，由调用方直接用 st.markdown 显示原文"""
+        if not self.enabled or not content or len(content) < self.min_length or _MATH.search(content):
+            return None
+        key = hashlib.blake2b(content.encode("utf-8"), digest_size=16).digest()
+        with self._lock:
+            html = self._entries.get(key)
+            if html is not None:
+                self._entries.move_to_end(key)
+                self._count("hits")
+                return html
+
+        try:
+            html = self._convert(content)
+        except Exception as e:
+            logger.warning(f"Markdown 转换失败，直接显示原文: {e}")
+            return None
+
+        size = len(html.encode("utf-8"))
+        with self._lock:
+            self._count("misses")
+            if size > self.max_bytes or key in self._entries:
+                return html
+            self._entries[key] = html
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= len(evicted.encode("utf-8"))
+                self.stats["evictions"] += 1
+        return html
+
+    def _convert(self, content):
+        """转换为 HTML：原始 HTML 标签按文本转义，去掉不安全的链接"""
+        md = getattr(self._local, "md", None)
+        if md is None:
+            # html=False：原始 HTML 按文本转义
+            md = MarkdownIt("gfm-like", {"html": False, "linkify": True, "typographer": False})
+            self._local.md = md
+        html = md.render(content)
+        return _UNSAFE_URL.sub("", html)
+
+    def _count(self, name):
+        """更新统计并定期记录命中率（调用方持有锁）"""
+        self.stats[name] += 1
+        lookups = self.stats["hits"] + self.stats["misses"]
+        if lookups % _STATS_LOG_INTERVAL == 0:
+            logger.info(
+                f"Markdown 缓存命中率 {self.hit_rate():.1%}，{len(self._entries)} 条，"
+                f"{self._bytes / 1024:.0f}KB / {self.max_bytes / 1024:.0f}KB，淘汰 {self.stats['evictions']} 次"
+            )
+
+    def hit_rate(self):
+        """返回命中率"""
+        total = self.stats["hits"] + self.stats["misses"]
+        return self.stats["hits"] / total if total else 0.0
+
+    @property
+    def size_bytes(self):
+        return self._bytes
+
+
+# 创建全局 Markdown 渲染缓存（进程内所有会话共享）
+markdown_cache = MarkdownCache(CONFIG.get("ui", {}).get("markdown_cache", {}))
@@ -87,6 +87,11 @@ class ModelSelector:
             
         return features
         
+    def is_short_prompt(self, message, history=None):
+        """判断是否为短小简单的提问（既不是长消息也不复杂），供调度器优先处理"""
+        features = self._extract_features(message, history or [])
+        return features.get("message_length", 0.5) < 1.0 and features.get("complexity", 0.5) < 1.0
+
     def _calculate_score(self, features, model_info):
         """根据特征和模型信息计算得分"""
         score = 0.0
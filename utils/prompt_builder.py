@@ -0,0 +1,86 @@
+"""
+提示词组装 - 保持请求前缀逐字节稳定，提高后端 KV 缓存的复用率
+
+Ollama 等后端会复用与上一次请求相同的提示词前缀的 KV 缓存。系统提示词和历史消息
+构成稳定前缀；每轮变化的提示（情感回应、简洁要求等）只追加在最后一条用户消息中，
+不写入系统提示词，也不写入对话历史。PrefixReuseTracker 统计每个对话相邻两次请求
+之间可复用的前缀长度。
+"""
+import logging
+import threading
+from collections import OrderedDict
+from utils.context_packer import context_packer
+
+logger = logging.getLogger(__name__)
+
+
+def apply_turn_hints(api_messages, hints, is_chinese=True):
+    """把本轮的临时提示追加到最后一条用户消息（返回新列表，不修改历史中的消息）"""
+    hints = [h for h in hints if h]
+    if not hints:
+        return api_messages
+    for index in range(len(api_messages) - 1, -1, -1):
+        if api_messages[index]["role"] == "user":
+            break
+    else:
+        return api_messages
+    label = "【本轮回复要求】" if is_chinese else "[Instructions for this reply]"
+    message = dict(api_messages[index])
+    message["content"] = f"{message['content']}\n\n{label}\n" + "\n".join(hints)
+    return api_messages[:index] + [message] + api_messages[index + 1:]
+
+
+class PrefixReuseTracker:
+    """记录每个对话上一次请求的消息，统计新请求与之相同的前缀长度（线程安全）"""
+
+    def __init__(self, max_conversations=1000):
+        self.max_conversations = int(max_conversations)
+        self._last = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {"requests": 0, "prompt_tokens": 0, "reused_tokens": 0}
+
+    def observe(self, conversation_id, api_messages):
+        """记录一次请求，返回 (可复用前缀的估算 token 数, 提示词估算 token 数)"""
+        with self._lock:
+            previous = self._last.pop(conversation_id, None)
+            self._last[conversation_id] = list(api_messages)
+            if len(self._last) > self.max_conversations:
+                self._last.popitem(last=False)
+
+        total = sum(context_packer.message_tokens(m) for m in api_messages)
+        reused = 0
+        if previous:
+            for old, new in zip(previous, api_messages):
+                if old is new or (old["role"] == new["role"] and old["content"] == new["content"]):
+                    reused += context_packer.message_tokens(new)
+                    continue
+                if old["role"] == new["role"]:
+                    # 第一条不同的消息中相同的开头部分也能复用
+                    reused += context_packer.estimate_tokens(_common_prefix(old["content"], new["content"]))
+                break
+
+        with self._lock:
+            self.stats["requests"] += 1
+            self.stats["prompt_tokens"] += total
+            self.stats["reused_tokens"] += reused
+        if previous:
+            logger.info(f"提示词前缀复用: {reused}/{total} tokens（累计复用率 {self.reuse_ratio():.0%}）")
+        return reused, total
+
+    def reuse_ratio(self):
+        """返回累计的前缀复用率"""
+        total = self.stats["prompt_tokens"]
+        return self.stats["reused_tokens"] / total if total else 0.0
+
+
+def _common_prefix(a, b):
+    """返回两个字符串的公共前缀"""
+    limit = min(len(a), len(b))
+    index = 0
+    while index < limit and a[index] == b[index]:
+        index += 1
+    return a[:index]
+
+
+# 创建全局前缀复用统计
+prefix_tracker = PrefixReuseTracker()
@@ -0,0 +1,220 @@
+"""
+响应缓存 - 重复提问直接返回缓存的回复，不再请求后端
+
+提问先做归一化（全半角、大小写、空白和结尾标点），按精确哈希查找。可选的近似匹配
+（默认关闭）用字符 n-gram 哈希向量做最近邻查找，但哈希向量并不理解语义（“求和”与“求积”、
+加了否定词的提问相似度都很高），所以只接受相似度极高、且词（中日韩单字和拉丁单词）完全相同、
+仅顺序或标点不同的提问，相当于宽松一点的精确匹配。缓存条目按
+模型、温度和系统提示词划分作用域，超过条目上限时按 LRU 淘汰，并统计命中率。
+条目存放在 utils/cache_backend.py 提供的存储后端中（内存或多进程共享的 SQLite）。
+"""
+import hashlib
+import logging
+import re
+import threading
+import time
+import unicodedata
+from collections import Counter
+from utils.cache_backend import create_cache_backend
+from utils.config import CONFIG
+
+logger = logging.getLogger(__name__)
+
+# numpy 为可选依赖，未安装时只做精确匹配
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# 哈希向量的维度
+_EMBEDDING_DIM = 512
+_TRAILING_PUNCT = "?？!！.。~～…"
+_LATIN_WORD = re.compile(r"[a-z0-9]+")
+_CJK_CHAR = re.compile(r"[\u4e00-\u9fff\u3040-\u30ff\uac00-\ud7af]")
+
+
+def normalize_prompt(text):
+    """归一化提问文本：NFKC、转小写、合并空白、去掉结尾标点"""
+    text = unicodedata.normalize("NFKC", text or "").lower()
+    text = " ".join(text.split())
+    return text.rstrip(_TRAILING_PUNCT + " ")
+
+
+def _hash_token(token):
+    return int.from_bytes(hashlib.blake2b(token.encode("utf-8"), digest_size=8).digest(), "little")
+
+
+def embed_text(text):
+    """把归一化后的文本映射为 L2 归一化的哈希向量（中日韩字符用 1-2 字 n-gram，拉丁文字用词和词二元组）"""
+    if np is None:
+        return None
+    tokens = []
+    cjk = _CJK_CHAR.findall(text)
+    tokens += cjk
+    tokens += [a + b for a, b in zip(cjk, cjk[1:])]
+    words = _LATIN_WORD.findall(text)
+    tokens += words
+    tokens += [f"{a} {b}" for a, b in zip(words, words[1:])]
+    if not tokens:
+        return None
+
+    vector = np.zeros(_EMBEDDING_DIM, dtype=np.float32)
+    for token in tokens:
+        h = _hash_token(token)
+        # 用哈希的一位决定符号，减少哈希碰撞带来的偏差
+        vector[h % _EMBEDDING_DIM] += 1.0 if (h >> 32) & 1 else -1.0
+    norm = float(np.linalg.norm(vector))
+    if norm == 0.0:
+        return None
+    return vector / norm
+
+
+def _words(text):
+    """返回文本中的词：中日韩单字和拉丁单词"""
+    return _CJK_CHAR.findall(text) + _LATIN_WORD.findall(text)
+
+
+def scope_key(model, temperature, system_prompt):
+    """缓存作用域：模型、温度和系统提示词都相同的请求才能共享缓存"""
+    payload = f"{model}\x00{round(float(temperature), 2)}\x00{normalize_prompt(system_prompt)}"
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """带语义相似度查找、TTL 和 LRU 淘汰的响应缓存（线程安全），条目保存在可替换的存储后端中"""
+
+    def __init__(self, config=None, backend=None):
+        config = config or {}
+        self.enabled = bool(config.get("enabled", True))
+        self.ttl = float(config.get("ttl", 3600))
+        self.semantic = bool(config.get("semantic", False)) and np is not None
+        self.similarity_threshold = float(config.get("similarity_threshold", 0.98))
+        # 近似匹配允许两个提问相差的词数（中日韩单字或拉丁单词）
+        self.max_token_diff = int(config.get("max_token_diff", 0))
+        # 只缓存没有前文的独立提问（多轮对话的回答依赖上下文）
+        self.standalone_only = bool(config.get("standalone_only", True))
+        # 语义索引的刷新间隔（秒）：共享后端中其它进程写入的条目在该时间内可见
+        self.index_refresh = float(config.get("index_refresh_seconds", 5.0))
+        self.backend = backend if backend is not None else create_cache_backend(config)
+        # 每个作用域的语义索引：(条目键列表, 向量矩阵, 构建时间)
+        self._scope_index = {}
+        # 已计算过的提问向量，避免刷新索引时重复计算
+        self._embeddings = {}
+        self._lock = threading.Lock()
+        self.stats = {"exact_hits": 0, "semantic_hits": 0, "misses": 0}
+
+    def _key(self, scope, prompt):
+        return hashlib.sha256(f"{scope}\x00{prompt}".encode("utf-8")).hexdigest()
+
+    def get(self, prompt, model, temperature, system_prompt):
+        """查找缓存的回复：先精确匹配，再（启用时）做近似匹配，未命中返回 None"""
+        if not self.enabled:
+            return None
+        scope = scope_key(model, temperature, system_prompt)
+        normalized = normalize_prompt(prompt)
+        try:
+            value = self.backend.get(self._key(scope, normalized))
+            if value is not None:
+                with self._lock:
+                    self.stats["exact_hits"] += 1
+                return value["response"]
+
+            if self.semantic:
+                match = self._nearest(scope, embed_text(normalized))
+                if match is not None:
+                    value = self.backend.get(match)
+                    if value is not None and self._near_exact(normalized, value.get("prompt", "")):
+                        with self._lock:
+                            self.stats["semantic_hits"] += 1
+                        logger.info(f"近似缓存命中: {normalized[:30]!r} ~ {value['prompt'][:30]!r}")
+                        return value["response"]
+        except Exception as e:
+            logger.warning(f"读取响应缓存失败: {e}")
+
+        with self._lock:
+            self.stats["misses"] += 1
+        return None
+
+    def put(self, prompt, model, temperature, system_prompt, response):
+        """写入一条回复"""
+        if not self.enabled or not response:
+            return
+        scope = scope_key(model, temperature, system_prompt)
+        normalized = normalize_prompt(prompt)
+        key = self._key(scope, normalized)
+        try:
+            self.backend.set(key, {"prompt": normalized, "response": response}, self.ttl, scope)
+        except Exception as e:
+            logger.warning(f"写入响应缓存失败: {e}")
+            return
+        if self.semantic:
+            # 本进程写入的条目直接加入向量缓存，下次查找时重建索引矩阵
+            with self._lock:
+                self._embeddings[key] = (scope, embed_text(normalized))
+                self._scope_index.pop(scope, None)
+
+    def _near_exact(self, a, b):
+        """近似匹配的保护条件：长度接近，且两边的词最多相差 max_token_diff 个"""
+        if min(len(a), len(b)) < 0.9 * max(len(a), len(b)):
+            return False
+        diff = Counter(_words(a))
+        diff.subtract(_words(b))
+        return sum(abs(n) for n in diff.values()) <= self.max_token_diff
+
+    def _nearest(self, scope, embedding):
+        """在同一作用域内查找相似度最高且超过阈值的条目键"""
+        if embedding is None:
+            return None
+        keys, matrix = self._index_for(scope)
+        if matrix is None:
+            return None
+        scores = matrix @ embedding
+        best = int(np.argmax(scores))
+        if scores[best] < self.similarity_threshold:
+            return None
+        return keys[best]
+
+    def _index_for(self, scope):
+        """返回作用域的近似匹配索引；过期后只从后端读取键列表，新条目才读取值并计算向量"""
+        now = time.time()
+        with self._lock:
+            index = self._scope_index.get(scope)
+            if index is not None and now - index[2] < self.index_refresh:
+                return index[0], index[1]
+            known = {k for k, (s, _) in self._embeddings.items() if s == scope}
+
+        live = self.backend.keys(scope)
+        missing = [key for key in live if key not in known]
+        computed = {}
+        if missing:
+            for key, value in self.backend.scan(scope, missing):
+                computed[key] = embed_text(value.get("prompt", ""))
+
+        with self._lock:
+            # 删除已不在后端中的条目向量，加入新条目的向量（无法向量化的记为 None，下次不再读取）
+            live_set = set(live)
+            for key in known - live_set:
+                self._embeddings.pop(key, None)
+            for key, vector in computed.items():
+                self._embeddings[key] = (scope, vector)
+            keys = [key for key in live if self._embeddings.get(key, (None, None))[1] is not None]
+            matrix = np.stack([self._embeddings[key][1] for key in keys]) if keys else None
+            self._scope_index[scope] = (keys, matrix, now)
+        return keys, matrix
+
+    def hit_rate(self):
+        """返回总体命中率"""
+        hits = self.stats["exact_hits"] + self.stats["semantic_hits"]
+        total = hits + self.stats["misses"]
+        return hits / total if total else 0.0
+
+    def clear(self):
+        """清空缓存"""
+        self.backend.clear()
+        with self._lock:
+            self._scope_index.clear()
+            self._embeddings.clear()
+
+
+# 创建全局响应缓存实例（进程内所有会话共享，磁盘后端时同一台机器上的进程共享）
+response_cache = ResponseCache(CONFIG.get("cache", {}))
@@ -0,0 +1,229 @@
+"""
+请求调度器 - 进程内所有会话共享的准入控制与公平排队
+
+每个模型有独立的并发上限（每个健康后端的上限 × 健康后端数，增加节点即增加容量），
+超过上限的请求进入等待队列。队列按会话做公平调度（同一会话连续提交的请求不会挤占其它会话），
+短小的提问可以优先处理；后端满载时表现为排队并向用户显示队列位置，而不是请求超时。
+对话摘要等后台任务使用单独的名额，只在没有前台请求排队时才获得名额。
+"""
+import itertools
+import logging
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from utils.config import CONFIG
+
+logger = logging.getLogger(__name__)
+
+# 请求优先级（数值越小越优先）
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+
+
+class AdmissionError(Exception):
+    """队列已满或排队超时，请求未被接受"""
+
+
+class _Ticket:
+    """排队中的一个请求"""
+
+    __slots__ = ("model", "session_id", "priority", "tag", "seq", "enqueued_at", "granted", "background")
+
+    def __init__(self, model, session_id, priority, tag, seq, background=False):
+        self.model = model
+        self.background = background
+        self.session_id = session_id
+        self.priority = priority
+        self.tag = tag
+        self.seq = seq
+        self.enqueued_at = time.time()
+        self.granted = False
+
+
+class RequestScheduler:
+    """按模型限制并发、按会话公平排队的请求调度器（线程安全）"""
+
+    def __init__(self, config=None):
+        config = config or {}
+        self.enabled = bool(config.get("enabled", True))
+        # 每个健康后端上每个模型的并发上限
+        self.default_limit = int(config.get("max_concurrent_per_model", 2))
+        self.model_limits = dict(config.get("model_limits", {}))
+        # 后台任务（对话摘要等）每个模型的名额，不占用前台名额
+        self.background_limit = int(config.get("max_background_per_model", 1))
+        self._backend_pool = None
+        # 不经过后端池的模型，并发上限不随后端数放大
+        self._unpooled_models = set()
+        self.max_queue_size = int(config.get("max_queue_size", 50))
+        self.queue_timeout = float(config.get("queue_timeout", 120))
+        self.poll_interval = float(config.get("poll_interval", 0.5))
+        # 普通优先级请求排队超过该时间后与高优先级请求同等对待，避免长提问饿死
+        self.priority_aging = float(config.get("priority_aging_seconds", 10))
+        self._cond = threading.Condition()
+        self._running = defaultdict(int)
+        self._running_background = defaultdict(int)
+        self._waiting = defaultdict(list)
+        # 公平排队：每个模型一个虚拟时钟，每个会话记录它最后一个请求的虚拟时间标签
+        self._virtual_clock = defaultdict(float)
+        self._session_tags = defaultdict(dict)
+        self._seq = itertools.count()
+
+    def attach_backend_pool(self, backend_pool):
+        """关联后端池，并发上限按其中健康后端的数量放大"""
+        self._backend_pool = backend_pool
+
+    def backend_count(self):
+        """返回当前健康的后端数（至少为 1）"""
+        pool = self._backend_pool
+        if pool is None:
+            return 1
+        return max(1, len(pool.healthy_backends()))
+
+    def mark_unpooled(self, model):
+        """声明模型的请求不经过后端池（例如 OCR 直接请求本地视觉服务），按配置的上限使用"""
+        self._unpooled_models.add(model)
+
+    def limit_for(self, model):
+        """返回模型的并发上限：每个后端的上限 × 健康后端数（不经过后端池的模型不放大）"""
+        limit = int(self.model_limits.get(model, self.default_limit))
+        if model in self._unpooled_models:
+            return limit
+        return limit * self.backend_count()
+
+    @contextmanager
+    def slot(self, model, session_id, priority=PRIORITY_NORMAL, on_wait=None, background=False):
+        """占用一个模型并发名额，名额不足时排队；on_wait(position) 在排队期间被定期调用
+
+        background=True 时使用后台任务的名额，有前台请求排队时让出
+        """
+        if not self.enabled:
+            yield
+            return
+        ticket = self._acquire(model, session_id, priority, on_wait, background)
+        try:
+            yield
+        finally:
+            self._release(ticket)
+
+    def _acquire(self, model, session_id, priority, on_wait, background=False):
+        """排队直到获得名额，返回已授权的票据"""
+        with self._cond:
+            waiting = self._waiting[model]
+            if len(waiting) >= self.max_queue_size:
+                raise AdmissionError(f"模型 {model} 的等待队列已满（{len(waiting)}）")
+            tags = self._session_tags[model]
+            tag = max(self._virtual_clock[model], tags.get(session_id, 0.0)) + 1.0
+            tags[session_id] = tag
+            ticket = _Ticket(model, session_id, priority, tag, next(self._seq), background)
+            waiting.append(ticket)
+
+        deadline = ticket.enqueued_at + self.queue_timeout
+        try:
+            while True:
+                with self._cond:
+                    if self._try_grant(ticket):
+                        break
+                    position = self._position(ticket)
+                if on_wait is not None:
+                    on_wait(position)
+                with self._cond:
+                    if self._try_grant(ticket):
+                        break
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise AdmissionError(f"排队等待超过 {self.queue_timeout:g} 秒")
+                    self._cond.wait(min(self.poll_interval, remaining))
+        except BaseException:
+            with self._cond:
+                if ticket.granted:
+                    self._running_for(ticket)[model] -= 1
+                elif ticket in self._waiting[model]:
+                    self._waiting[model].remove(ticket)
+                self._cond.notify_all()
+            raise
+
+        waited = time.time() - ticket.enqueued_at
+        if waited > self.poll_interval:
+            logger.info(f"会话 {session_id[:8]} 排队 {waited:.1f}秒后获得模型 {model} 的名额")
+        return ticket
+
+    def _release(self, ticket):
+        """归还名额并唤醒排队中的请求"""
+        with self._cond:
+            running = self._running_for(ticket)
+            running[ticket.model] = max(0, running[ticket.model] - 1)
+            self._cond.notify_all()
+
+    def _sort_key(self, ticket, now):
+        """排队顺序：优先级（带老化），再按会话公平的虚拟时间标签，最后按到达顺序"""
+        priority = ticket.priority
+        if priority != PRIORITY_HIGH and now - ticket.enqueued_at >= self.priority_aging:
+            priority = PRIORITY_HIGH
+        return (priority, ticket.tag, ticket.seq)
+
+    def _running_for(self, ticket):
+        return self._running_background if ticket.background else self._running
+
+    def _try_grant(self, ticket):
+        """票据排在队首且有空闲名额时授权（调用方持有锁）"""
+        if ticket.granted:
+            return True
+        model = ticket.model
+        waiting = self._waiting[model]
+        if ticket.background:
+            # 后台任务按到达顺序获得自己的名额，有前台请求排队时让出
+            if self._running_background[model] >= self.background_limit:
+                return False
+            if any(not t.background for t in waiting):
+                return False
+            if min((t for t in waiting if t.background), key=lambda t: t.seq) is not ticket:
+                return False
+        else:
+            if self._running[model] >= self.limit_for(model):
+                return False
+            now = time.time()
+            if min((t for t in waiting if not t.background), key=lambda t: self._sort_key(t, now)) is not ticket:
+                return False
+        waiting.remove(ticket)
+        ticket.granted = True
+        self._running_for(ticket)[model] += 1
+        self._virtual_clock[model] = max(self._virtual_clock[model], ticket.tag)
+        self._prune_session_tags(model)
+        # 可能还有空闲名额，唤醒下一个排队者
+        self._cond.notify_all()
+        return True
+
+    def _position(self, ticket):
+        """排在该票据之前的请求数（调用方持有锁）"""
+        if ticket.background:
+            return sum(1 for t in self._waiting[ticket.model] if not t.background or t.seq < ticket.seq)
+        now = time.time()
+        key = self._sort_key(ticket, now)
+        return sum(1 for t in self._waiting[ticket.model] if not t.background and self._sort_key(t, now) < key)
+
+    def _prune_session_tags(self, model):
+        """清理不再影响排队顺序的会话标签（调用方持有锁）"""
+        tags = self._session_tags[model]
+        if len(tags) > 1000:
+            clock = self._virtual_clock[model]
+            for session_id in [s for s, tag in tags.items() if tag <= clock]:
+                del tags[session_id]
+
+    def stats(self):
+        """返回每个模型当前的运行数和排队数"""
+        with self._cond:
+            models = set(self._running) | set(self._running_background) | set(self._waiting)
+            return {
+                model: {
+                    "running": self._running[model],
+                    "background": self._running_background[model],
+                    "waiting": len(self._waiting[model]),
+                    "limit": self.limit_for(model)
+                }
+                for model in models
+            }
+
+
+# 创建全局请求调度器实例（进程内所有会话共享）
+request_scheduler = RequestScheduler(CONFIG.get("scheduler", {}))
@@ -0,0 +1,71 @@
+"""
+全文检索分词 - 聊天历史倒排索引使用的分词、查询解析和结果摘录
+
+中日韩文字按相邻两个字切分为词（每段文字的最后一个字单独作为一个词，这样每个字都是某个词的开头，
+单字查询可以按前缀匹配）；拉丁字母和数字按单词切分并转为小写。
+倒排索引本身保存在 utils/history_store.py 的 postings 表中，随消息追加增量更新。
+"""
+import re
+import unicodedata
+from collections import Counter
+
+_TOKEN = re.compile(r"([\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af]+)|([0-9a-z_]+)")
+
+# 过长的单词（哈希、base64 等）截断后再索引
+MAX_WORD_LENGTH = 40
+
+
+def _normalize(text):
+    """全角转半角并转为小写"""
+    return unicodedata.normalize("NFKC", text or "").lower()
+
+
+def tokenize(text):
+    """把文本切分为索引词"""
+    terms = []
+    for match in _TOKEN.finditer(_normalize(text)):
+        run, word = match.groups()
+        if word:
+            terms.append(word[:MAX_WORD_LENGTH])
+        else:
+            terms.extend(run[i:i + 2] for i in range(len(run) - 1))
+            terms.append(run[-1])
+    return terms
+
+
+def term_frequencies(text):
+    """返回文本中每个索引词的出现次数"""
+    return Counter(tokenize(text))
+
+
+def query_terms(query):
+    """把查询切分为 (词, 是否按前缀匹配) 列表（去重并保持顺序）"""
+    terms = []
+    for match in _TOKEN.finditer(_normalize(query)):
+        run, word = match.groups()
+        if word:
+            terms.append((word[:MAX_WORD_LENGTH], False))
+        elif len(run) == 1:
+            # 单个字：匹配以它开头的所有词
+            terms.append((run, True))
+        else:
+            terms.extend((run[i:i + 2], False) for i in range(len(run) - 1))
+    return list(dict.fromkeys(terms))
+
+
+def snippet(content, query, width=60):
+    """截取消息中第一个命中查询的位置附近的文字"""
+    text = " ".join((content or "").split())
+    lowered = text.lower()
+    fragments = sorted((m.group(0) for m in _TOKEN.finditer(_normalize(query))), key=len, reverse=True)
+    position = -1
+    for fragment in fragments:
+        position = lowered.find(fragment)
+        if position < 0 and len(fragment) > 2 and not fragment.isascii():
+            # 整段没有出现时用第一个二字词定位
+            position = lowered.find(fragment[:2])
+        if position >= 0:
+            break
+    start = max(0, position - width // 3) if position >= 0 else 0
+    end = start + width
+    return ("…" if start > 0 else "") + text[start:end] + ("…" if end < len(text) else "")
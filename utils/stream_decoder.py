@@ -0,0 +1,175 @@
+"""
+流式响应解码器 - 增量解析 Ollama NDJSON、OpenAI SSE 和纯文本流
+
+解码器直接处理网络读到的原始字节：分帧格式和内容字段只在流开始时识别一次，
+之后每一行只定位 content 字段并用 C 实现的 scanstring 解码这个字符串值，
+不再对整行做 decode + json.loads + 逐层取字典。无法走快速路径的行才回退到
+完整 JSON 解析。性能基准见 benchmarks/stream_decoder_bench.py。
+"""
+import json
+import logging
+from json.decoder import scanstring as _scanstring
+
+logger = logging.getLogger(__name__)
+
+# 分帧格式
+FRAMING_NDJSON = "ndjson"
+FRAMING_SSE = "sse"
+FRAMING_TEXT = "text"
+
+# 按顺序尝试的内容字段（Ollama chat/OpenAI 使用 content，Ollama generate 使用 response）
+_CONTENT_KEYS = (b'"content":"', b'"response":"')
+_SSE_PREFIX = b"data:"
+_SSE_DONE = b"[DONE]"
+
+# 解析失败的行最多保留多少字节，用于流结束后的整体回退解析
+_MAX_UNPARSED_BYTES = 1024 * 1024
+
+
+class StreamError(str):
+    """流式生成中以文本块形式返回的错误提示：界面照常显示，但不应写入历史缓存"""
+
+
+class StreamDecoder:
+    """增量流式解码器：feed() 输入原始字节，返回本次解出的文本片段列表"""
+
+    def __init__(self, api_type="unknown"):
+        self.api_type = api_type
+        self.framing = None
+        self.done = False
+        self.parse_errors = 0
+        self.chunks = 0
+        self.error = None
+        self._pending = b""
+        self._content_key = None
+        self._unparsed = []
+        self._unparsed_size = 0
+
+    def feed(self, data):
+        """输入一段原始字节，返回其中所有完整行解出的内容"""
+        if self.done or not data:
+            return []
+
+        lines = (self._pending + data).split(b"\n") if self._pending else data.split(b"\n")
+        # 最后一段可能是不完整的行，留到下一个数据块
+        self._pending = lines.pop()
+        if not lines:
+            return []
+
+        if self.framing is None:
+            self.framing = _detect_framing(lines)
+            if self.framing is None:
+                return []
+
+        out = []
+        append = out.append
+        key = self._content_key
+        key_len = len(key) if key else 0
+        sse = self.framing == FRAMING_SSE
+
+        for line in lines:
+            if not line or line == b"\r":
+                continue
+            if sse and line.startswith(_SSE_PREFIX) and line[5:].strip() == _SSE_DONE:
+                self.done = True
+                break
+
+            # 快速路径：定位内容字段，只解码该字段的字符串值
+            pos = line.find(key) if key else -1
+            if pos != -1:
+                try:
+                    content = _scanstring(line[pos + key_len:].decode("utf-8", "replace"), 0)[0]
+                except ValueError:
+                    content = self._decode_line(line)
+            else:
+                content = self._decode_line(line)
+                if key is None and self._content_key is not None:
+                    key = self._content_key
+                    key_len = len(key)
+            if content:
+                append(content)
+
+        self.chunks += len(out)
+        return out
+
+    def flush(self):
+        """流结束时处理缓冲区中最后一行（没有换行结尾的情况）"""
+        out = []
+        if not self.done and self._pending.strip():
+            out = self.feed(b"\n")
+        self._pending = b""
+        return out
+
+    def unparsed_text(self):
+        """返回解析失败的原始内容，供非流式（整块JSON）响应回退解析"""
+        return b"\n".join(self._unparsed).decode("utf-8", errors="replace")
+
+    def _decode_line(self, line):
+        """通用路径：处理快速路径无法识别的行，并确定本次流使用的内容字段"""
+        line = line.strip()
+        if not line:
+            return ""
+        if self.framing == FRAMING_TEXT:
+            return line.decode("utf-8", errors="replace")
+        if self.framing == FRAMING_SSE:
+            # SSE 中的注释、event: 等行直接忽略
+            if not line.startswith(_SSE_PREFIX):
+                return ""
+            line = line[5:].lstrip()
+
+        if self._content_key is None:
+            for candidate in _CONTENT_KEYS:
+                if candidate in line:
+                    self._content_key = candidate
+                    break
+        return self._slow_extract(line)
+
+    def _slow_extract(self, line):
+        """慢速路径：完整解析 JSON 并按常见格式提取内容"""
+        try:
+            chunk = json.loads(line)
+        except ValueError:
+            self.parse_errors += 1
+            if self._unparsed_size < _MAX_UNPARSED_BYTES:
+                self._unparsed.append(line)
+                self._unparsed_size += len(line)
+            return ""
+        if isinstance(chunk, dict):
+            if "error" in chunk and self.error is None:
+                self.error = str(chunk["error"])
+            return extract_stream_content(chunk)
+        return ""
+
+
+def _detect_framing(lines):
+    """根据第一行非空内容识别分帧格式（每个流只执行一次），全部为空行时返回 None"""
+    for line in lines:
+        head = line.lstrip()
+        if not head:
+            continue
+        if head.startswith(_SSE_PREFIX) or head.startswith(b"event:") or head.startswith(b":"):
+            return FRAMING_SSE
+        if head.startswith(b"{") or head.startswith(b"["):
+            return FRAMING_NDJSON
+        return FRAMING_TEXT
+    return None
+
+
+def extract_stream_content(chunk_data):
+    """从流式响应数据块中提取内容（兼容各种API格式）"""
+    if "content" in chunk_data and isinstance(chunk_data["content"], str):
+        return chunk_data["content"]
+    message = chunk_data.get("message")
+    if isinstance(message, dict) and "content" in message:
+        return message["content"] or ""
+    choices = chunk_data.get("choices")
+    if choices:
+        choice = choices[0]
+        delta = choice.get("delta")
+        if isinstance(delta, dict) and "content" in delta:
+            return delta["content"] or ""
+        if "text" in choice:
+            return choice["text"] or ""
+    if "response" in chunk_data:
+        return chunk_data["response"] or ""
+    return ""
@@ -0,0 +1,102 @@
+"""
+流式渲染器 - 合并流式数据块后再刷新界面
+
+逐块调用 placeholder.markdown(全文) 时，每个 token 都会重新发送并重新渲染整段回复，
+长回复的服务端开销和 websocket 流量随长度平方增长。渲染器把数据块先累积起来，
+按时间间隔（随回复长度增长）或字符数批量刷新，遇到句子结尾、换行或代码块边界时提前刷新，
+使显示节奏自然，同时把刷新次数降低一个数量级。
+
+后台生成时渲染器保存在会话状态中，跨 fragment 的多次运行保留节流状态：每次运行换用新的占位符，
+没有达到刷新条件时只重新显示上次刷新的内容（内容不变的较大消息由 Streamlit 的消息缓存按哈希引用发送）。
+"""
+import logging
+import time
+from utils.config import CONFIG
+
+logger = logging.getLogger(__name__)
+
+# 在这些字符处结束的数据块是自然的刷新点
+_BOUNDARY_CHARS = ("。", "！", "？", "；", ".", "!", "?", ";", "\n")
+_CODE_FENCE = "```"
+
+
+class StreamRenderer:
+    """把流式文本增量渲染到 Streamlit 占位符，按时间/字符预算和文本边界节流刷新"""
+
+    def __init__(self, placeholder, config=None, cursor=""):
+        config = CONFIG.get("ui", {}) if config is None else config
+        # 两次刷新之间的基础间隔（毫秒）
+        self.flush_interval = float(config.get("stream_flush_interval_ms", 100)) / 1000.0
+        # 回复越长每次刷新的代价越大，刷新间隔随长度增长，但不超过该上限（毫秒）
+        self.max_flush_interval = float(config.get("stream_max_flush_interval_ms", 500)) / 1000.0
+        # 待刷新字符数达到该值时立即刷新
+        self.flush_chars = int(config.get("stream_flush_chars", 400))
+        # 遇到句子/代码块边界时，距上次刷新至少经过该时间（毫秒）才提前刷新
+        self.boundary_interval = float(config.get("stream_boundary_flush_ms", 40)) / 1000.0
+        self.placeholder = placeholder
+        self.cursor = cursor
+        self.text = ""
+        self.renders = 0
+        self._pending = 0
+        self._last_flush = 0.0
+        # 上次刷新到界面的文本（含光标和补齐的代码块）
+        self._shown = ""
+
+    def append(self, chunk):
+        """追加一个数据块，满足刷新条件时刷新界面"""
+        if not chunk:
+            return
+        self.text += chunk
+        self._pending += len(chunk)
+        if self._should_flush(chunk):
+            self._render(self.cursor)
+
+    def flush_pending(self):
+        """没有新数据块时，待刷新内容到达刷新间隔后刷新"""
+        if self._pending and self._should_flush(""):
+            self._render(self.cursor)
+
+    def attach(self, placeholder):
+        """换用新的占位符（fragment 每次运行都会重新创建元素）"""
+        self.placeholder = placeholder
+
+    def refresh(self):
+        """在当前占位符中重新显示上次刷新的内容，不显示尚未刷新的新内容"""
+        if self._shown:
+            self.placeholder.markdown(self._shown)
+
+    def reset(self):
+        """清空文本，保留刷新节奏（之后追加完整文本）"""
+        self.text = ""
+        self._pending = 0
+
+    def _should_flush(self, chunk):
+        # 第一个数据块立即显示，保证首字延迟不受节流影响
+        if self.renders == 0 or self._pending >= self.flush_chars:
+            return True
+        elapsed = time.monotonic() - self._last_flush
+        # 每 1000 个字符增加一个基础间隔
+        interval = min(self.max_flush_interval, self.flush_interval * (1 + len(self.text) / 1000))
+        if elapsed >= interval:
+            return True
+        at_boundary = chunk.rstrip(" ").endswith(_BOUNDARY_CHARS) or _CODE_FENCE in chunk
+        return at_boundary and elapsed >= max(self.boundary_interval, interval / 2)
+
+    def _render(self, suffix):
+        text = self.text
+        # 流式过程中临时补齐未闭合的代码块，避免后续内容整体被当作代码渲染后又跳回
+        if suffix and text.count(_CODE_FENCE) % 2 == 1:
+            text = f"{text}{suffix}\n{_CODE_FENCE}"
+        else:
+            text = text + suffix
+        self.placeholder.markdown(text)
+        self._shown = text
+        self.renders += 1
+        self._pending = 0
+        self._last_flush = time.monotonic()
+
+    def finish(self):
+        """生成结束：刷新剩余内容并去掉光标，返回完整文本"""
+        if self.text and (self._pending or self.cursor):
+            self._render("")
+        return self.text
@@ -0,0 +1,132 @@
+"""
+对话摘要 - 把较早的对话轮次折叠为滚动摘要，限制每轮提示词的长度
+
+未摘要的历史消息超过 token 预算的一定比例时，在后台线程中用轻量模型把最早的若干轮
+对话与已有摘要合并为新的摘要，保存在对话记录的 "summary" 字段中：
+{"text": 摘要, "upto": 已被摘要覆盖的消息数, "updated_at": 时间戳}。
+请求路径上只做一次判断和提交，不等待摘要生成。
+"""
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from utils.config import CONFIG
+from utils.context_packer import context_packer
+from utils.scheduler import request_scheduler
+
+logger = logging.getLogger(__name__)
+
+_SUMMARY_PROMPT = """你负责维护一段对话的滚动摘要。请把“已有摘要”和“新的对话内容”合并为一份新的摘要：
+保留用户的目标、偏好、已确认的事实和结论、未解决的问题，以及后续回答需要的关键细节；
+省略寒暄和重复内容。使用对话所用的语言，只输出摘要本身，不超过 {max_words} 字。
+
+已有摘要：
+{summary}
+
+新的对话内容：
+{transcript}"""
+
+
+def summary_message(summary_text):
+    """把摘要包装为放在系统提示词之后的系统消息"""
+    return {"role": "system", "content": f"以下是之前对话的摘要（更早的消息已省略）：\n{summary_text}"}
+
+
+class ConversationSummarizer:
+    """在后台把对话的早期轮次折叠为摘要（线程安全，每个对话同一时间最多一个摘要任务）"""
+
+    def __init__(self, config=None):
+        config = config or {}
+        self.enabled = bool(config.get("enabled", True))
+        self.model = config.get("model", "qwen2.5:3b")
+        # 未摘要历史超过预算的该比例时触发摘要
+        self.trigger_ratio = float(config.get("trigger_ratio", 0.6))
+        # 摘要后保留原文的最近历史占预算的比例
+        self.keep_ratio = float(config.get("keep_ratio", 0.3))
+        self.max_summary_tokens = int(config.get("max_summary_tokens", 512))
+        self.temperature = float(config.get("temperature", 0.2))
+        self._executor = ThreadPoolExecutor(max_workers=int(config.get("max_workers", 2)), thread_name_prefix="llm-summary")
+        self._in_flight = set()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def active_summary(chat):
+        """返回对话当前有效的摘要（消息被清空等导致摘要失效时返回 None）"""
+        summary = chat.get("summary")
+        if not summary or summary.get("upto", 0) > len(chat.get("messages", [])):
+            return None
+        return summary
+
+    def unsummarized(self, chat):
+        """返回尚未被摘要覆盖的消息"""
+        summary = self.active_summary(chat)
+        messages = chat.get("messages", [])
+        return messages[summary["upto"]:] if summary else messages
+
+    def maybe_schedule(self, chat_id, chat, llm_client, budget):
+        """未摘要的历史超过预算阈值时在后台提交摘要任务，立即返回是否已提交"""
+        if not self.enabled or not hasattr(llm_client, "generate_response"):
+            return False
+        pending = self.unsummarized(chat)
+        tokens = [context_packer.message_tokens(m) for m in pending]
+        if sum(tokens) <= budget * self.trigger_ratio:
+            return False
+
+        # 从最新的消息往前保留 keep_ratio 的预算，其余折叠进摘要；折叠边界落在助手回复之后
+        keep_budget = budget * self.keep_ratio
+        kept = 0
+        fold = len(pending)
+        while fold > 0 and kept + tokens[fold - 1] <= keep_budget:
+            fold -= 1
+            kept += tokens[fold]
+        while fold > 0 and pending[fold - 1]["role"] != "assistant":
+            fold -= 1
+        if fold == 0:
+            return False
+
+        with self._lock:
+            if chat_id in self._in_flight:
+                return False
+            self._in_flight.add(chat_id)
+        summary = self.active_summary(chat)
+        start = summary["upto"] if summary else 0
+        self._executor.submit(self._summarize, chat_id, chat, llm_client, summary, pending[:fold], start + fold)
+        return True
+
+    def _summarize(self, chat_id, chat, llm_client, summary, folded, upto):
+        """生成新的摘要并写回对话记录（在后台线程中运行）"""
+        try:
+            transcript = "\n".join(
+                f"{'用户' if m['role'] == 'user' else '助手'}: {m['content']}" for m in folded if m["role"] != "system"
+            )
+            prompt = _SUMMARY_PROMPT.format(
+                max_words=self.max_summary_tokens,
+                summary=summary["text"] if summary else "（无）",
+                transcript=transcript
+            )
+            started = time.time()
+            # 使用后台名额，不占用聊天请求的并发名额
+            with request_scheduler.slot(self.model, f"summarizer:{chat_id}", background=True):
+                reply, error = llm_client.generate_response(
+                    [{"role": "user", "content": prompt}],
+                    self.model,
+                    temperature=self.temperature,
+                    max_tokens=self.max_summary_tokens * 2,
+                    # 工作线程中没有脚本上下文，不能走流式分支（它会向页面渲染）
+                    stream=False
+                )
+            if error or not reply:
+                logger.warning(f"对话摘要生成失败: {error}")
+                return
+            # 一次赋值替换整个摘要，界面线程读到的总是完整的一份
+            chat["summary"] = {"text": reply.strip(), "upto": upto, "updated_at": time.time()}
+            logger.info(f"对话 {chat_id[:8]} 的前 {upto} 条消息已折叠为摘要（耗时 {time.time() - started:.1f}秒）")
+        except Exception as e:
+            logger.warning(f"对话摘要生成出错: {e}")
+        finally:
+            with self._lock:
+                self._in_flight.discard(chat_id)
+
+
+# 创建全局对话摘要器
+conversation_summarizer = ConversationSummarizer(CONFIG.get("conversation", {}).get("summarization", {}))